@@ -0,0 +1,349 @@
+"""
+
+Equivalence checks and timings of the factorization based segmentation steps
+
+Usage:
+    python factseg_bench.py [size]
+
+"""
+# Import required packages
+import sys
+import time
+import tracemalloc
+import numpy as np
+from numpy import linalg as LA
+
+# Import customized modules
+import satellite_image_factoseg as satseg
+import factseg_subspace as subspace
+import factseg_cluster as cluster
+import factseg_nmf
+
+
+def SHcomp_integral(Ig, ws, BinN=11):
+    """
+    Reference integral histogram implementation of satseg.SHcomp
+    """
+    h, w, bn = Ig.shape
+
+    # quantize values at each pixel into bin ID
+    for i in range(bn):
+        b_max = np.max(Ig[:, :, i])
+        b_min = np.min(Ig[:, :, i])
+        assert b_max != b_min, "Band %d has only one value!" % i
+
+        b_interval = (b_max - b_min) * 1. / BinN
+        Ig[:, :, i] = np.floor((Ig[:, :, i] - b_min) / b_interval)
+
+    Ig[Ig >= BinN] = BinN-1
+    Ig = np.int32(Ig)
+
+    # convert to one hot encoding
+    one_hot_pix = []
+    for i in range(bn):
+        one_hot_pix_b = np.zeros((h*w, BinN), dtype=np.int32)
+        one_hot_pix_b[np.arange(h*w), Ig[:, :, i].flatten()] = 1
+        one_hot_pix.append(one_hot_pix_b.reshape((h, w, BinN)))
+
+    # compute integral histogram
+    integral_hist = np.concatenate(one_hot_pix, axis=2)
+
+    np.cumsum(integral_hist, axis=1, out=integral_hist, dtype=np.float32)
+    np.cumsum(integral_hist, axis=0, out=integral_hist, dtype=np.float32)
+
+    # compute spectral histogram based on integral histogram
+    padding_l = np.zeros((h, ws + 1, BinN * bn), dtype=np.int32)
+    padding_r = np.tile(integral_hist[:, -1:, :], (1, ws, 1))
+
+    integral_hist_pad_tmp = np.concatenate([padding_l, integral_hist, padding_r], axis=1)
+
+    padding_t = np.zeros((ws + 1, integral_hist_pad_tmp.shape[1], BinN * bn), dtype=np.int32)
+    padding_b = np.tile(integral_hist_pad_tmp[-1:, :, :], (ws, 1, 1))
+
+    integral_hist_pad = np.concatenate([padding_t, integral_hist_pad_tmp, padding_b], axis=0)
+
+    integral_hist_1 = integral_hist_pad[ws + 1 + ws:, ws + 1 + ws:, :]
+    integral_hist_2 = integral_hist_pad[:-ws - ws - 1, :-ws - ws - 1, :]
+    integral_hist_3 = integral_hist_pad[ws + 1 + ws:, :-ws - ws -1, :]
+    integral_hist_4 = integral_hist_pad[:-ws - ws - 1, ws + 1 + ws:, :]
+
+    sh_mtx = integral_hist_1 + integral_hist_2 - integral_hist_3 - integral_hist_4
+
+    histsum = np.sum(sh_mtx, axis=-1, keepdims=True) * 1. / bn
+
+    sh_mtx = np.float32(sh_mtx) / np.float32(histsum)
+
+    return sh_mtx
+
+
+def cluster_loop(Y_woedge, segn):
+    """
+    Reference per-centre clustering of the original satseg.Fseg
+    """
+    dimn = Y_woedge.shape[1]
+    cls_cen = np.zeros((segn, dimn), dtype=np.float32)
+    L = np.sum(Y_woedge ** 2, axis=1)
+    cls_cen[0, :] = Y_woedge[np.argmax(L), :]  # find the first initial center
+
+    D = np.sum((cls_cen[0, :] - Y_woedge) ** 2, axis=1)
+    cls_cen[1, :] = Y_woedge[np.argmax(D), :]
+
+    cen_id = 1
+    while cen_id < segn-1:
+        cen_id += 1
+        D_tmp = np.zeros((cen_id, Y_woedge.shape[0]), dtype=np.float32)
+        for i in range(cen_id):
+            D_tmp[i, :] = np.sum((cls_cen[i, :] - Y_woedge) ** 2, axis=1)
+        D = np.min(D_tmp, axis=0)
+        cls_cen[cen_id, :] = Y_woedge[np.argmax(D), :]
+
+    D_cen2all = np.zeros((segn, Y_woedge.shape[0]), dtype=np.float32)
+    cls_cen_new = np.zeros((segn, dimn), dtype=np.float32)
+    is_converging = 1
+    while is_converging:
+        for i in range(segn):
+            D_cen2all[i, :] = np.sum((cls_cen[i, :] - Y_woedge) ** 2, axis=1)
+
+        cls_id = np.argmin(D_cen2all, axis=0)
+
+        for i in range(segn):
+            cls_cen_new[i, :] = np.mean(Y_woedge[cls_id == i, :], axis=0)
+
+        if np.max((cls_cen_new - cls_cen)**2) < .00001:
+            is_converging = 0
+        else:
+            cls_cen = cls_cen_new * 1.
+    return cls_cen_new
+
+
+def nmf_loop(Y, w0, segn):
+    """
+    Reference non-negative refinement of the original satseg.Fseg, without its prints.
+    returns the weights and the number of iterations
+    """
+    dnorm0 = 1
+    for i in range(100):
+        tmp, _, _, _ = LA.lstsq(np.dot(w0.T, w0) + np.eye(segn) * .01, np.dot(w0.T, Y.T), rcond=None)
+        h = np.maximum(0, tmp)
+        tmp, _, _, _ = LA.lstsq(np.dot(h, h.T) + np.eye(segn) * .01, np.dot(h, Y), rcond=None)
+        w = np.maximum(0, tmp)
+        w = w.T * 1.
+
+        d = Y.T - np.dot(w, h)
+        dnorm = np.sqrt(np.mean(d * d))
+        if np.abs(dnorm - dnorm0) < .1:
+            break
+
+        w0 = w * 1.
+        dnorm0 = dnorm * 1.
+    return h, i + 1
+
+
+def SHedgeness_loop(sh_mtx, ws):
+    """
+    Reference per-pixel implementation of satseg.SHedgeness
+    """
+    h, w, _ = sh_mtx.shape
+    edge_map = np.ones((h, w)) * -1
+    for i in range(ws, h-ws-1):
+        for j in range(ws, w-ws-1):
+            edge_map[i, j] = np.sqrt(np.sum((sh_mtx[i - ws, j, :] - sh_mtx[i + ws, j, :])**2)
+                                     + np.sum((sh_mtx[i, j - ws, :] - sh_mtx[i, j + ws, :])**2))
+    return edge_map
+
+
+def timeit(func, *args, **kwargs):
+    """
+    Run func once and return its output and run time in seconds
+    """
+    time0 = time.perf_counter()
+    out = func(*args, **kwargs)
+    return out, time.perf_counter() - time0
+
+
+def peak_memory(func, *args, **kwargs):
+    """
+    Run func once and return its output, run time in seconds and peak traced memory in bytes
+    """
+    tracemalloc.start()
+    try:
+        out, seconds = timeit(func, *args, **kwargs)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return out, seconds, peak
+
+
+def bench_histogram(size=512, bn=15, ws=12, strip_rows=64, seed=0):
+    """
+    Check the box sum histograms against the integral histograms and compare their
+    run time and peak memory
+    :param size: height and width of the synthetic image
+    :param bn: number of bands
+    :param ws: half window size
+    :param strip_rows: rows per strip of the box sum histograms
+    :param seed: random seed
+    :return: dictionary of run times in seconds and peak memory in MB
+    """
+    rng = np.random.default_rng(seed)
+    Ig = np.float32(rng.random((size, size, bn)))
+
+    ref, t_ref, m_ref = peak_memory(SHcomp_integral, Ig.copy(), ws)
+    result = {'size': size, 'integral_s': t_ref, 'integral_MB': m_ref / 2 ** 20}
+    for dtype in (np.float32, np.uint16):
+        out, t_box, m_box = peak_memory(satseg.SHcomp, Ig.copy(), ws, dtype=dtype, strip_rows=strip_rows)
+        assert np.array_equal(ref, out), "Local histograms differ!"
+        result[np.dtype(dtype).name + '_s'] = t_box
+        result[np.dtype(dtype).name + '_MB'] = m_box / 2 ** 20
+    return result
+
+
+def bench_subspace(n_pixels=1000000, dims=165, rank=8, k=6, seed=0):
+    """
+    Compare the subspace solvers with the dense eigendecomposition of Y.T @ Y
+    :param n_pixels: number of pixels of the synthetic features
+    :param dims: number of features, i.e. BinN x bands
+    :param rank: rank of the signal in the synthetic features
+    :param k: number of leading eigenvectors
+    :param seed: random seed
+    :return: dictionary of run times in seconds and errors of each solver
+    """
+    rng = np.random.default_rng(seed)
+    Y = np.float32(np.abs(np.dot(rng.standard_normal((n_pixels, rank)), rng.standard_normal((rank, dims)))
+                          + .1 * rng.standard_normal((n_pixels, dims))))
+
+    _, t_dot = timeit(np.dot, Y.T, Y)
+    S, t_gram = timeit(subspace.gram, Y)
+    d_ref, v_ref = subspace.leading_eigenpairs(Y, k, method="eigh", S=S)
+
+    # projection as Fseg, against the float64 product of the whole features
+    Y1, t_project = timeit(subspace.project, Y, v_ref)
+    assert np.allclose(Y1, np.dot(np.float64(Y), v_ref), rtol=1e-12, atol=1e-9), "Projections differ!"
+    result = {'n_pixels': n_pixels, 'dot_s': t_dot, 'gram_s': t_gram, 'project_s': t_project}
+    for method in subspace.SUBSPACE_METHODS:
+        (d, v), t = timeit(subspace.leading_eigenpairs, Y, k, method=method, S=S)
+        result[method + '_s'] = t
+        result[method + '_eigenvalue_err'] = float(np.max(np.abs(d - d_ref)) / d_ref[0])
+        result[method + '_vector_err'] = float(np.max(1 - np.abs(np.sum(v * v_ref, axis=0))))
+    return result
+
+
+def bench_cluster(n_pixels=1000000, segn=6, batch_size=4096, seed=0):
+    """
+    Check the vectorised k-means against the per-centre loop and compare the
+    throughput of the seeding and update methods
+    :param n_pixels: number of edge-free pixels of the synthetic features
+    :param segn: number of segments, i.e. clusters and features
+    :param batch_size: number of pixels per mini-batch
+    :param seed: random seed
+    :return: dictionary of run times in seconds, pixels per second and inertia of each method
+    """
+    rng = np.random.default_rng(seed)
+    means = rng.standard_normal((segn, segn)) * 3
+    Y_woedge = means[rng.integers(segn, size=n_pixels)] + rng.standard_normal((n_pixels, segn))
+
+    def inertia(centres):
+        labels = cluster.assign(Y_woedge, centres)
+        return float(np.mean(np.sum((Y_woedge - centres[labels]) ** 2, axis=1)))
+
+    ref, t_loop = timeit(cluster_loop, Y_woedge, segn)
+    result = {'n_pixels': n_pixels, 'loop_s': t_loop, 'loop_inertia': inertia(ref)}
+    for name, kwargs in [('lloyd', {}), ('kmeans++', {'init': 'kmeans++'}),
+                         ('minibatch', {'init': 'kmeans++', 'batch_size': batch_size})]:
+        (centres, n_iter), t = timeit(cluster.kmeans, Y_woedge, segn, **kwargs)
+        if name == 'lloyd':
+            assert np.allclose(ref, centres, atol=1e-3), "Cluster centres differ!"
+        result[name + '_s'] = t
+        result[name + '_pixels_per_s'] = n_pixels * n_iter / t if name != 'minibatch' else batch_size * n_iter / t
+        result[name + '_iterations'] = n_iter
+        result[name + '_inertia'] = inertia(centres)
+    return result
+
+
+def bench_nmf(n_pixels=1000000, dims=165, segn=6, seed=0):
+    """
+    Compare the labels and run time of the NMF refinement with the original loop
+    :param n_pixels: number of pixels of the synthetic features
+    :param dims: number of features, i.e. BinN x bands
+    :param segn: number of segments
+    :param seed: random seed
+    :return: dictionary of run times in seconds, iterations and label agreement of each method.
+             the default settings stop as the original loop, on an absolute change of .1 of
+             the RMS residual, which is often after two iterations. the methods are also run
+             with a relative tolerance, so compare their time per iteration
+    """
+    rng = np.random.default_rng(seed)
+    w_true = rng.random((dims, segn))
+    h_true = rng.dirichlet(np.ones(segn) * .2, size=n_pixels).T
+    Y = np.float32(np.dot(w_true, h_true).T + .01 * rng.random((n_pixels, dims)))
+    w0 = w_true + .1 * rng.standard_normal((dims, segn))
+
+    (h, n_iter), t_loop = timeit(nmf_loop, Y, w0, segn)
+    labels = np.argmax(h, axis=0)
+    result = {'n_pixels': n_pixels, 'loop_s': t_loop, 'loop_iterations': n_iter,
+              'loop_s_per_iteration': t_loop / n_iter}
+
+    # the default settings reproduce the float64 loop, float32 is only compared
+    (_, h, dnorms), t = timeit(factseg_nmf.nmf, Y.T, w0)
+    assert len(dnorms) == n_iter, "Number of NMF iterations differs!"
+    assert np.array_equal(np.argmax(h, axis=0), labels), "NMF labels differ!"
+    _, h64, _ = factseg_nmf.nmf(Y.T, w0, dtype=np.float64)
+    assert np.array_equal(h, h64), "Default NMF is not the float64 one!"
+    result['default_s'] = t
+    _, h, _ = factseg_nmf.nmf(Y.T, w0, dtype=np.float32)
+    result['default_float32_agreement'] = float(np.mean(np.argmax(h, axis=0) == labels))
+
+    for method in factseg_nmf.NMF_METHODS:
+        for dtype in (np.float64, np.float32):
+            (_, h, dnorms), t = timeit(factseg_nmf.nmf, Y.T, w0, method=method, rtol=1e-2, dtype=dtype)
+            name = '%s_%s' % (method, np.dtype(dtype).name)
+            result[name + '_s'] = t
+            result[name + '_iterations'] = len(dnorms)
+            result[name + '_s_per_iteration'] = t / len(dnorms)
+            result[name + '_agreement'] = float(np.mean(np.argmax(h, axis=0) == labels))
+    return result
+
+
+def bench_edgeness(size=512, dimn=4, ws=12, chunk_rows=64, seed=0):
+    """
+    Check the vectorised edgeness against the per-pixel loop and time both
+    :param size: height and width of the synthetic features
+    :param dimn: number of features, i.e. segments in Fseg
+    :param ws: half window size
+    :param chunk_rows: rows per chunk of the chunked variant
+    :param seed: random seed
+    :return: dictionary of run times in seconds and the largest differences
+    """
+    rng = np.random.default_rng(seed)
+    Y1 = np.float32(rng.random((size, size, dimn)))
+
+    ref, t_loop = timeit(SHedgeness_loop, Y1, ws)
+    out, t_vec = timeit(satseg.SHedgeness, Y1, ws)
+    out_chunked, t_chunked = timeit(satseg.SHedgeness, Y1, ws, chunk_rows=chunk_rows)
+
+    assert np.array_equal(ref < 0, out < 0), "Edge map borders differ!"
+    assert np.allclose(ref, out, rtol=1e-5, atol=1e-6), "Edge maps differ!"
+    assert np.array_equal(out, out_chunked), "Chunked edge map differs!"
+
+    return {'size': size, 'loop_s': t_loop, 'vectorised_s': t_vec, 'chunked_s': t_chunked,
+            'speedup': t_loop / t_vec, 'max_abs_diff': float(np.max(np.abs(ref - out)))}
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 512
+
+    for ws in (2, 12):
+        print(bench_edgeness(size=size, ws=ws))
+    print(bench_histogram(size=size))
+    print(bench_subspace(n_pixels=size * size))
+    print(bench_cluster(n_pixels=size * size))
+    print(bench_nmf(n_pixels=size * size))
+    # degenerate shapes where the window does not fit
+    for shape in ((3, 40, 2), (40, 3, 2), (1, 1, 1)):
+        sh_mtx = np.ones(shape, dtype=np.float32)
+        assert np.array_equal(SHedgeness_loop(sh_mtx, 1), satseg.SHedgeness(sh_mtx, 1))
+
+
+if __name__ == '__main__':
+
+    main()
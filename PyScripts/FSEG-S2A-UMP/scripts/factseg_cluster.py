@@ -0,0 +1,135 @@
+"""
+
+K-means clustering of the representative features of Fseg
+
+Distances to all centres are computed at once with the ||x||^2 - 2 x.c + ||c||^2
+expansion, over chunks of pixels to bound the size of the distance matrix.
+Centres are seeded deterministically, either with the farthest point heuristic of
+the original Fseg or with k-means++, and updated on all pixels (Lloyd) or on
+random mini-batches.
+
+"""
+import numpy as np
+
+CLUSTER_INITS = ("farthest", "kmeans++")
+CHUNK_ROWS = 65536
+
+
+def sq_distances(X, centres, X_sq=None):
+    """
+    Compute the squared Euclidean distances between points and centres
+    :param X: points, (n, d)
+    :param centres: centres, (k, d)
+    :param X_sq: optional precomputed squared norms of the points, (n,)
+    :return: squared distances, (n, k), clipped at 0 against rounding errors
+    """
+    if X_sq is None:
+        X_sq = np.einsum('ij,ij->i', X, X)
+    D = np.dot(X, centres.T)
+    D *= -2
+    D += X_sq[:, None]
+    D += np.einsum('ij,ij->i', centres, centres)[None, :]
+    return np.maximum(D, 0, out=D)
+
+
+def assign(X, centres, chunk_rows=CHUNK_ROWS):
+    """
+    Assign each point to its nearest centre
+    :param X: points, (n, d)
+    :param centres: centres, (k, d)
+    :param chunk_rows: number of points per chunk
+    :return: cluster ID of each point, (n,)
+    """
+    labels = np.empty(X.shape[0], dtype=np.intp)
+    for start in range(0, X.shape[0], chunk_rows):
+        labels[start:start + chunk_rows] = np.argmin(sq_distances(X[start:start + chunk_rows], centres), axis=1)
+    return labels
+
+
+def init_centres(X, k, init="farthest", seed=0):
+    """
+    Seed the cluster centres
+    :param X: points, (n, d)
+    :param k: number of clusters
+    :param init: 'farthest' starts from the point of largest norm and adds the point
+                 farthest from the current centres, as the original Fseg. 'kmeans++'
+                 starts from a random point and samples points with probability
+                 proportional to their squared distance to the current centres
+    :param seed: random seed of 'kmeans++'
+    :return: centres, (k, d) float32
+    """
+    assert init in CLUSTER_INITS, "Undefined initialisation method."
+    assert 0 < k <= X.shape[0], "Number of clusters must be between 1 and %d!" % X.shape[0]
+    rng = np.random.default_rng(seed)
+
+    centres = np.zeros((k, X.shape[1]), dtype=np.float32)
+    if init == "farthest":
+        centres[0, :] = X[np.argmax(np.sum(X ** 2, axis=1)), :]
+    else:
+        centres[0, :] = X[rng.integers(X.shape[0]), :]
+
+    # squared distance of each point to its nearest centre, updated as centres are added
+    D = np.sum((centres[0, :] - X) ** 2, axis=1)
+    for i in range(1, k):
+        if init == "farthest":
+            idx = np.argmax(D)
+        else:
+            total = np.sum(D, dtype=np.float64)
+            idx = rng.choice(X.shape[0], p=D / total) if total > 0 else rng.integers(X.shape[0])
+        centres[i, :] = X[idx, :]
+        np.minimum(D, np.sum((centres[i, :] - X) ** 2, axis=1), out=D)
+    return centres
+
+
+def _cluster_sums(X, labels, k):
+    """
+    Sum and count the points of each cluster
+    """
+    counts = np.bincount(labels, minlength=k)
+    sums = np.stack([np.bincount(labels, weights=X[:, j], minlength=k) for j in range(X.shape[1])], axis=1)
+    return sums, counts
+
+
+def kmeans(X, k, init="farthest", max_iter=300, tol=1e-5, batch_size=None, seed=0, chunk_rows=CHUNK_ROWS):
+    """
+    Cluster points with k-means
+    :param X: points, (n, d)
+    :param k: number of clusters
+    :param init: seeding method, see init_centres
+    :param max_iter: maximum number of iterations, or of mini-batches
+    :param tol: convergence threshold on the largest squared shift of a centre coordinate
+    :param batch_size: number of points per mini-batch, all points (Lloyd) if None.
+                       a centre moves towards the mean of its batch points with a step
+                       of their share of all the points it has been assigned so far
+    :param seed: random seed of the seeding and of the mini-batches
+    :param chunk_rows: number of points per chunk of the distance computation
+    :return: centres (k, d) float32, number of iterations
+    """
+    rng = np.random.default_rng(seed)
+    centres = init_centres(X, k, init, seed)
+    seen = np.zeros(k)
+
+    for n_iter in range(1, max_iter + 1):
+        if batch_size is None:
+            batch = X
+        else:
+            batch = X[np.sort(rng.integers(X.shape[0], size=batch_size))]
+        sums, counts = _cluster_sums(batch, assign(batch, centres, chunk_rows), k)
+
+        # clusters without points keep their centre
+        new_centres = centres.copy()
+        has_points = counts > 0
+        if batch_size is None:
+            new_centres[has_points] = sums[has_points] / counts[has_points, None]
+        else:
+            seen += counts
+            rate = counts[has_points] / seen[has_points]
+            means = sums[has_points] / counts[has_points, None]
+            new_centres[has_points] += rate[:, None] * (means - centres[has_points])
+
+        shift = np.max((new_centres - centres) ** 2)
+        centres = new_centres
+        if shift < tol:
+            break
+
+    return centres, n_iter
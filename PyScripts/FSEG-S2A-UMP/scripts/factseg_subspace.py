@@ -0,0 +1,125 @@
+"""
+
+Leading eigenvectors of the feature Gram matrix for the subspace projection of Fseg
+
+The features Y are (pixels, dims) with few dims and many pixels. Their Gram matrix
+Y.T @ Y is accumulated over pixel chunks in float64, and the truncated solvers only
+access Y through chunked products, so Y is never copied as a whole.
+
+"""
+import numpy as np
+from numpy import linalg as LA
+
+SUBSPACE_METHODS = ("eig", "eigh", "lanczos", "randomized")
+CHUNK_ROWS = 65536
+
+
+def gram(Y, chunk_rows=CHUNK_ROWS):
+    """
+    Compute Y.T @ Y streaming over chunks of pixels
+    :param Y: features, (pixels, dims)
+    :param chunk_rows: number of pixels per chunk
+    :return: Gram matrix, (dims, dims) float64
+    """
+    S = np.zeros((Y.shape[1], Y.shape[1]))
+    for start in range(0, Y.shape[0], chunk_rows):
+        Yc = np.float64(Y[start:start + chunk_rows])
+        S += np.dot(Yc.T, Yc)
+    return S
+
+
+def gram_dot(Y, X, chunk_rows=CHUNK_ROWS):
+    """
+    Compute (Y.T @ Y) @ X streaming over chunks of pixels, without the Gram matrix
+    :param Y: features, (pixels, dims)
+    :param X: vectors, (dims,) or (dims, n)
+    :param chunk_rows: number of pixels per chunk
+    :return: product, shaped as X
+    """
+    out = np.zeros(X.shape)
+    for start in range(0, Y.shape[0], chunk_rows):
+        Yc = Y[start:start + chunk_rows]
+        out += np.dot(Yc.T, np.dot(Yc, X))
+    return out
+
+
+def project(Y, U, chunk_rows=CHUNK_ROWS):
+    """
+    Compute Y @ U in float64 streaming over chunks of pixels, without a float64 copy of Y
+    :param Y: features, (pixels, dims)
+    :param U: vectors, (dims, k)
+    :param chunk_rows: number of pixels per chunk
+    :return: projected features, (pixels, k) float64
+    """
+    out = np.empty((Y.shape[0], U.shape[1]))
+    for start in range(0, Y.shape[0], chunk_rows):
+        out[start:start + chunk_rows] = np.dot(np.float64(Y[start:start + chunk_rows]), U)
+    return out
+
+
+def spectrum(S):
+    """
+    Eigenvalues of a Gram matrix in ascending order, as used to estimate the segment number
+    :param S: Gram matrix, (dims, dims)
+    :return: absolute eigenvalues, ascending
+    """
+    return np.sort(np.abs(LA.eigvalsh(S)))
+
+
+def leading_eigenpairs(Y, k, method="eigh", S=None, chunk_rows=CHUNK_ROWS,
+                       n_oversamples=10, n_iter=7, seed=0):
+    """
+    Compute the k leading eigenpairs of Y.T @ Y
+    :param Y: features, (pixels, dims)
+    :param k: number of eigenpairs
+    :param method: 'eig' (dense general solver), 'eigh' (dense symmetric solver),
+                   'lanczos' (truncated, scipy eigsh) or 'randomized' (randomized
+                   subspace iteration)
+    :param S: optional precomputed Gram matrix. the truncated solvers use it instead
+              of passing over Y when given, the dense ones compute it if missing.
+              without it, every product of the truncated solvers is a pass over Y,
+              which only pays off when dims is too large for a dense Gram matrix
+    :param chunk_rows: number of pixels per chunk of the streaming products
+    :param n_oversamples: extra random vectors of the randomized solver
+    :param n_iter: power iterations of the randomized solver
+    :param seed: random seed of the randomized solver
+    :return: eigenvalues in descending order (k,), eigenvectors (dims, k)
+    """
+    assert method in SUBSPACE_METHODS, "Undefined subspace method."
+    dims = Y.shape[1]
+    assert 0 < k <= dims, "Number of eigenpairs must be between 1 and %d!" % dims
+
+    if S is not None:
+        dot = lambda X: np.dot(S, X)
+    else:
+        dot = lambda X: gram_dot(Y, X, chunk_rows)
+
+    # the truncated solvers need k < dims, and gain nothing over dense solvers then
+    if method in ("lanczos", "randomized") and k >= dims - 1:
+        method = "eigh"
+
+    if method in ("eig", "eigh"):
+        S = gram(Y, chunk_rows) if S is None else S
+        if method == "eig":
+            d, v = LA.eig(S)
+            d, v = np.real(d), np.real(v)
+        else:
+            d, v = LA.eigh(S)
+        idx = np.argsort(d)[::-1][:k]
+        return d[idx], v[:, idx]
+
+    if method == "lanczos":
+        from scipy.sparse.linalg import LinearOperator, eigsh
+        op = LinearOperator((dims, dims), matvec=dot, matmat=dot, dtype=np.float64)
+        d, v = eigsh(op, k=k, which="LA")
+    else:
+        # randomized range finder with power iterations, then Rayleigh-Ritz
+        rng = np.random.default_rng(seed)
+        Q, _ = LA.qr(dot(rng.standard_normal((dims, min(k + n_oversamples, dims)))))
+        for _ in range(n_iter):
+            Q, _ = LA.qr(dot(Q))
+        d, W = LA.eigh(np.dot(Q.T, dot(Q)))
+        v = np.dot(Q, W)
+
+    idx = np.argsort(d)[::-1][:k]
+    return d[idx], v[:, idx]
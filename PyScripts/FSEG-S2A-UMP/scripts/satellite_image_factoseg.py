@@ -2,90 +2,78 @@
 
 Factorization based segmentation
 
+The features are projected and factorised in float64, as the original Fseg, so the
+labels do not depend on the type of the histograms. A float32 factorisation halves
+its memory but is opt-in (nmf_dtype), as it may change the labels of pixels whose
+weights nearly tie.
+
 """
 # Import required packages
 import time
 import numpy as np
-from numpy import linalg as LA
 from scipy import linalg as LAsci
 import math
 from skimage import io, color
 
 # Import customized modules
 from factseg_filters import image_filtering
+from factseg_histogram import quantize_bands, local_histograms, window_area
+from factseg_subspace import gram, project, spectrum, leading_eigenpairs
+from factseg_cluster import kmeans
+from factseg_nmf import nmf
 
 
-def SHcomp(Ig, ws, BinN=11):
+def SHcomp(Ig, ws, BinN=11, dtype=np.float32, strip_rows=256):
     """
-    Compute local spectral histogram using integral histograms
+    Compute local spectral histogram using separable running box sums
     :param Ig: a n-band image
     :param ws: half window size
     :param BinN: number of bins of histograms
+    :param dtype: accumulator of the histogram counts, np.float32 or np.uint16
+    :param strip_rows: number of rows computed at a time, bounds the temporary memory
     :return: local spectral histogram at each pixel
     """
     h, w, bn = Ig.shape
 
     # quantize values at each pixel into bin ID
-    for i in range(bn):
-        b_max = np.max(Ig[:, :, i])
-        b_min = np.min(Ig[:, :, i])
-        assert b_max != b_min, "Band %d has only one value!" % i
-
-        b_interval = (b_max - b_min) * 1. / BinN
-        Ig[:, :, i] = np.floor((Ig[:, :, i] - b_min) / b_interval)
-
-    Ig[Ig >= BinN] = BinN-1
-    Ig = np.int32(Ig)
-
-    # convert to one hot encoding
-    one_hot_pix = []
-    for i in range(bn):
-        one_hot_pix_b = np.zeros((h*w, BinN), dtype=np.int32)
-        one_hot_pix_b[np.arange(h*w), Ig[:, :, i].flatten()] = 1
-        one_hot_pix.append(one_hot_pix_b.reshape((h, w, BinN)))
-
-    # compute integral histogram
-    integral_hist = np.concatenate(one_hot_pix, axis=2)
-
-    np.cumsum(integral_hist, axis=1, out=integral_hist, dtype=np.float32)
-    np.cumsum(integral_hist, axis=0, out=integral_hist, dtype=np.float32)
-
-    # compute spectral histogram based on integral histogram
-    padding_l = np.zeros((h, ws + 1, BinN * bn), dtype=np.int32)
-    padding_r = np.tile(integral_hist[:, -1:, :], (1, ws, 1))
-
-    integral_hist_pad_tmp = np.concatenate([padding_l, integral_hist, padding_r], axis=1)
-
-    padding_t = np.zeros((ws + 1, integral_hist_pad_tmp.shape[1], BinN * bn), dtype=np.int32)
-    padding_b = np.tile(integral_hist_pad_tmp[-1:, :, :], (ws, 1, 1))
-
-    integral_hist_pad = np.concatenate([padding_t, integral_hist_pad_tmp, padding_b], axis=0)
-
-    integral_hist_1 = integral_hist_pad[ws + 1 + ws:, ws + 1 + ws:, :]
-    integral_hist_2 = integral_hist_pad[:-ws - ws - 1, :-ws - ws - 1, :]
-    integral_hist_3 = integral_hist_pad[ws + 1 + ws:, :-ws - ws -1, :]
-    integral_hist_4 = integral_hist_pad[:-ws - ws - 1, ws + 1 + ws:, :]
+    bins = quantize_bands(Ig, BinN)
 
-    sh_mtx = integral_hist_1 + integral_hist_2 - integral_hist_3 - integral_hist_4
-
-    histsum = np.sum(sh_mtx, axis=-1, keepdims=True) * 1. / bn
-
-    sh_mtx = np.float32(sh_mtx) / np.float32(histsum)
+    # compute local histograms and normalise each band by the window size
+    sh_mtx = local_histograms(bins, ws, BinN, dtype, strip_rows, out=np.empty((h, w, BinN * bn), dtype=np.float32))
+    sh_mtx /= window_area(h, w, ws)[:, :, None]
 
     return sh_mtx
 
 
-def SHedgeness(sh_mtx, ws):
+def SHedgeness(sh_mtx, ws, chunk_rows=None):
+    """
+    Compute the edgeness of the local spectral histograms from the differences
+    between the features ws pixels above and below, and left and right of each pixel
+    :param sh_mtx: features at each pixel, (h, w, d)
+    :param ws: half window size
+    :param chunk_rows: number of output rows computed at a time, all rows if None.
+                       bounds the temporary arrays to about chunk_rows x w x d values
+    :return: edge map, -1 at the borders where the edgeness is not defined
+    """
     h, w, _ = sh_mtx.shape
     edge_map = np.ones((h, w)) * -1
-    for i in range(ws, h-ws-1):
-        for j in range(ws, w-ws-1):
-            edge_map[i, j] = np.sqrt(np.sum((sh_mtx[i - ws, j, :] - sh_mtx[i + ws, j, :])**2)
-                                     + np.sum((sh_mtx[i, j - ws, :] - sh_mtx[i, j + ws, :])**2))
+    if h - 2 * ws - 1 <= 0 or w - 2 * ws - 1 <= 0:
+        return edge_map
+
+    chunk_rows = chunk_rows or h
+    cols = slice(ws, w - ws - 1)
+    for start in range(ws, h - ws - 1, chunk_rows):
+        stop = min(start + chunk_rows, h - ws - 1)
+        # pixels ws rows above and below
+        diff_v = sh_mtx[start - ws:stop - ws, cols, :] - sh_mtx[start + ws:stop + ws, cols, :]
+        # pixels ws columns left and right
+        diff_h = sh_mtx[start:stop, :w - 2 * ws - 1, :] - sh_mtx[start:stop, 2 * ws:w - 1, :]
+        edge_map[start:stop, cols] = np.sqrt(np.sum(diff_v ** 2, axis=-1) + np.sum(diff_h ** 2, axis=-1))
     return edge_map
 
 
-def Fseg(Ig, ws, segn, omega, nonneg_constraint=True):
+def Fseg(Ig, ws, segn, omega, nonneg_constraint=True, subspace="eigh", cluster_init="farthest",
+         batch_size=None, max_iter=300, nmf_method="als", nmf_rtol=None, nmf_dtype=np.float64, verbose=False):
     """
     Factorization based segmentation
     :param Ig: a n-band image
@@ -93,25 +81,31 @@ def Fseg(Ig, ws, segn, omega, nonneg_constraint=True):
     :param segn: number of segment. if set to 0, the number will be automatically estimated
     :param omega: error threshod for estimating segment number. need to adjust for different filter bank.
     :param nonneg_constraint: whether apply negative matrix factorization
+    :param subspace: solver of the leading eigenvectors, see factseg_subspace.SUBSPACE_METHODS
+    :param cluster_init: seeding of the representative features, see factseg_cluster.CLUSTER_INITS
+    :param batch_size: pixels per mini-batch of the clustering, all pixels if None
+    :param max_iter: maximum number of clustering iterations
+    :param nmf_method: update of the non-negative factorization, see factseg_nmf.NMF_METHODS
+    :param nmf_rtol: relative tolerance on the residual change of the non-negative factorization.
+                     None stops on an absolute change of .1, as the original Fseg
+    :param nmf_dtype: np.float64, or np.float32 for a lower memory non-negative factorization
+    :param verbose: whether to print the residual at each iteration of the non-negative factorization
     :return: segmentation label map
     """
 
     N1, N2, bn = Ig.shape
 
-    ws = ws / 2
+    ws = ws // 2
     sh_mtx = SHcomp(Ig, ws)
     sh_dim = sh_mtx.shape[2]
 
     Y = (sh_mtx.reshape((N1 * N2, sh_dim)))
-    S = np.dot(Y.T, Y)
-    d, v = LA.eig(S)
+    # Gram matrix accumulated over pixel chunks, the solvers only work on this (dims x dims) matrix
+    S = gram(Y)
 
-    d_sorted = np.sort(d)
-    idx = np.argsort(d)
-    k = np.abs(d_sorted)
-    
     print("\nEstimating the segment number ...")
     if segn == 0:  # estimate the segment number
+        k = spectrum(S)
         print("\nCalculate the least squared error (LSE) ratio:")
         lse_ratio = np.cumsum(k) * 1. / (N1 * N2)
         print(lse_ratio)
@@ -126,9 +120,9 @@ def Fseg(Ig, ws, segn, omega, nonneg_constraint=True):
 
     dimn = segn
 
-    U1 = v[:, idx[-1:-dimn-1:-1]]
+    _, U1 = leading_eigenpairs(Y, dimn, method=subspace, S=S)
 
-    Y1 = np.dot(Y, U1)  # project features onto the subspace
+    Y1 = project(Y, U1)  # project features onto the subspace, without a float64 copy of Y
 
     edge_map = SHedgeness(Y1.reshape((N1, N2, dimn)), ws)
 
@@ -137,38 +131,7 @@ def Fseg(Ig, ws, segn, omega, nonneg_constraint=True):
     Y_woedge = Y1[(edge_map_flatten >= 0) & (edge_map_flatten <= np.max(edge_map)*0.4), :]
 
     # find representative features using clustering
-    cls_cen = np.zeros((segn, dimn), dtype=np.float32)
-    L = np.sum(Y_woedge ** 2, axis=1)
-    cls_cen[0, :] = Y_woedge[np.argmax(L), :]  # find the first initial center
-
-    D = np.sum((cls_cen[0, :] - Y_woedge) ** 2, axis=1)
-    cls_cen[1, :] = Y_woedge[np.argmax(D), :]
-
-    cen_id = 1
-    while cen_id < segn-1:
-        cen_id += 1
-        D_tmp = np.zeros((cen_id, Y_woedge.shape[0]), dtype=np.float32)
-        for i in range(cen_id):
-            D_tmp[i, :] = np.sum((cls_cen[i, :] - Y_woedge) ** 2, axis=1)
-        D = np.min(D_tmp, axis=0)
-        cls_cen[cen_id, :] = Y_woedge[np.argmax(D), :]
-
-    D_cen2all = np.zeros((segn, Y_woedge.shape[0]), dtype=np.float32)
-    cls_cen_new = np.zeros((segn, dimn), dtype=np.float32)
-    is_converging = 1
-    while is_converging:
-        for i in range(segn):
-            D_cen2all[i, :] = np.sum((cls_cen[i, :] - Y_woedge) ** 2, axis=1)
-
-        cls_id = np.argmin(D_cen2all, axis=0)
-
-        for i in range(segn):
-            cls_cen_new[i, :] = np.mean(Y_woedge[cls_id == i, :], axis=0)
-
-        if np.max((cls_cen_new - cls_cen)**2) < .00001:
-            is_converging = 0
-        else:
-            cls_cen = cls_cen_new * 1.
+    cls_cen_new, _ = kmeans(Y_woedge, segn, init=cluster_init, max_iter=max_iter, batch_size=batch_size)
     cls_cen_new = cls_cen_new.T
 
     ZZTinv = LAsci.inv(np.dot(cls_cen_new.T, cls_cen_new))
@@ -178,31 +141,14 @@ def Fseg(Ig, ws, segn, omega, nonneg_constraint=True):
 
     if nonneg_constraint:
         w0 = np.dot(U1, cls_cen_new)
-        dnorm0 = 1
-
-        h = Beta * 1.
-        for i in range(100):
-            tmp, _, _, _ = LA.lstsq(np.dot(w0.T, w0) + np.eye(segn) * .01, np.dot(w0.T, Y.T), rcond=None)
-            h = np.maximum(0, tmp)
-            tmp, _, _, _ = LA.lstsq(np.dot(h, h.T) + np.eye(segn) * .01, np.dot(h, Y), rcond=None)
-            w = np.maximum(0, tmp)
-            w = w.T * 1.
-
-            d = Y.T - np.dot(w, h)
-            dnorm = np.sqrt(np.mean(d * d))
-            print(i, np.abs(dnorm - dnorm0), dnorm)
-            if np.abs(dnorm - dnorm0) < .1:
-                break
-
-            w0 = w * 1.
-            dnorm0 = dnorm * 1.
-
+        _, h, _ = nmf(Y.T, w0, method=nmf_method, max_iter=100, rtol=nmf_rtol, dnorm0=1.,
+                   dtype=nmf_dtype, verbose=verbose)
         seg_label = np.argmax(h, axis=0)
 
     return seg_label.reshape((N1, N2))
 
 
-def FacSeg_S2A(input_path, filter_bank, output_path=None, ws=25, segn=0, omega=.045, nonneg_constraint=True):
+def FacSeg_S2A(input_path, filter_bank, output_path=None, ws=25, segn=0, omega=.045, nonneg_constraint=True, subspace='eigh'):
     # Read the image data
     import rasterio as rio
     with rio.open(input_path) as sat_image:
@@ -223,7 +169,7 @@ def FacSeg_S2A(input_path, filter_bank, output_path=None, ws=25, segn=0, omega=.
     Ig = np.concatenate((np.float32(image_data), grey_image, np.float32(filter_out)), axis=2)
     
     # Try different window size, with and without nonneg constraints
-    segmented_image = Fseg(Ig, ws, segn, omega, nonneg_constraint)
+    segmented_image = Fseg(Ig, ws, segn, omega, nonneg_constraint, subspace)
     
     # Include original image
     out_shape = (1, bands.shape[1], bands.shape[2])
@@ -242,7 +188,7 @@ def FacSeg_S2A(input_path, filter_bank, output_path=None, ws=25, segn=0, omega=.
     
     return merged_bands
 
-def FacSeg_S2A_fbands(input_path, filter_bank, output_path=None, ws=25, segn=0, omega=.045, nonneg_constraint=True):
+def FacSeg_S2A_fbands(input_path, filter_bank, output_path=None, ws=25, segn=0, omega=.045, nonneg_constraint=True, subspace='eigh'):
     # Read the image data
     import rasterio as rio
     with rio.open(input_path) as sat_image:
@@ -269,7 +215,7 @@ def FacSeg_S2A_fbands(input_path, filter_bank, output_path=None, ws=25, segn=0,
                          np.float32(filter_blue), np.float32(filter_nir)), axis=2)
     
     # Try different window size, with and without nonneg constraints
-    segmented_image = Fseg(Ig, ws, segn, omega, nonneg_constraint)
+    segmented_image = Fseg(Ig, ws, segn, omega, nonneg_constraint, subspace)
     
     # Include original image
     out_shape = (1, bands.shape[1], bands.shape[2])
@@ -288,7 +234,7 @@ def FacSeg_S2A_fbands(input_path, filter_bank, output_path=None, ws=25, segn=0,
     
     return merged_bands
 
-def FacSeg_main(image_path, filter_bank, ws, segn=0, omega=.045, nonneg_constraint=True):
+def FacSeg_main(image_path, filter_bank, ws, segn=0, omega=.045, nonneg_constraint=True, subspace='eigh'):
     # Read the image data
     image_data = io.imread(image_path)
     if len(image_data.shape) > 2:
@@ -300,7 +246,7 @@ def FacSeg_main(image_path, filter_bank, ws, segn=0, omega=.045, nonneg_constrai
     Ig = np.concatenate((np.float32(image_data.reshape((image_data.shape[0], image_data.shape[1], 1))), filter_out), axis=2)
     
     # Try different window size, with and without nonneg constraints
-    segmented_image = Fseg(Ig, ws, segn, omega, nonneg_constraint)
+    segmented_image = Fseg(Ig, ws, segn, omega, nonneg_constraint, subspace)
     
     out_shape = (1, image_data.shape[0], image_data.shape[1])
     final_image = np.concatenate((image_data.reshape(out_shape), segmented_image.reshape(out_shape)), axis=0)
@@ -5,6 +5,7 @@ Factorization based segmentation with manually selected seeds
 import time
 import numpy as np
 from fact_based_seg_filters import image_filtering
+from fact_based_seg_histogram import quantize_bands, local_histograms
 import matplotlib.pyplot as plt
 from scipy import linalg as LAsci
 from skimage import io, transform
@@ -23,56 +24,24 @@ def resize_image(image, target_size=(1024, 1024)):
     resized = transform.resize(image, target_size + (image.shape[2],), anti_aliasing=True, preserve_range=True)
     return resized.astype(np.float32)
 
-def SHcomp(Ig, ws, BinN=11):
+def SHcomp(Ig, ws, BinN=11, dtype=np.float32, strip_rows=256):
     """
-    Compute local spectral histogram using integral histograms
+    Compute local spectral histogram using separable running box sums
     :param Ig: a n-band image
     :param ws: half window size
     :param BinN: number of bins of histograms
+    :param dtype: accumulator of the histogram counts, np.float32 or np.uint16
+    :param strip_rows: number of rows computed at a time, bounds the temporary memory
     :return: local spectral histogram at each pixel
     """
     h, w, bn = Ig.shape
 
     # quantize values at each pixel into bin ID
-    for i in range(bn):
-        b_max = np.max(Ig[:, :, i])
-        b_min = np.min(Ig[:, :, i])
-        assert b_max != b_min, f"Band {i} has only one value!"
-
-        b_interval = (b_max - b_min) * 1. / BinN
-        Ig[:, :, i] = np.floor((Ig[:, :, i] - b_min) / b_interval)
-
-    Ig[Ig >= BinN] = BinN - 1
-    Ig = np.int32(Ig)
-
-    # convert to one hot encoding
-    one_hot_pix = []
-    for i in range(bn):
-        one_hot_pix_b = np.zeros((h * w, BinN), dtype=np.int32)
-        one_hot_pix_b[np.arange(h * w), Ig[:, :, i].flatten()] = 1
-        one_hot_pix.append(one_hot_pix_b.reshape((h, w, BinN)))
-
-    # compute integral histogram
-    integral_hist = np.concatenate(one_hot_pix, axis=2)
-    np.cumsum(integral_hist, axis=1, out=integral_hist)
-    np.cumsum(integral_hist, axis=0, out=integral_hist)
-
-    # compute spectral histogram based on integral histogram
-    padding_l = np.zeros((h, ws + 1, BinN * bn), dtype=np.int32)
-    padding_r = np.tile(integral_hist[:, -1:, :], (1, ws, 1))
-    integral_hist_pad_tmp = np.concatenate([padding_l, integral_hist, padding_r], axis=1)
-    padding_t = np.zeros((ws + 1, integral_hist_pad_tmp.shape[1], BinN * bn), dtype=np.int32)
-    padding_b = np.tile(integral_hist_pad_tmp[-1:, :, :], (ws, 1, 1))
-    integral_hist_pad = np.concatenate([padding_t, integral_hist_pad_tmp, padding_b], axis=0)
-
-    integral_hist_1 = integral_hist_pad[ws + 1 + ws:, ws + 1 + ws:, :]
-    integral_hist_2 = integral_hist_pad[:-ws - 1 - ws, :-ws - 1 - ws, :]
-    integral_hist_3 = integral_hist_pad[ws + 1 + ws:, :-ws - 1 - ws, :]
-    integral_hist_4 = integral_hist_pad[:-ws - 1 - ws, ws + 1 + ws:, :]
-
-    histsum = integral_hist_1 + integral_hist_2 - integral_hist_3 - integral_hist_4
-    sh_mtx = np.float32(histsum)
-    sh_mtx = np.float32(sh_mtx) / np.float32(histsum)
+    bins = quantize_bands(Ig, BinN)
+
+    # compute local histograms
+    histsum = local_histograms(bins, ws, BinN, dtype, strip_rows, out=np.empty((h, w, BinN * bn), dtype=np.float32))
+    sh_mtx = histsum / histsum
 
     return sh_mtx
 
@@ -1,65 +1,45 @@
 """
 Factorization based segmentation
+
+The features are factorised in float64, as the original Fseg. A float32 factorisation
+halves its memory but is opt-in (nmf_dtype), as it may change the labels of pixels
+whose weights nearly tie.
 """
 import os
 import time
 import numpy as np
-from numpy import linalg as LA
 from fact_based_seg_filters import image_filtering
+from fact_based_seg_histogram import quantize_bands, local_histograms
+from fact_based_seg_subspace import gram, spectrum
+from fact_based_seg_nmf import nmf
 import matplotlib.pyplot as plt
 from scipy import linalg as LAsci
 import math
 from skimage import io, color
 
-def SHcomp(Ig, ws, BinN=11):
+def SHcomp(Ig, ws, BinN=11, dtype=np.float32, strip_rows=256):
     """
-    Compute local spectral histogram using integral histograms
+    Compute local spectral histogram using separable running box sums
     :param Ig: a n-band image
     :param ws: half window size
     :param BinN: number of bins of histograms
+    :param dtype: accumulator of the histogram counts, np.float32 or np.uint16
+    :param strip_rows: number of rows computed at a time, bounds the temporary memory
     :return: local spectral histogram at each pixel
     """
     h, w, bn = Ig.shape
 
     # quantize values at each pixel into bin ID
-    for i in range(bn):
-        b_max = np.max(Ig[:, :, i])
-        b_min = np.min(Ig[:, :, i])
-        assert b_max != b_min, "Band %d has only one value!" % i
-
-        b_interval = (b_max - b_min) * 1. / BinN
-        Ig[:, :, i] = np.floor((Ig[:, :, i] - b_min) / b_interval)
-
-    Ig[Ig >= BinN] = BinN - 1
-    Ig = np.int32(Ig)
-
-    # convert to one hot encoding
-    one_hot_pix = []
-    for i in range(bn):
-        one_hot_pix_b = np.zeros((h * w, BinN), dtype=np.int32)
-        one_hot_pix_b[np.arange(h * w), Ig[:, :, i].flatten()] = 1
-        one_hot_pix.append(one_hot_pix_b.reshape((h, w, BinN)))
-
-    # compute integral histogram
-    integral_hist = np.concatenate(one_hot_pix, axis=2)
-    np.cumsum(integral_hist, axis=1, out=integral_hist, dtype=np.float32)
-    np.cumsum(integral_hist, axis=0, out=integral_hist, dtype=np.float32)
-
-    # compute spectral histogram based on integral histogram
-    padding_l = np.zeros((h, ws + 1, BinN * bn), dtype=np.int32)
-    padding_r = np.tile(integral_hist[:, -1:, :], (1, ws, 1))
-    integral_hist_pad_tmp = np.concatenate([padding_l, integral_hist, padding_r], axis=1)
-    padding_t = np.zeros((ws + 1, integral_hist_pad_tmp.shape[1], BinN * bn), dtype=np.int32)
-    padding_b = np.tile(integral_hist_pad_tmp[-1:, :, :], (ws, 1, 1))
-    integral_hist_pad = np.concatenate([padding_t, integral_hist_pad_tmp, padding_b], axis=0)
-
-    hi = (integral_hist_pad[2 * ws + 1:, 2 * ws + 1:, :] + integral_hist_pad[:-2 * ws - 1, :-2 * ws - 1, :] -
-          integral_hist_pad[2 * ws + 1:, :-2 * ws - 1, :] - integral_hist_pad[:-2 * ws - 1, 2 * ws + 1:, :])
-    hi = hi / ((2. * ws + 1) ** 2)
+    bins = quantize_bands(Ig, BinN)
+
+    # compute local histograms normalised by the full window size
+    hi = local_histograms(bins, ws, BinN, dtype, strip_rows, out=np.empty((h, w, BinN * bn)))
+    hi /= (2. * ws + 1) ** 2
 
     return hi
 
-def Fseg(Ig, ws, segn=0, omega=0.045, nonneg_constraint=True):
+def Fseg(Ig, ws, segn=0, omega=0.045, nonneg_constraint=True, nmf_method="als", nmf_rtol=None,
+         nmf_dtype=np.float64, verbose=False):
     """
     Factorization based segmentation
     :param Ig: a n-band image
@@ -67,36 +47,28 @@ def Fseg(Ig, ws, segn=0, omega=0.045, nonneg_constraint=True):
     :param segn: number of segments
     :param omega: regularization parameter
     :param nonneg_constraint: if True, apply non-negative constraints
+    :param nmf_method: update of the non-negative factorization, see fact_based_seg_nmf.NMF_METHODS
+    :param nmf_rtol: relative tolerance on the residual change of the non-negative factorization.
+                     None stops on an absolute change of .1, as the original Fseg
+    :param nmf_dtype: np.float64, or np.float32 for a lower memory non-negative factorization
+    :param verbose: whether to print the residual at each iteration of the non-negative factorization
     :return: segmentation result
     """
     N1, N2, Bn = Ig.shape
     Y = SHcomp(Ig, ws).reshape((N1 * N2, Bn * 11)).T
 
     if segn == 0:
-        U, S, V = LA.svd(Y, full_matrices=False)
+        # singular values of Y from the eigenvalues of its Gram matrix, accumulated over
+        # pixel chunks instead of a full SVD of the (features x pixels) matrix
+        S = np.sqrt(spectrum(gram(Y.T))[::-1])
         d = np.cumsum(S) / np.sum(S)
         segn = np.where(d >= (1 - omega))[0][0] + 1
 
     if nonneg_constraint:
         np.random.seed(0)
         w0 = np.random.rand(Y.shape[0], segn)
-        dnorm0 = 0
-
-        for i in range(1000):
-            tmp, _, _, _ = LA.lstsq(np.dot(w0.T, w0) + np.eye(segn) * .01, np.dot(w0.T, Y), rcond=None)
-            h = np.maximum(0, tmp)
-            tmp, _, _, _ = LA.lstsq(np.dot(h, h.T) + np.eye(segn) * .01, np.dot(h, Y.T), rcond=None)
-            w = np.maximum(0, tmp)
-            w = w.T * 1.
-
-            d = Y - np.dot(w, h)
-            dnorm = np.sqrt(np.mean(d * d))
-            print(i, np.abs(dnorm - dnorm0), dnorm)
-            if np.abs(dnorm - dnorm0) < .1:
-                break
-
-            w0 = w * 1.
-            dnorm0 = dnorm * 1.
+        _, h, _ = nmf(Y, w0, method=nmf_method, max_iter=1000, rtol=nmf_rtol, dnorm0=0.,
+                       dtype=nmf_dtype, verbose=verbose)
 
         seg_label = np.argmax(h, axis=0)
 
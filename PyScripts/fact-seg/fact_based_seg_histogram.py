@@ -0,0 +1,125 @@
+"""
+
+Local spectral histograms with separable running box sums
+
+The histogram counts of the window around each pixel are computed strip by strip:
+the one-hot bins of each band are summed along the rows with a running (cumulative)
+sum, then along the columns. Neither the full one-hot tensor nor padded copies of the
+integral histogram are built, so the memory used besides the output is bounded by
+the strip size. Windows are clipped at the image borders, as in SHcomp.
+
+"""
+import numpy as np
+
+
+def quantize_bands(Ig, BinN=11):
+    """
+    Quantize the values of each band into BinN equal bins, in place as SHcomp did
+    :param Ig: a n-band image, (h, w, bn). overwritten with the bin IDs
+    :param BinN: number of bins of histograms
+    :return: bin ID of each pixel and band, (h, w, bn)
+    """
+    bn = Ig.shape[2]
+    for i in range(bn):
+        b_max = np.max(Ig[:, :, i])
+        b_min = np.min(Ig[:, :, i])
+        assert b_max != b_min, "Band %d has only one value!" % i
+
+        b_interval = (b_max - b_min) * 1. / BinN
+        Ig[:, :, i] = np.floor((Ig[:, :, i] - b_min) / b_interval)
+
+    Ig[Ig >= BinN] = BinN - 1
+    return np.asarray(Ig, dtype=np.uint8 if BinN <= 256 else np.int32)
+
+
+def _window_bounds(n, ws):
+    """
+    First and last+1 positions of the clipped windows of half size ws along an axis
+    """
+    pos = np.arange(n)
+    return np.maximum(pos - ws, 0), np.minimum(pos + ws, n - 1) + 1
+
+
+def window_area(h, w, ws, rows=None):
+    """
+    Number of pixels in the clipped window around each pixel
+    :param h: image height
+    :param w: image width
+    :param ws: half window size
+    :param rows: (start, stop) of the rows to return, all rows if None
+    :return: window areas, (stop - start, w) float32
+    """
+    r0, r1 = rows or (0, h)
+    lo, hi = _window_bounds(h, ws)
+    n_rows = (hi - lo)[r0:r1]
+    lo, hi = _window_bounds(w, ws)
+    n_cols = hi - lo
+    return np.float32(np.outer(n_rows, n_cols))
+
+
+def iter_local_histograms(bins, ws, BinN=11, dtype=np.float32, strip_rows=256):
+    """
+    Compute the local histogram counts strip by strip
+    :param bins: bin ID of each pixel and band, (h, w, bn), see quantize_bands
+    :param ws: half window size
+    :param BinN: number of bins of histograms
+    :param dtype: accumulator, np.float32 or np.uint16. uint16 sums wrap around but
+                  their differences are exact as long as a window has less than
+                  65536 pixels
+    :param strip_rows: number of output rows per strip, all rows if None
+    :return: generator of (start row, stop row, counts of shape (rows, w, BinN * bn))
+    """
+    assert dtype in (np.float32, np.uint16), "Undefined accumulator type."
+    h, w, bn = bins.shape
+    ws = int(ws)
+    strip_rows = strip_rows or h
+    if dtype == np.uint16:
+        assert (2 * ws + 1) ** 2 < 2 ** 16, "Window too large for uint16 counts!"
+    else:
+        # running sums are exact integers up to 2 ** 24 in float32
+        assert (w + 1) * (2 * ws + 1) < 2 ** 24, "Image too wide for float32 counts!"
+        assert (strip_rows + 2 * ws) * (2 * ws + 1) < 2 ** 24, "Strips too large for float32 counts!"
+
+    col_lo, col_hi = _window_bounds(w, ws)
+    row_lo, row_hi = _window_bounds(h, ws)
+    bin_ids = np.arange(BinN, dtype=bins.dtype)
+
+    for r0 in range(0, h, strip_rows):
+        r1 = min(r0 + strip_rows, h)
+        # input rows covered by the windows of the strip
+        a, b = row_lo[r0], row_hi[r1 - 1]
+        lo = row_lo[r0:r1] - a
+        hi = row_hi[r0:r1] - a
+
+        counts = np.empty((r1 - r0, w, BinN * bn), dtype=dtype)
+        for i in range(bn):
+            # running sums along the rows, with a leading zero column
+            csum = np.zeros((b - a, w + 1, BinN), dtype=dtype)
+            np.cumsum(bins[a:b, :, i, None] == bin_ids, axis=1, dtype=dtype, out=csum[:, 1:])
+            hsum = csum[:, col_hi] - csum[:, col_lo]
+
+            # running sums along the columns, with a leading zero row
+            csum = np.zeros((b - a + 1, w, BinN), dtype=dtype)
+            np.cumsum(hsum, axis=0, dtype=dtype, out=csum[1:])
+            counts[:, :, i * BinN:(i + 1) * BinN] = csum[hi] - csum[lo]
+
+        yield r0, r1, counts
+
+
+def local_histograms(bins, ws, BinN=11, dtype=np.float32, strip_rows=256, out=None):
+    """
+    Compute the local histogram counts of the window around each pixel
+    :param bins: bin ID of each pixel and band, (h, w, bn), see quantize_bands
+    :param ws: half window size
+    :param BinN: number of bins of histograms
+    :param dtype: accumulator, np.float32 or np.uint16
+    :param strip_rows: number of rows per strip, all rows if None
+    :param out: optional output array of shape (h, w, BinN * bn), e.g. float64
+    :return: histogram counts, (h, w, BinN * bn)
+    """
+    h, w, bn = bins.shape
+    if out is None:
+        out = np.empty((h, w, BinN * bn), dtype=dtype)
+    for r0, r1, counts in iter_local_histograms(bins, ws, BinN, dtype, strip_rows):
+        out[r0:r1] = counts
+    return out
@@ -0,0 +1,115 @@
+"""
+
+Non-negative matrix factorization refinement of Fseg
+
+The features X (dims, pixels) are factorized as X ~ W H, with W (dims, segn) the
+representative features and H (segn, pixels) their weights at each pixel. Each
+iteration only needs the small Gram matrices W.T W and H H.T and the products W.T X
+and X H.T, and the residual norm is computed from these cached products as
+
+    ||X - W H||^2 = ||X||^2 - 2 <W, X H.T> + <W.T W, H H.T>
+
+instead of from a materialised (dims, pixels) residual.
+
+"""
+import numpy as np
+from numpy import linalg as LA
+
+NMF_METHODS = ("als", "hals", "mu")
+EPS = 1e-10
+
+
+def _update_als(A, B, reg):
+    """
+    Regularised non-negative least squares step, max(0, (A + reg I)^-1 B)
+    """
+    return np.maximum(0, LA.solve(A + np.eye(A.shape[0], dtype=A.dtype) * reg, B))
+
+
+def _update_hals(H, A, B, reg):
+    """
+    Hierarchical ALS step, updating the rows of H one at a time for the Gram matrix A
+    and the product B
+    """
+    for j in range(H.shape[0]):
+        step = (B[j] - np.dot(A[j], H) - reg * H[j]) / (A[j, j] + reg)
+        np.maximum(H[j] + step, 0, out=H[j])
+    return H
+
+
+def _update_mu(H, A, B, reg):
+    """
+    Multiplicative update step of H for the Gram matrix A and the product B
+    """
+    H *= B / (np.dot(A, H) + reg * H + EPS)
+    return H
+
+
+def nmf(X, W0, method="als", max_iter=100, tol=.1, rtol=None, dnorm0=1., reg=.01, dtype=np.float64,
+        verbose=False):
+    """
+    Refine a factorization X ~ W H under non-negative constraints
+    :param X: features, (dims, pixels). cast to dtype once, a transposed view of that
+              dtype is used without a copy
+    :param W0: initial representative features, (dims, segn). may be negative, the
+               first iteration is a regularised ALS step for every method
+    :param method: 'als' (regularised alternating least squares, as the original
+                   Fseg), 'hals' (hierarchical ALS) or 'mu' (multiplicative updates)
+    :param max_iter: maximum number of iterations
+    :param tol: absolute tolerance on the change of the RMS residual between iterations,
+                as the original Fseg. the first iteration is compared to dnorm0
+    :param rtol: relative tolerance on the change of the RMS residual between iterations,
+                 used instead of tol if given, from the second iteration on
+    :param dnorm0: residual the first iteration is compared to with tol, 1 in the
+                   original Fseg of satseg and 0 in that of fact_based_seg
+    :param reg: ridge regularisation of W and H
+    :param dtype: np.float64, or np.float32 to halve the memory of X, H and the products.
+                  float32 may change the labels of pixels whose weights nearly tie
+    :param verbose: whether to print the residual at each iteration
+    :return: W (dims, segn), H (segn, pixels), RMS residual of each iteration
+    """
+    assert method in NMF_METHODS, "Undefined NMF method."
+    X = X.astype(dtype, copy=False)
+    W = np.asarray(W0, dtype=dtype)
+    X_sq = np.einsum('ij,ij->', X, X, dtype=np.float64)
+    size = X.shape[0] * X.shape[1]
+
+    H = None
+    dnorms = []
+    for i in range(max_iter):
+        # update H for the current W
+        WtW = np.dot(W.T, W)
+        WtX = np.dot(W.T, X)
+        if H is None or method == "als":
+            H = _update_als(WtW, WtX, reg)
+            if method == "mu":
+                np.maximum(H, EPS, out=H)
+        elif method == "hals":
+            H = _update_hals(H, WtW, WtX, reg)
+        else:
+            H = _update_mu(H, WtW, WtX, reg)
+
+        # update W for the current H
+        HHt = np.dot(H, H.T)
+        XHt = np.dot(X, H.T)
+        if i == 0 or method == "als":
+            W = _update_als(HHt, XHt.T, reg).T
+            if method == "mu":
+                np.maximum(W, EPS, out=W)
+        elif method == "hals":
+            W = _update_hals(W.T.copy(), HHt, XHt.T, reg).T
+        else:
+            W = _update_mu(W.T.copy(), HHt, XHt.T, reg).T
+
+        # residual from the cached products, in float64 against cancellation
+        res_sq = (X_sq - 2 * np.sum(np.float64(W) * XHt) + np.sum(np.dot(np.float64(W.T), W) * HHt))
+        dnorms.append(np.sqrt(max(res_sq, 0) / size))
+        if verbose:
+            print(i, dnorms[-1])
+        if rtol is None:
+            if np.abs(dnorms[-1] - (dnorms[-2] if i > 0 else dnorm0)) < tol:
+                break
+        elif i > 0 and np.abs(dnorms[-1] - dnorms[-2]) <= rtol * dnorms[-2]:
+            break
+
+    return W, H, dnorms
@@ -0,0 +1,864 @@
+"""
+Benchmarks for the geoutils raster hot paths
+
+Run the suite on synthetic data, offline and on CPU only:
+
+    python geobench.py suite --sizes 1024 2048 4096 --output results.json
+    python geobench.py micro
+"""
+
+import os
+import csv
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import geopandas as gpd
+import rasterio as rio
+from rasterio import features
+from rasterio.transform import from_origin
+from shapely.geometry import box
+from rasterio.windows import Window, transform
+
+import geoutils as gu
+
+
+def synthetic_bands(size, count=12, dtype=np.float32, seed=0):
+    """
+    Generates a random Sentinel-2 like band stack with surface reflectance values.
+
+    Args:
+        size (int) : Height and width of the stack in pixels
+        count (int) : Number of bands
+        dtype (np.dtype) : Data type of the bands
+        seed (int) : Random seed
+
+    Returns:
+        bands (np.array) : Array of shape (count, size, size)
+    """
+
+    rng = np.random.default_rng(seed)
+    return rng.uniform(0.0, 0.6, size=(count, size, size)).astype(dtype)
+
+
+def write_synthetic_image(output_file, size, count=12, seed=0, **kwargs):
+    """
+    Writes a random Sentinel-2 like band stack to a GTiff.
+
+    Args:
+        output_file (str) : The output filepath
+        size (int) : Height and width of the image in pixels
+        count (int) : Number of bands
+        seed (int) : Random seed
+        kwargs : Creation options overriding the default profile
+
+    Returns:
+        output_file (str) : The output filepath
+    """
+
+    profile = {
+        "driver": "GTiff",
+        "height": size,
+        "width": size,
+        "count": count,
+        "dtype": "float32",
+        "crs": "EPSG:32631",
+        "transform": from_origin(390000, 600000, 10, 10),
+        "compress": "deflate",
+    }
+    profile.update(kwargs)
+
+    # Integer images hold reflectance * 10000, as Sentinel-2 L2A products
+    scale = 1 if np.issubdtype(np.dtype(profile["dtype"]), np.floating) else 10000
+
+    rng = np.random.default_rng(seed)
+    with rio.open(output_file, "w", **profile) as dst:
+        # write in row strips to keep memory bounded for large sizes
+        for row in range(0, size, 512):
+            height = min(512, size - row)
+            window = Window(0, row, size, height)
+            data = rng.uniform(0.0, 0.6, size=(count, height, size)) * scale
+            dst.write(data.astype(profile["dtype"]), window=window)
+
+    return output_file
+
+
+def write_synthetic_labels(output_file, tiff_file, n_polygons, seed=0):
+    """
+    Writes random rectangular label polygons over the extent of a raster to a
+    GPKG, with a "class" column as used by the label files.
+
+    Args:
+        output_file (str) : The output filepath
+        tiff_file (str) : Path to the reference raster
+        n_polygons (int) : Number of polygons
+        seed (int) : Random seed
+
+    Returns:
+        output_file (str) : The output filepath
+    """
+
+    with rio.open(tiff_file) as src:
+        left, bottom, right, top = src.bounds
+        crs = src.crs
+        res = src.res[0]
+
+    rng = np.random.default_rng(seed)
+    x = rng.uniform(left, right, n_polygons)
+    y = rng.uniform(bottom, top, n_polygons)
+    size = rng.uniform(2, 20, (2, n_polygons)) * res
+    classes = ["Informal settlement", "Formal settlement", "Other"]
+
+    gdf = gpd.GeoDataFrame(
+        {"class": rng.choice(classes, n_polygons)},
+        geometry=[box(*b) for b in zip(x, y, x + size[0], y + size[1])],
+        crs=crs,
+    )
+    gdf.to_file(output_file, driver="GPKG")
+
+    return output_file
+
+
+class DummyModel:
+    """
+    Deterministic sklearn-like classifier, a logistic function of random
+    feature weights, standing in for the fitted models in the benchmarks.
+
+    Args:
+        seed (int) : Random seed of the weights
+    """
+
+    def __init__(self, seed=0):
+        self.seed = seed
+        self.coef_ = None
+
+    def fit(self, X, y=None):
+        rng = np.random.default_rng(self.seed)
+        self.coef_ = rng.normal(size=np.shape(X)[1])
+        return self
+
+    def predict_proba(self, X):
+        X = np.asarray(X, dtype=np.float64)
+        if self.coef_ is None:
+            self.fit(X)
+        p = 1.0 / (1.0 + np.exp(-(X @ self.coef_)))
+        return np.stack([1.0 - p, p], axis=1)
+
+
+def _timeit(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def bench_indices(size=2048, dtype=np.float32, repeat=3, seed=0):
+    """
+    Compares the per-function index path formerly used by write_indices
+    against the fused compute_indices engine.
+
+    Args:
+        size (int) : Height and width of the window in pixels
+        dtype (np.dtype) : Output data type of the fused engine
+        repeat (int) : Number of runs, the fastest one is reported
+        seed (int) : Random seed
+
+    Returns:
+        result (dict) : Timings in seconds and megapixels per second
+    """
+
+    bands = synthetic_bands(size, dtype=np.float32, seed=seed)
+    out = np.empty((len(gu.INDEX_NAMES), size, size), dtype=dtype)
+
+    def per_function():
+        image_array = {f"B{b + 1}": bands[b].ravel() for b in range(len(bands))}
+        with np.errstate(divide="ignore", invalid="ignore"):
+            for name in gu.INDEX_NAMES:
+                image_array[name] = getattr(gu, name)(image_array)
+        for index in image_array:
+            image_array[index] = (
+                image_array[index].reshape((size, size)).astype(np.float64)
+            )
+
+    def fused():
+        gu.compute_indices(bands, out=out, dtype=dtype)
+
+    mpix = size * size / 1e6
+    t_legacy = _timeit(per_function, repeat)
+    t_fused = _timeit(fused, repeat)
+
+    return {
+        "size": size,
+        "dtype": np.dtype(dtype).name,
+        "per_function_s": t_legacy,
+        "fused_s": t_fused,
+        "per_function_mpix_s": mpix / t_legacy,
+        "fused_mpix_s": mpix / t_fused,
+        "speedup": t_legacy / t_fused,
+    }
+
+
+def bench_mosaic(size=4096, grid_blocks=5, workdir=None):
+    """
+    Compares writing windows straight into one tiled mosaic against the
+    former tmp tiles + gdal_merge.py + gdalwarp path. The former path is
+    only measured when the GDAL command line tools are on the PATH.
+
+    Args:
+        size (int) : Height and width of the raster in pixels
+        grid_blocks (int) : Number of windows along each axis
+        workdir (str) : Directory for the benchmark files, a temporary one if None
+
+    Returns:
+        result (dict) : Timings in seconds and megapixels per second
+    """
+
+    cleanup = workdir is None
+    workdir = workdir or tempfile.mkdtemp(prefix="geobench_")
+    tmp_dir = os.path.join(workdir, "tmp") + os.sep
+    os.makedirs(tmp_dir, exist_ok=True)
+
+    raster1 = write_synthetic_image(os.path.join(workdir, "r1.tif"), size, 1, 1)
+    raster2 = write_synthetic_image(os.path.join(workdir, "r2.tif"), size, 1, 2)
+    windows = gu.make_windows(raster1, grid_blocks=grid_blocks)
+    mpix = size * size / 1e6
+
+    start = time.perf_counter()
+    gu.get_rasters_merged(
+        raster1, raster2, os.path.join(workdir, "mosaic.tif"), tmp_dir, grid_blocks
+    )
+    t_mosaic = time.perf_counter() - start
+
+    t_stitch = None
+    if shutil.which("gdal_merge.py") and shutil.which("gdalwarp"):
+        start = time.perf_counter()
+        with rio.open(raster1) as src1, rio.open(raster2) as src2:
+            for idx, window in enumerate(windows):
+                result = np.maximum(
+                    src1.read(1, window=window), src2.read(1, window=window)
+                )
+                tfm = transform(window, transform=src1.transform)
+                gu.save_predictions_window(
+                    result, raster1, tmp_dir + f"tmp{idx}.tif", window, tfm
+                )
+        merged = os.path.join(tmp_dir, "merged.tif")
+        tiles = " ".join(tmp_dir + f"tmp{idx}.tif" for idx in range(len(windows)))
+        gu.run_cmd(f"gdal_merge.py -n -1 -a_nodata -1 -o {merged} -of gtiff {tiles}")
+        gu.run_cmd(
+            f'gdalwarp -co "COMPRESS=DEFLATE" -srcnodata -1 -dstnodata -1 '
+            f"{merged} {os.path.join(workdir, 'stitched.tif')}"
+        )
+        t_stitch = time.perf_counter() - start
+
+    if cleanup:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "size": size,
+        "mosaic_s": t_mosaic,
+        "mosaic_mpix_s": mpix / t_mosaic,
+        "stitch_s": t_stitch,
+        "stitch_mpix_s": mpix / t_stitch if t_stitch else None,
+    }
+
+
+def bench_cog(
+    size=2048, n_reads=200, n_zoomed=20, read_size=512, zoom=8, workdir=None, seed=0
+):
+    """
+    Compares a tiled GTiff without overviews against a COG written through
+    finish_output on a random-window workload: full resolution windows and
+    zoomed-out windows decimated by zoom, as read by map viewers.
+
+    Args:
+        size (int) : Height and width of the raster in pixels
+        n_reads (int) : Number of random full resolution windows read
+        n_zoomed (int) : Number of random zoomed-out windows read
+        read_size (int) : Height and width of the full resolution windows
+        zoom (int) : Decimation factor of the zoomed-out reads
+        workdir (str) : Directory for the benchmark files, a temporary one if None
+        seed (int) : Random seed
+
+    Returns:
+        results (list) : One dict per layout with timings, file size and the
+                         COG validation errors
+    """
+
+    cleanup = workdir is None
+    workdir = workdir or tempfile.mkdtemp(prefix="geobench_")
+    image_file = write_synthetic_image(os.path.join(workdir, "image.tif"), size)
+
+    with rio.open(image_file) as src:
+        profile = gu.output_profile(src.meta, len(gu.INDEX_NAMES))
+    windows = gu.plan_windows(image_file, align=gu.OUTPUT_BLOCKSIZE)
+    rng = np.random.default_rng(seed)
+    zoomed_size = min(read_size * zoom, size)
+    offsets = rng.integers(0, size - read_size, size=(n_reads, 2))
+    zoomed_offsets = rng.integers(0, size - zoomed_size + 1, size=(n_zoomed, 2))
+
+    results = []
+    for name, cog in (("tiled", False), ("cog", True)):
+        output_file = os.path.join(workdir, name + ".tif")
+
+        start = time.perf_counter()
+        with rio.open(image_file) as src, rio.open(output_file, "w", **profile) as dst:
+            for window in windows:
+                dst.write(gu.compute_indices(src.read(window=window)), window=window)
+        gu.finish_output(output_file, cog=cog)
+        t_write = time.perf_counter() - start
+
+        # A small block cache, so repeated reads decode their tiles again
+        with rio.Env(GDAL_CACHEMAX=1), rio.open(output_file) as src:
+            start = time.perf_counter()
+            for row, col in offsets:
+                src.read(1, window=Window(col, row, read_size, read_size))
+            t_read = (time.perf_counter() - start) / n_reads
+
+            start = time.perf_counter()
+            for row, col in zoomed_offsets:
+                src.read(
+                    1,
+                    window=Window(col, row, zoomed_size, zoomed_size),
+                    out_shape=(zoomed_size // zoom, zoomed_size // zoom),
+                )
+            t_zoomed = (time.perf_counter() - start) / n_zoomed
+
+        results.append(
+            {
+                "layout": name,
+                "write_s": t_write,
+                "file_bytes": os.path.getsize(output_file),
+                "read_window_ms": t_read * 1000,
+                "read_zoomed_ms": t_zoomed * 1000,
+                "cog_errors": gu.validate_cog(output_file),
+            }
+        )
+
+    if cleanup:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return results
+
+
+def bench_band_cache(size=2048, passes=3, workdir=None):
+    """
+    Times repeated window passes of read_bands_window over a DEFLATE image
+    read through GDAL and through the memory-mapped band cache. The first
+    pass with the cache includes decoding the image into it.
+
+    Args:
+        size (int) : Height and width of the image in pixels
+        passes (int) : Number of passes over all windows
+        workdir (str) : Directory for the benchmark files, a temporary one if None
+
+    Returns:
+        results (list) : One dict per reader with the time of each pass
+    """
+
+    cleanup = workdir is None
+    workdir = workdir or tempfile.mkdtemp(prefix="geobench_")
+    images_dir = os.path.join(workdir, "images") + os.sep
+    os.makedirs(images_dir, exist_ok=True)
+    write_synthetic_image(images_dir + "bench_2019.tif", size)
+    area_dict = gu.get_filepaths(["bench"], images_dir, images_dir)
+    windows = gu.plan_windows(area_dict["bench"]["images"][0])
+
+    results = []
+    for name, cache_dir in (("gdal", None), ("memmap", workdir + "/cache")):
+        datasets = gu.DatasetCache(band_cache_dir=cache_dir)
+        times = []
+        for _ in range(passes):
+            start = time.perf_counter()
+            for window in windows:
+                gu.read_bands_window(area_dict, "bench", window, datasets=datasets)
+            times.append(time.perf_counter() - start)
+        datasets.close()
+        results.append({"size": size, "reader": name, "pass_s": times})
+
+    if cleanup:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return results
+
+
+def bench_reduce(size=2048, n_inputs=8, workdir=None):
+    """
+    Times reduce_rasters with each reducer over n_inputs aligned rasters.
+
+    Args:
+        size (int) : Height and width of the rasters in pixels
+        n_inputs (int) : Number of input rasters
+        workdir (str) : Directory for the benchmark files, a temporary one if None
+
+    Returns:
+        results (list) : One dict of timings per reducer
+    """
+
+    cleanup = workdir is None
+    workdir = workdir or tempfile.mkdtemp(prefix="geobench_")
+
+    rasters = [
+        write_synthetic_image(os.path.join(workdir, f"r{idx}.tif"), size, 1, idx)
+        for idx in range(n_inputs)
+    ]
+    mpix = size * size / 1e6
+
+    results = []
+    for reducer in gu.REDUCERS:
+        output_file = os.path.join(workdir, reducer + ".tif")
+        start = time.perf_counter()
+        gu.reduce_rasters(rasters, output_file, reducer)
+        elapsed = time.perf_counter() - start
+        results.append(
+            {
+                "size": size,
+                "n_inputs": n_inputs,
+                "reducer": reducer,
+                "seconds": elapsed,
+                "mpix_s": mpix / elapsed,
+            }
+        )
+
+    if cleanup:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return results
+
+
+def _legacy_mask_shapes(gdf, values, grid_start):
+    """Per-row GeoJSON round-trip formerly used by generate_mask"""
+    value = 1.0
+    grid_id = grid_start
+    masks, grids = [], []
+    for index, (idx, x) in enumerate(gdf.iterrows()):
+        if "class" in x:
+            value = values[x["class"]]
+        row = gpd.GeoDataFrame([x], geometry="geometry", crs=gdf.crs)
+        gdf_json = json.loads(row.to_json())
+        feature = [gdf_json["features"][0]["geometry"]][0]
+        masks.append((feature, value))
+        grids.append((feature, grid_id))
+        grid_id += 1
+    return masks, grids
+
+
+def bench_generate_mask(size=2048, n_polygons=20000, workdir=None):
+    """
+    Compares generate_mask against the former per-row GeoJSON round-trip and
+    double rasterisation, and checks that both produce the same bands.
+
+    Args:
+        size (int) : Height and width of the reference raster in pixels
+        n_polygons (int) : Number of label polygons
+        workdir (str) : Directory for the benchmark files, a temporary one if None
+
+    Returns:
+        result (dict) : Timings in seconds and whether the outputs are equal
+    """
+
+    cleanup = workdir is None
+    workdir = workdir or tempfile.mkdtemp(prefix="geobench_")
+    tiff_file = write_synthetic_image(os.path.join(workdir, "ref.tif"), size, 1)
+    shape_file = write_synthetic_labels(
+        os.path.join(workdir, "labels.gpkg"), tiff_file, n_polygons
+    )
+
+    start = time.perf_counter()
+    masks, grids, values = gu.generate_mask(
+        tiff_file, shape_file, os.path.join(workdir, "mask.tif"), grid_start=1
+    )
+    t_vectorised = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with rio.open(tiff_file) as src:
+        gdf = gu.explode(gpd.read_file(shape_file).dropna())
+        legacy_masks, legacy_grids = _legacy_mask_shapes(gdf, values, 1)
+        legacy_masks = features.rasterize(
+            legacy_masks, out_shape=src.shape, transform=src.transform
+        ).astype(rio.uint16)
+        legacy_grids = features.rasterize(
+            legacy_grids, out_shape=src.shape, transform=src.transform
+        ).astype(rio.uint16)
+    t_legacy = time.perf_counter() - start
+
+    if cleanup:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "size": size,
+        "n_polygons": n_polygons,
+        "legacy_s": t_legacy,
+        "vectorised_s": t_vectorised,
+        "speedup": t_legacy / t_vectorised,
+        "equal": bool(
+            np.array_equal(masks, legacy_masks)
+            and np.array_equal(grids, legacy_grids)
+        ),
+    }
+
+
+def bench_output_profile(size=4096, n_reads=200, read_size=256, workdir=None, seed=0):
+    """
+    Writes a ten band index stack with the former profile (float64, striped,
+    default deflate) and with output_profile variants, and measures write time,
+    file size and the latency of reading random windows back.
+
+    Args:
+        size (int) : Height and width of the raster in pixels
+        n_reads (int) : Number of random windows read back
+        read_size (int) : Height and width of the windows read back
+        workdir (str) : Directory for the benchmark files, a temporary one if None
+        seed (int) : Random seed
+
+    Returns:
+        results (list) : One dict per profile with timings in seconds and sizes in bytes
+    """
+
+    cleanup = workdir is None
+    workdir = workdir or tempfile.mkdtemp(prefix="geobench_")
+    image_file = write_synthetic_image(os.path.join(workdir, "image.tif"), size)
+
+    with rio.open(image_file) as src:
+        meta = src.meta.copy()
+    legacy = meta.copy()
+    legacy.update(count=10, dtype="float64", nodata=-1, compress="deflate")
+
+    count = len(gu.INDEX_NAMES)
+    profiles = {
+        "legacy_float64_strips": (legacy, np.float64),
+        "float32_tiled256": (gu.output_profile(meta, count), np.float32),
+        "float32_tiled512": (
+            gu.output_profile(meta, count, blocksize=512),
+            np.float32,
+        ),
+        "float32_tiled256_zstd": (
+            gu.output_profile(meta, count, compress="zstd", level=9),
+            np.float32,
+        ),
+        "int16_scaled_tiled256": (
+            gu.output_profile(meta, count, dtype=np.int16, nodata=-32768),
+            np.int16,
+        ),
+    }
+    windows = gu.plan_windows(image_file, align=512)
+    rng = np.random.default_rng(seed)
+    offsets = rng.integers(0, size - read_size, size=(n_reads, 2))
+
+    results = []
+    for name, (profile, dtype) in profiles.items():
+        output_file = os.path.join(workdir, name + ".tif")
+
+        start = time.perf_counter()
+        with rio.open(image_file) as src, rio.open(output_file, "w", **profile) as dst:
+            for window in windows:
+                indices = gu.compute_indices(src.read(window=window))
+                if np.issubdtype(dtype, np.integer):
+                    indices = gu.quantize(indices, gu.INDEX_SCALE, dtype)
+                dst.write(indices.astype(dtype), window=window)
+        t_write = time.perf_counter() - start
+
+        start = time.perf_counter()
+        with rio.open(output_file) as src:
+            for row, col in offsets:
+                src.read([1, 2], window=Window(col, row, read_size, read_size))
+        t_read = (time.perf_counter() - start) / n_reads
+
+        results.append(
+            {
+                "profile": name,
+                "write_s": t_write,
+                "file_bytes": os.path.getsize(output_file),
+                "read_window_ms": t_read * 1000,
+            }
+        )
+
+    if cleanup:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return results
+
+
+# Features of the DummyModel in the prediction benchmark, per year
+SUITE_FEATURES = ["B2", "B3", "B4", "B8", "B11", "ndvi", "ndbi", "mndwi"]
+
+# Hot paths measured by run_suite, in dependency order
+SUITE_CASES = (
+    "make_windows",
+    "generate_mask",
+    "write_indices",
+    "read_bands_window",
+    "training_data",
+    "predict",
+    "merge",
+    "stitch",
+)
+
+
+def make_suite_data(
+    workdir, size, years=(2019, 2020), n_polygons=None, seed=0, **kwargs
+):
+    """
+    Writes the synthetic inputs of one suite size: a 12 band image per year,
+    positive and negative label GPKGs with their masks, and the indices rasters.
+
+    Args:
+        workdir (str) : Directory of the files of this size
+        size (int) : Height and width of the images in pixels
+        years (list) : Years of the images
+        n_polygons (int) : Number of polygons per label file, by default one
+                           per 1000 pixels
+        seed (int) : Random seed
+        kwargs : Creation options of the images, e.g. dtype="uint16"
+
+    Returns:
+        data (dict) : The area, area_dict and directories of the inputs
+    """
+
+    area = "bench"
+    dirs = {}
+    for name in ("images", "indices", "labels", "tmp", "out"):
+        dirs[name] = os.path.join(workdir, name) + os.sep
+        os.makedirs(dirs[name], exist_ok=True)
+
+    for idx, year in enumerate(years):
+        image_file = "{}{}_{}.tif".format(dirs["images"], area, year)
+        write_synthetic_image(image_file, size, seed=seed + idx, **kwargs)
+
+    n_polygons = n_polygons or max(size * size // 1000, 10)
+    for idx, kind in enumerate(("pos", "neg")):
+        write_synthetic_labels(
+            "{}{}_{}.gpkg".format(dirs["labels"], area, kind),
+            image_file,
+            n_polygons,
+            seed=seed + idx,
+        )
+
+    area_dict = gu.get_filepaths(
+        [area], dirs["images"], dirs["indices"], dirs["labels"], dirs["labels"]
+    )
+    area_dict = gu.get_pos_raster_mask(area_dict)
+    area_dict, _ = gu.get_neg_raster_mask(area_dict)
+    area_dict = gu.write_indices(area_dict, area, dirs["indices"], dirs["tmp"])
+    gu.close_datasets()
+
+    return {"area": area, "area_dict": area_dict, "dirs": dirs, "years": years}
+
+
+def run_case(case, data, size, seed=0):
+    """
+    Runs one hot path of the suite and measures its wall time and the growth
+    of the peak RSS over the RSS at its start.
+
+    Args:
+        case (str) : Name of the case, one of SUITE_CASES
+        data (dict) : Inputs written by make_suite_data
+        size (int) : Height and width of the images in pixels
+        seed (int) : Random seed
+
+    Returns:
+        result (dict) : Case, size, seconds, megapixels per second and peak memory
+    """
+
+    assert case in SUITE_CASES, "Undefined case name."
+
+    area, area_dict, dirs = data["area"], data["area_dict"], data["dirs"]
+    image_file = area_dict[area]["images"][0]
+    pred_file = dirs["out"] + "pred.tif"
+    result = {"case": case, "size": size, "pixels": size * size}
+
+    if case == "stitch" and not all(
+        shutil.which(tool) for tool in ("gdal_merge.py", "gdalwarp", "conda")
+    ):
+        result["skipped"] = "gdal_merge.py, gdalwarp or conda not on the PATH"
+        return result
+
+    reset = gu.reset_peak_rss()
+    rss_start, _ = gu.current_rss()
+    start = time.perf_counter()
+
+    if case == "make_windows":
+        result["calls"] = 100
+        for _ in range(100):
+            gu.make_windows(image_file, grid_blocks=5)
+            gu.plan_windows(image_file)
+    elif case == "generate_mask":
+        gu.generate_mask(
+            image_file,
+            area_dict[area]["pos_mask_gpkg"],
+            dirs["out"] + "mask.tif",
+            grid_start=1,
+        )
+    elif case == "write_indices":
+        gu.write_indices(area_dict, area, dirs["out"], dirs["tmp"], force=True)
+    elif case == "read_bands_window":
+        for window in gu.plan_windows(image_file):
+            gu.read_bands_window(area_dict, area, window)
+    elif case == "training_data":
+        gu.generate_training_data(area_dict, streaming=True)
+    elif case == "predict":
+        features = [
+            "{}_{}".format(name, year)
+            for year in data["years"]
+            for name in SUITE_FEATURES
+        ]
+        report = gu.get_preds_windowing(
+            area,
+            area_dict,
+            DummyModel(seed),
+            dirs["tmp"],
+            features,
+            pred_file,
+        )
+        result["pixels_per_second"] = report["pixels_per_second"]
+    elif case == "merge":
+        gu.get_rasters_merged(
+            pred_file, pred_file, dirs["out"] + "merged.tif", dirs["tmp"]
+        )
+    elif case == "stitch":
+        tiles = []
+        with rio.open(pred_file) as src:
+            for idx, window in enumerate(gu.make_windows(pred_file, grid_blocks=4)):
+                tile = dirs["tmp"] + "tile{}.tif".format(idx)
+                tfm = transform(window, transform=src.transform)
+                gu.save_predictions_window(
+                    src.read(1, window=window), pred_file, tile, window, tfm
+                )
+                tiles.append(tile)
+        gu.stitch(dirs["out"] + "stitched.tif", dirs["tmp"], file_list=tiles)
+
+    seconds = time.perf_counter() - start
+    rss_end, peak = gu.current_rss()
+    gu.close_datasets()
+
+    result.update(
+        {
+            "seconds": seconds,
+            "mpix_s": size * size / 1e6 / seconds,
+            "peak_rss_mb": peak / 2 ** 20,
+            "peak_growth_mb": (peak - rss_start) / 2 ** 20 if reset else None,
+        }
+    )
+    return result
+
+
+def run_suite(
+    sizes=(1024, 2048, 4096),
+    cases=SUITE_CASES,
+    workdir=None,
+    years=(2019, 2020),
+    seed=0,
+    keep=False,
+    **kwargs
+):
+    """
+    Runs the benchmark suite: for each size, writes the synthetic inputs and runs
+    each case in a fresh process, so its peak memory is measured on its own.
+
+    Args:
+        sizes (list) : Heights and widths of the images in pixels
+        cases (list) : Cases to run, see SUITE_CASES
+        workdir (str) : Directory for the benchmark files, a temporary one if None
+        years (list) : Years of the images
+        seed (int) : Random seed
+        keep (bool) : Whether to keep the files of each size
+        kwargs : Creation options of the images, e.g. dtype="uint16"
+
+    Returns:
+        results (list) : One dict per case and size
+    """
+
+    cleanup = workdir is None
+    workdir = workdir or tempfile.mkdtemp(prefix="geobench_")
+    cases = [case for case in SUITE_CASES if case in cases]
+    context = multiprocessing.get_context("fork")
+
+    results = []
+    for size in sizes:
+        size_dir = os.path.join(workdir, str(size))
+        start = time.perf_counter()
+        data = make_suite_data(size_dir, size, years, seed=seed, **kwargs)
+        setup_s = time.perf_counter() - start
+
+        for case in cases:
+            with ProcessPoolExecutor(1, mp_context=context) as pool:
+                result = pool.submit(run_case, case, data, size, seed).result()
+            result["setup_s"] = setup_s
+            print(result)
+            results.append(result)
+
+        if not keep:
+            shutil.rmtree(size_dir, ignore_errors=True)
+
+    if cleanup and not keep:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return results
+
+
+def save_results(results, output_file):
+    """Writes benchmark results to a JSON or, by extension, a CSV file"""
+    if output_file.endswith(".csv"):
+        columns = []
+        for result in results:
+            columns += [key for key in result if key not in columns]
+        with open(output_file, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=columns)
+            writer.writeheader()
+            writer.writerows(results)
+    else:
+        with open(output_file, "w") as f:
+            json.dump(results, f, indent=1)
+
+
+def run_micro():
+    """Runs the comparisons of the individual optimisations"""
+    results = []
+    for dtype in (np.float32, np.float64):
+        results.append(bench_indices(dtype=dtype))
+    results.append(bench_mosaic())
+    results += bench_reduce()
+    results += bench_band_cache()
+    results.append(bench_generate_mask())
+    results += bench_output_profile()
+    results += bench_cog()
+    for result in results:
+        print(result)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "command", nargs="?", choices=["suite", "micro"], default="suite"
+    )
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1024, 2048, 4096])
+    parser.add_argument("--cases", nargs="+", choices=SUITE_CASES, default=SUITE_CASES)
+    parser.add_argument("--years", type=int, nargs="+", default=[2019, 2020])
+    parser.add_argument("--dtype", default="float32", help="data type of the images")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workdir", help="directory for the benchmark files")
+    parser.add_argument("--keep", action="store_true", help="keep the benchmark files")
+    parser.add_argument("--output", help="JSON or CSV file for the results")
+    args = parser.parse_args()
+
+    if args.command == "micro":
+        results = run_micro()
+    else:
+        results = run_suite(
+            args.sizes,
+            args.cases,
+            workdir=args.workdir,
+            years=args.years,
+            seed=args.seed,
+            keep=args.keep,
+            dtype=args.dtype,
+        )
+
+    if args.output:
+        save_results(results, args.output)
@@ -1,158 +1,777 @@
 import os
+import sys
+import csv
 import json
+import math
+import fcntl
+import shutil
+import hashlib
+import resource
+import time
+import tempfile
 import itertools
 import numpy as np
 import pandas as pd
 from tqdm import tqdm
 from pathlib import Path
+import threading
 import subprocess
+from contextlib import contextmanager
+from collections import deque, OrderedDict
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import matplotlib.pyplot as plt
 
 import geopandas as gpd
 import rasterio as rio
-from rasterio.windows import Window, transform
+from rasterio.windows import Window
 from rasterio import features
+from rasterio.enums import Interleaving, Resampling
+from rasterio.shutil import copy as rio_copy
 import rasterio.mask
 from rasterio.plot import show
 from fiona.crs import to_string
 
-GRID_ID = 1
+# Default size of the decoded source data of one processing window in bytes
+WINDOW_MEM_BUDGET = 64 * 1024 * 1024
 
+# Height and width of the internal tiles of the rasters written by geoutils
+OUTPUT_BLOCKSIZE = 256
 
-def write_indices(area_dict, area, indices_dir, tmp_dir):
+# Indices written as integers store round(index * INDEX_SCALE)
+INDEX_SCALE = 1000
+
+# Version of the index formulas, bump it when compute_indices changes
+INDEX_VERSION = 1
+
+# Manifest of the indices rasters written by write_indices, in indices_dir. Its
+# name, and that of its lock, are dot-prefixed so get_filepaths skips them
+INDEX_MANIFEST = ".indices_manifest.json"
+
+# Seconds between the checkpoints of a partial indices raster, see write_indices
+INDEX_CHECKPOINT_SECONDS = 60
+
+# Number of feature rows passed to predict_proba at a time
+PREDICT_BATCH_SIZE = 65536
+
+# Pixel-wise reducers of reduce_rasters
+REDUCERS = ("max", "mean", "median", "count", "first")
+
+# Value of tmp_dir placing the scratch directories on the tmpfs below
+IN_MEMORY = ":memory:"
+TMPFS_DIR = "/dev/shm"
+
+# Maximum number of datasets kept open by a DatasetCache
+DATASET_CACHE_SIZE = 64
+
+# Directory of the decoded band caches used by DatasetCache, see MemmapDataset.
+# None disables the cache
+BAND_CACHE_DIR = None
+
+# Default DatasetCache of each thread, see get_dataset_cache
+_DATASETS = threading.local()
+
+# State of the prediction workers of a process pool, see _init_worker
+_WORKER = {}
+
+# Records of the profiler stages running in this process, see PipelineProfiler
+_OPEN_STAGES = []
+_OPEN_STAGES_LOCK = threading.Lock()
+
+# Band order of the derived indices rasters written by write_indices
+INDEX_NAMES = [
+    "ndvi",
+    "ndbi",
+    "savi",
+    "mndwi",
+    "ui",
+    "nbi",
+    "brba",
+    "nbai",
+    "mbi",
+    "baei",
+]
+
+# Band of the IBI in indices rasters written with write_indices(ibi=True)
+IBI_BAND = len(INDEX_NAMES) + 1
+
+# Share of the IBI values clipped as outliers, half at each end
+IBI_THRESHOLD = 0.05
+
+# Maximum number of pixels sampled to estimate the IBI quantiles
+IBI_SAMPLE_SIZE = 1000000
+
+
+def write_indices(
+    area_dict,
+    area,
+    indices_dir,
+    tmp_dir,
+    dtype=np.float32,
+    mem_budget=WINDOW_MEM_BUDGET,
+    overviews=None,
+    profile_options=None,
+    force=False,
+    ibi=False,
+    cog=False,
+    profiler=None,
+):
     """
     Reads the bands for each image of each area and calculates the derived indices.
+    Each window is written straight into the output raster of its year.
+
+    With ibi=True the IBI is added as band IBI_BAND. Its normalisation ranges
+    and outlier cutoffs are estimated beforehand in one streaming pass, see
+    ibi_stats. With cog=True the outputs are Cloud Optimized GeoTIFFs, see
+    finish_output.
+
+    With an integer dtype such as np.int16, indices are stored as
+    round(index * INDEX_SCALE), clipped to the range of the type, with the
+    scale recorded in the raster and non-finite values set to nodata.
+
+    Outputs are recorded in a manifest (INDEX_MANIFEST in indices_dir) keyed by
+    the content hash of the source image, INDEX_VERSION and the output profile.
+    Up-to-date outputs are skipped. Stale ones are rebuilt in a partial file in
+    a ".partial" directory under tmp_dir that is moved into place once complete.
+    The manifest, the partial directory and the locks are dot-prefixed, so
+    get_filepaths does not list them as indices rasters. A run interrupted
+    part-way resumes from the last checkpoint. The partial file stays open
+    while it is written and is checkpointed every INDEX_CHECKPOINT_SECONDS:
+    it is closed, which writes the TIFF directory, flushed to disk, and only
+    then are its windows recorded as done. Each output is locked while it is
+    built, so concurrent jobs sharing indices_dir never write the same file.
 
     Args:
         area_dict (dict) : Python dictionary containing the file paths per area
         area (str) : The area of interest (AOI)
+        indices_dir (str) : Path to the output directory of the indices rasters
+        tmp_dir (str) : Directory of the partial outputs, defaults to indices_dir.
+                        IN_MEMORY places them on the tmpfs at TMPFS_DIR when
+                        available, where they do not survive a reboot
+        dtype (np.dtype) : Data type of the output indices rasters
+        mem_budget (int) : Size of the decoded bands of one window in bytes
+        overviews (list) : Optional overview factors, e.g. [2, 4, 8]
+        profile_options (dict) : Extra keyword arguments of output_profile
+        force (bool) : Whether to rebuild all outputs
+        ibi (bool) : Whether to add the IBI as an 11th band
+        cog (bool) : Whether to write Cloud Optimized GeoTIFFs
+        profiler (PipelineProfiler) : Optional profiler of the stages and windows
 
     Returns:
-        data (pd.DataFrame) : The resulting pandas dataframe containing the raw spectral
-                              bands and derived indices
+        area_dict (dict) : The input area_dict with the indices file paths appended
     """
 
-    image_array = {}
     image_list = area_dict[area]["images"]
-
-    p = Path(tmp_dir)
-    tmp_files = [str(f) for f in list(p.glob("tmp*.tif"))]
-    for f in tmp_files:
-        os.remove(f)
-
-    import math
-
-    def get_grid_blocks(filepath):
-        # prevent memory inflation by making sure each block processes max 50mb only
-        mb_size = os.path.getsize(filepath) / 1024 / 1024
-        return math.ceil(math.sqrt(mb_size / 50))
+    profile_options = profile_options or {}
+    profiler = profiler or PipelineProfiler(enabled=False)
+    scaled = np.issubdtype(dtype, np.integer)
+
+    partial_dir = os.path.join(resolve_tmp_dir(tmp_dir) or indices_dir, ".partial")
+    os.makedirs(partial_dir, exist_ok=True)
+    manifest_file = os.path.join(indices_dir, INDEX_MANIFEST)
+    profile_key = hashlib.sha1(
+        json.dumps(
+            {
+                "dtype": np.dtype(dtype).name,
+                "scale": INDEX_SCALE if scaled else None,
+                "overviews": overviews,
+                "profile_options": profile_options,
+                "ibi": ibi,
+                "cog": cog,
+            },
+            sort_keys=True,
+        ).encode()
+    ).hexdigest()
 
     # Iterate over each year
     for image_file in tqdm(image_list, total=len(image_list)):
         year = image_file.split("_")[-1].split(".")[0]
         output_file = indices_dir + "indices_" + area + "_" + year + ".tif"
-        area_dict[area]["indices"].append(output_file)
+        if output_file not in area_dict[area]["indices"]:
+            area_dict[area]["indices"].append(output_file)
+
+        name = os.path.basename(output_file)
+        partial_file = os.path.join(partial_dir, name)
+        with file_lock(partial_file):
+            _write_indices_file(
+                image_file,
+                output_file,
+                partial_file,
+                manifest_file,
+                profile_key,
+                dtype,
+                mem_budget,
+                overviews,
+                profile_options,
+                force,
+                ibi,
+                cog,
+                profiler,
+            )
 
-        image = rio.open(image_file)
-        grid_blocks = get_grid_blocks(image_file)
-        windows = make_windows(image_file, grid_blocks=grid_blocks)
+    return area_dict
 
-        image_meta = image.meta
-        indices_meta = image_meta.copy()
-        indices_meta.update(
-            {
-                "driver": "GTiff",
-                "count": 10,
-                "nodata": -1,
-                "dtype": np.float64,
-            }
+
+def _write_indices_file(
+    image_file,
+    output_file,
+    partial_file,
+    manifest_file,
+    profile_key,
+    dtype,
+    mem_budget,
+    overviews,
+    profile_options,
+    force,
+    ibi,
+    cog,
+    profiler,
+):
+    """Writes the indices raster of one image, see write_indices"""
+
+    blocksize = profile_options.get("blocksize", OUTPUT_BLOCKSIZE)
+    scaled = np.issubdtype(dtype, np.integer)
+    nodata = np.iinfo(dtype).min if scaled else -1
+    work_dtype = np.float32 if scaled else dtype
+    count = IBI_BAND if ibi else len(INDEX_NAMES)
+
+    name = os.path.basename(output_file)
+    entry = load_manifest(manifest_file).get(name, {})
+    source = file_digest(image_file, entry.get("source"))
+    key = [source["digest"], INDEX_VERSION, profile_key]
+
+    if not force and entry.get("key") == key:
+        if entry.get("complete") and os.path.isfile(output_file):
+            return
+
+    windows = plan_windows(image_file, mem_budget=mem_budget, align=blocksize)
+    windows_key = [mem_budget, blocksize, len(windows)]
+
+    resume = (
+        not force
+        and entry.get("key") == key
+        and entry.get("windows_key") == windows_key
+        and os.path.isfile(partial_file)
+    )
+    if not resume:
+        entry = {"key": key, "windows_key": windows_key, "done": []}
+    entry.update({"source": source, "complete": False})
+    if ibi and "ibi" not in entry:
+        with profiler.stage("ibi_stats", file=name):
+            entry["ibi"] = ibi_stats(image_file, windows, dtype=work_dtype)
+
+    with rio.open(image_file) as image:
+        if not resume:
+            indices_meta = output_profile(
+                image.meta,
+                count=count,
+                dtype=dtype,
+                nodata=nodata,
+                **profile_options
+            )
+            with rio.open(partial_file, "w", **indices_meta) as dst:
+                if scaled:
+                    dst.scales = [1.0 / INDEX_SCALE] * count
+            fsync_path(partial_file)
+        update_manifest(manifest_file, name, entry)
+
+        done = set(entry["done"])
+        pending = []
+        checkpoint = time.perf_counter()
+        dst = rio.open(partial_file, "r+")
+        try:
+            for idx, window in tqdm(enumerate(windows), total=len(windows)):
+                if idx in done:
+                    continue
+
+                with profiler.stage("read", idx, file=name) as record:
+                    bands = image.read(window=window)
+                    record["bytes_read"] = bands.nbytes
+
+                # Get derived indices in a single pass over the window
+                with profiler.stage("compute", idx, file=name):
+                    indices = np.empty((count,) + bands.shape[1:], dtype=work_dtype)
+                    compute_indices(
+                        bands, out=indices[: len(INDEX_NAMES)], dtype=work_dtype
+                    )
+                    if ibi:
+                        ndbi_t, savi_t, mndwi_t = indices[1:4]
+                        indices[IBI_BAND - 1] = ibi_window(
+                            ndbi_t, savi_t, mndwi_t, **entry["ibi"]
+                        )
+                    if scaled:
+                        indices = quantize(indices, INDEX_SCALE, dtype)
+
+                with profiler.stage("write", idx, file=name) as record:
+                    dst.write(indices, window=window)
+                    record["bytes_written"] = indices.nbytes
+                pending.append(idx)
+
+                if time.perf_counter() - checkpoint >= INDEX_CHECKPOINT_SECONDS:
+                    with profiler.stage("checkpoint", idx, file=name):
+                        dst.close()
+                        _record_windows(
+                            partial_file, manifest_file, name, entry, pending
+                        )
+                        dst = rio.open(partial_file, "r+")
+                    checkpoint = time.perf_counter()
+        finally:
+            # Windows written before an error are kept for the next run
+            dst.close()
+            _record_windows(partial_file, manifest_file, name, entry, pending)
+
+    with profiler.stage("finish", file=name) as record:
+        finish_output(partial_file, overviews, cog)
+        fsync_path(partial_file)
+        record["bytes_written"] = os.path.getsize(partial_file)
+    finalise(partial_file, output_file)
+    entry.update({"complete": True, "done": []})
+    update_manifest(manifest_file, name, entry)
+
+
+def _record_windows(partial_file, manifest_file, name, entry, pending):
+    """
+    Records the windows written to the closed partial file as done, once the
+    file is on disk, see write_indices
+    """
+
+    if not pending:
+        return
+    fsync_path(partial_file)
+    entry["done"] += pending
+    pending.clear()
+    update_manifest(manifest_file, name, entry)
+
+
+def fsync_path(path):
+    """Flushes a file or directory to disk"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def file_digest(path, record=None, chunk_size=8 * 1024 * 1024):
+    """
+    Returns the BLAKE2 content hash of a file along with its size and
+    modification time. If record, a previous result for the file, has the same
+    size and modification time, its hash is reused instead of reading the file.
+
+    Args:
+        path (str) : Path to the file
+        record (dict) : Previous result of file_digest for the file
+        chunk_size (int) : Number of bytes hashed at a time
+
+    Returns:
+        record (dict) : The "size", "mtime_ns" and "digest" of the file
+    """
+
+    stat = os.stat(path)
+    if record and (record["size"], record["mtime_ns"]) == (
+        stat.st_size,
+        stat.st_mtime_ns,
+    ):
+        return record
+
+    digest = hashlib.blake2b(digest_size=20)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+
+    return {
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "digest": digest.hexdigest(),
+    }
+
+
+def load_manifest(manifest_file):
+    """Reads a JSON manifest, returning an empty one if the file does not exist"""
+    if not os.path.isfile(manifest_file):
+        return {}
+    with open(manifest_file) as f:
+        return json.load(f)
+
+
+def update_manifest(manifest_file, name, entry):
+    """
+    Sets one entry of a JSON manifest. The manifest is locked, re-read and
+    replaced atomically, so concurrent jobs do not lose each other's entries
+    and a crash never leaves it truncated. It is on disk when this returns.
+    """
+
+    with file_lock(manifest_file):
+        manifest = load_manifest(manifest_file)
+        manifest[name] = entry
+        fd, tmp_file = tempfile.mkstemp(
+            prefix=".manifest-", dir=os.path.dirname(manifest_file) or "."
         )
+        with os.fdopen(fd, "w") as f:
+            json.dump(manifest, f, indent=1)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, manifest_file)
+        fsync_path(os.path.dirname(manifest_file) or ".")
 
-        for idx, window in tqdm(enumerate(windows), total=len(windows)):
 
-            window_size = {
-                "height": window.height,
-                "width": window.width,
-                "transform": transform(window, transform=image.transform),
-            }
-            indices_meta.update(window_size)
-
-            for band in range(1, image.count + 1):
-                band_window = image.read(band, window=window)
-                band_values = band_window.ravel()
-                image_array[f"B{band}"] = band_values
-
-            # Get derived indices
-            image_array["ndvi"] = ndvi(image_array)
-            image_array["ndbi"] = ndbi(image_array)
-            image_array["savi"] = savi(image_array)
-            image_array["mndwi"] = mndwi(image_array)
-            image_array["ui"] = ui(image_array)
-            image_array["nbi"] = nbi(image_array)
-            image_array["brba"] = brba(image_array)
-            image_array["nbai"] = nbai(image_array)
-            image_array["mbi"] = mbi(image_array)
-            image_array["baei"] = baei(image_array)
-
-            for index in image_array:
-                image_array[index] = (
-                    image_array[index]
-                    .reshape((window.height, window.width))
-                    .astype(np.float64)
-                )
+@contextmanager
+def file_lock(path):
+    """
+    Holds an exclusive advisory lock on path + ".lock" while the context is open.
 
-            # save index window to tiff
-            tmp_file = tmp_dir + f"tmp{idx}.tif"
-            with rio.open(
-                tmp_file, "w", **indices_meta, compress="deflate"
-            ) as dst:
-                dst.write(image_array["ndvi"], 1)
-                dst.write(image_array["ndbi"], 2)
-                dst.write(image_array["savi"], 3)
-                dst.write(image_array["mndwi"], 4)
-                dst.write(image_array["ui"], 5)
-                dst.write(image_array["nbi"], 6)
-                dst.write(image_array["brba"], 7)
-                dst.write(image_array["nbai"], 8)
-                dst.write(image_array["mbi"], 9)
-                dst.write(image_array["baei"], 10)
-
-        # collect to windows to 1 tif
-        stitch(output_file, tmp_dir)
+    Args:
+        path (str) : Path of the file to lock
 
-    return area_dict
+    Yields:
+        None
+    """
+
+    with open(path + ".lock", "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
 
 
-def save_predictions_window(pred, image_src, output_file, window, tfm):
+def resolve_tmp_dir(tmp_dir):
+    """
+    Returns the directory to use for tmp_dir: TMPFS_DIR for IN_MEMORY when it
+    exists, otherwise None, and tmp_dir itself for any other value.
+    """
+
+    if tmp_dir == IN_MEMORY:
+        return TMPFS_DIR if os.path.isdir(TMPFS_DIR) else None
+    return tmp_dir
+
+
+@contextmanager
+def scratch_dir(tmp_dir=None, prefix="geoutils-"):
+    """
+    Creates a scratch directory private to one job and removes it with all its
+    content when the context exits, whether the job succeeded or not.
+
+    Args:
+        tmp_dir (str) : Parent directory. IN_MEMORY places it on the tmpfs at
+                        TMPFS_DIR when available, None on the system default
+        prefix (str) : Prefix of the directory name
+
+    Yields:
+        path (str) : Path to the scratch directory
+    """
+
+    tmp_dir = resolve_tmp_dir(tmp_dir)
+    if tmp_dir:
+        os.makedirs(tmp_dir, exist_ok=True)
+
+    path = tempfile.mkdtemp(prefix=prefix, dir=tmp_dir)
+    try:
+        yield path
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def finalise(scratch_file, output_file):
+    """
+    Moves a finished file into place atomically. Readers of output_file see
+    either the previous file or the complete new one, even when scratch_file is
+    on another filesystem, in which case it is first copied next to output_file.
+    The move is on disk when this returns, and a copy is on disk before
+    scratch_file is removed.
+
+    Args:
+        scratch_file (str) : Path to the finished file
+        output_file (str) : Destination path
+
+    Returns:
+        None
+    """
+
+    get_dataset_cache().evict(output_file)
+    output_dir = os.path.dirname(output_file) or "."
+    try:
+        os.replace(scratch_file, output_file)
+    except OSError:
+        fd, tmp_file = tempfile.mkstemp(prefix=".partial-", dir=output_dir)
+        os.close(fd)
+        try:
+            shutil.copyfile(scratch_file, tmp_file)
+            fsync_path(tmp_file)
+            os.replace(tmp_file, output_file)
+        except BaseException:
+            os.remove(tmp_file)
+            raise
+        # The copy must be on disk before the only other copy is removed
+        fsync_path(output_dir)
+        os.remove(scratch_file)
+        return
+    fsync_path(output_dir)
+
+
+@contextmanager
+def atomic_output(output_file, tmp_dir=None):
+    """
+    Yields a path in a private scratch directory to write output_file to. The
+    file is moved into place with finalise only if the context exits without
+    error, otherwise output_file is left untouched.
+
+    Args:
+        output_file (str) : The output filepath
+        tmp_dir (str) : Parent of the scratch directory, see scratch_dir
+
+    Yields:
+        scratch_file (str) : Path to write the output to
+    """
+
+    with scratch_dir(tmp_dir) as path:
+        scratch_file = os.path.join(path, os.path.basename(output_file))
+        yield scratch_file
+        finalise(scratch_file, output_file)
+
+
+def quantize(values, scale, dtype=np.int16):
+    """
+    Converts floats to scaled integers, round(values * scale), clipped to the
+    range of dtype. Non-finite values are set to the minimum of dtype, which
+    serves as nodata.
+    """
+
+    info = np.iinfo(dtype)
+    scaled = np.multiply(values, scale, dtype=np.float32)
+    np.rint(scaled, out=scaled)
+    finite = np.isfinite(scaled)
+    np.clip(scaled, info.min + 1, info.max, out=scaled)
+    out = scaled.astype(dtype)
+    out[~finite] = info.min
+    return out
+
+
+def output_profile(
+    meta,
+    count=1,
+    dtype=np.float32,
+    nodata=-1,
+    blocksize=OUTPUT_BLOCKSIZE,
+    compress="deflate",
+    predictor=None,
+    level=6,
+):
+    """
+    Creates the profile of a full-size, tiled and compressed GTiff that windows
+    can be written to directly. Bands are stored separately so that reading a
+    subset of them only decompresses that subset. Shared by all geoutils writers.
+
+    Args:
+        meta (dict) : Metadata of the reference raster
+        count (int) : Number of bands
+        dtype (np.dtype) : Data type of the output raster
+        nodata (float) : Nodata value of the output raster
+        blocksize (int) : Height and width of the internal tiles
+        compress (str) : Compression, e.g. "deflate", "zstd", "lzw" or "none"
+        predictor (int) : TIFF predictor, 1 for none, 2 for integers, 3 for floats.
+                          Picked from dtype if None
+        level (int) : Compression level of deflate or zstd
+
+    Returns:
+        profile (dict) : The rasterio profile of the output raster
+    """
+
+    profile = meta.copy()
+    profile.update(
+        {
+            "driver": "GTiff",
+            "count": count,
+            "nodata": nodata,
+            "dtype": dtype,
+            "compress": compress,
+            "tiled": True,
+            "blockxsize": blocksize,
+            "blockysize": blocksize,
+            "interleave": "band",
+            "BIGTIFF": "IF_SAFER",
+        }
+    )
+
+    if compress in ("deflate", "zstd", "lzw"):
+        if predictor is None:
+            predictor = 3 if np.issubdtype(dtype, np.floating) else 2
+        profile["predictor"] = predictor
+    if compress == "deflate":
+        profile["zlevel"] = level
+    elif compress == "zstd":
+        profile["zstd_level"] = level
+
+    return profile
+
+
+def build_overviews(raster_file, factors=(2, 4, 8, 16), resampling="average"):
+    """
+    Adds internal overviews to a raster, respecting its nodata value.
+
+    Args:
+        raster_file (str) : Path to the raster file
+        factors (list) : Decimation factors of the overviews
+        resampling (str) : Name of the rasterio Resampling method
+
+    Returns:
+        None
+    """
+
+    get_dataset_cache().evict(raster_file)
+    with rio.open(raster_file, "r+") as dst:
+        dst.build_overviews(list(factors), Resampling[resampling])
+        dst.update_tags(ns="rio_overview", resampling=resampling)
+
+
+def cog_overview_factors(width, height, blocksize=OUTPUT_BLOCKSIZE):
+    """
+    Returns the overview factors, powers of two, needed for the smallest
+    overview of a raster to fit in a single tile.
+    """
+
+    factors = []
+    factor = 2
+    while max(width, height) > blocksize * factor // 2:
+        factors.append(factor)
+        factor *= 2
+    return factors
+
+
+def finish_output(raster_file, overviews=None, cog=False, resampling="average"):
+    """
+    Completes a raster written window by window: adds its overviews and, with
+    cog=True, rewrites it in place as a Cloud Optimized GeoTIFF, with the IFDs
+    first and the overview tiles, smallest first, before the full resolution
+    ones. Creation options of the raster (tiling, compression, predictor,
+    interleave) are kept.
+
+    GTiff cannot reorder a file written window by window, so the COG layout
+    costs one full copy of the raster after its overviews are built: every
+    tile is read and written again, and a second copy of the file is needed
+    next to raster_file until it replaces it.
+
+    Args:
+        raster_file (str) : Path to the raster file, usually in a scratch directory
+        overviews (list) : Overview factors. With cog=True and overviews None
+                           they are picked with cog_overview_factors
+        cog (bool) : Whether to rewrite the raster as a COG
+        resampling (str) : Name of the rasterio Resampling method
+
+    Returns:
+        None
+    """
+
+    get_dataset_cache().evict(raster_file)
+    if cog and overviews is None:
+        with rio.open(raster_file) as src:
+            blocksize = src.block_shapes[0][1]
+            overviews = cog_overview_factors(src.width, src.height, blocksize)
+    if overviews:
+        build_overviews(raster_file, overviews, resampling)
+    if not cog:
+        return
+
+    with rio.open(raster_file) as src:
+        structure = src.tags(ns="IMAGE_STRUCTURE")
+        options = {
+            "tiled": True,
+            "blockysize": src.block_shapes[0][0],
+            "blockxsize": src.block_shapes[0][1],
+            "compress": structure.get("COMPRESSION", "NONE"),
+            "interleave": structure.get("INTERLEAVE", "BAND"),
+            "BIGTIFF": "IF_SAFER",
+        }
+        if "PREDICTOR" in structure:
+            options["predictor"] = structure["PREDICTOR"]
+
+    # The one full rewrite of the raster, see above
+    cog_file = raster_file + ".cog"
+    rio_copy(
+        raster_file, cog_file, driver="GTiff", copy_src_overviews=True, **options
+    )
+    os.replace(cog_file, raster_file)
+
+
+def validate_cog(raster_file):
+    """
+    Checks the layout of a Cloud Optimized GeoTIFF, following the GDAL
+    validate_cloud_optimized_geotiff.py rules: tiled, with overviews if larger
+    than a tile, IFDs before the image data and overview tiles, smallest
+    overview first, before the full resolution tiles.
+
+    Args:
+        raster_file (str) : Path to the raster file
+
+    Returns:
+        errors (list) : Description of each rule broken, empty for a valid COG
+    """
+
+    errors = []
+    with rio.open(raster_file) as src:
+        if src.driver != "GTiff":
+            return ["Not a GTiff file"]
+        block_h, block_w = src.block_shapes[0]
+        if block_w == src.width and src.width > 512:
+            errors.append("The file is not tiled")
+        n_overviews = len(src.overviews(1))
+        if n_overviews == 0 and max(src.width, src.height) > block_w:
+            errors.append("The file has no overviews")
+
+        levels = [None] + list(range(n_overviews))
+        ifd_offsets, data_offsets = [], []
+        for level in levels:
+            with rio.open(raster_file, overview_level=level) as ovr:
+                ifd_offsets.append(int(ovr.get_tag_item("IFD_OFFSET", "TIFF", bidx=1)))
+                offset = ovr.get_tag_item("BLOCK_OFFSET_0_0", "TIFF", bidx=1)
+                data_offsets.append(int(offset) if offset else 0)
+
+    if ifd_offsets != sorted(ifd_offsets):
+        errors.append("The IFDs are not ordered from full resolution to overviews")
+
+    # Levels whose first tile is sparse, i.e. not written, have no data offset
+    data_offsets = [offset for offset in data_offsets if offset]
+    if not data_offsets:
+        errors.append("No level has a first tile written, the data layout is unknown")
+        return errors
+    if max(ifd_offsets) > min(data_offsets):
+        errors.append("The IFDs are not all before the image data")
+    if data_offsets != sorted(data_offsets, reverse=True):
+        errors.append("The image data is not ordered from smallest overview up")
+
+    return errors
+
+
+def save_predictions_window(
+    pred, image_src, output_file, window, tfm, dtype=np.float32, **profile_options
+):
     """
     Saves the predictions as a TIFF file, using img_source as reference.
 
     Args:
         pred (numpy array) : The array containing the predictions
         image_src (str) : Path to the source image to be used as a reference file
+        dtype (np.dtype) : Data type of the output raster
+        profile_options : Extra keyword arguments of output_profile
 
     Returns:
         None
     """
 
+    get_dataset_cache().evict(output_file)
     with rio.open(image_src) as src:
         out_image = np.array(pred).reshape((window.height, window.width))
-        out_meta = src.meta
-
+        out_meta = output_profile(src.meta, dtype=dtype, **profile_options)
         out_meta.update(
             {
-                "driver": "GTiff",
                 "height": window.height,
                 "width": window.width,
-                "count": 1,
-                "nodata": -1,
-                "dtype": np.float64,
                 "transform": tfm,
             }
         )
 
-        with rio.open(output_file, "w", **out_meta, compress="deflate") as dest:
-            dest.write(out_image, 1)
+        with rio.open(output_file, "w", **out_meta) as dest:
+            dest.write(out_image.astype(dtype), 1)
 
 
 def rename_ind_cols(df):
@@ -174,148 +793,1227 @@ def rename_ind_cols(df):
         "I8": "nbai",
         "I9": "mbi",
         "I10": "baei",
+        "I11": "ibi",
     }
 
-    # create mapping of column names
-    for col in cols:
-        pat = col.split("_")[0]
-        col_n = col.replace(pat, ind_dict[pat])
-        renaming[col] = col_n
+    # create mapping of column names
+    for col in cols:
+        pat = col.split("_")[0]
+        col_n = col.replace(pat, ind_dict[pat])
+        renaming[col] = col_n
+
+    return df.rename(columns=renaming)
+
+
+def get_rasters_merged(
+    raster_file1,
+    raster_file2,
+    output_file,
+    tmp_dir,
+    grid_blocks=None,
+    mem_budget=WINDOW_MEM_BUDGET,
+    datasets=None,
+    dtype=np.float32,
+    overviews=None,
+    profile_options=None,
+    cog=False,
+    profiler=None,
+):
+    """
+    Merges two rasters into one by taking their pixel-wise maximum,
+    see reduce_rasters.
+
+    Args:
+        raster_file1 (str) : Path to the first raster, also used as reference
+        raster_file2 (str) : Path to the second raster
+        output_file (str) : The output filepath
+        tmp_dir (str) : Parent of the scratch directory, see scratch_dir
+        grid_blocks (int) : Number of windows along each axis. If None, the
+                            windows are planned with plan_windows
+        mem_budget (int) : Size of the decoded inputs of one window in bytes
+        datasets (DatasetCache) : Cache of open datasets, defaults to the cache
+                                  of the calling thread
+        dtype (np.dtype) : Data type of the output raster
+        overviews (list) : Optional overview factors, e.g. [2, 4, 8]
+        profile_options (dict) : Extra keyword arguments of output_profile
+        cog (bool) : Whether to write a Cloud Optimized GeoTIFF
+        profiler (PipelineProfiler) : Optional profiler of the stages and windows
+
+    Returns:
+        None
+    """
+
+    reduce_rasters(
+        [raster_file1, raster_file2],
+        output_file,
+        reducer="max",
+        tmp_dir=tmp_dir,
+        grid_blocks=grid_blocks,
+        mem_budget=mem_budget,
+        datasets=datasets,
+        dtype=dtype,
+        overviews=overviews,
+        profile_options=profile_options,
+        cog=cog,
+        profiler=profiler,
+    )
+
+
+def reduce_rasters(
+    raster_files,
+    output_file,
+    reducer="max",
+    tmp_dir=None,
+    band=1,
+    grid_blocks=None,
+    mem_budget=WINDOW_MEM_BUDGET,
+    datasets=None,
+    dtype=np.float32,
+    nodata=-1,
+    overviews=None,
+    profile_options=None,
+    cog=False,
+    profiler=None,
+):
+    """
+    Combines any number of aligned rasters pixel by pixel into one, window by
+    window. Nodata and NaN pixels of an input are ignored, and pixels without
+    any valid input are set to nodata.
+
+    Except for "median", inputs are folded into a running result one at a time,
+    so a window holds at most one input and the result whatever the number of
+    inputs. The output is written in a private scratch directory and moved into
+    place once complete.
+
+    Args:
+        raster_files (list) : Paths to the rasters, the first is the reference
+        output_file (str) : The output filepath
+        reducer (str) : One of REDUCERS: "max", "mean", "median", "count" (number
+                        of valid inputs) or "first" (first valid input in order)
+        tmp_dir (str) : Parent of the scratch directory, see scratch_dir
+        band (int) : Band of the inputs to combine
+        grid_blocks (int) : Number of windows along each axis. If None, the
+                            windows are planned with plan_windows
+        mem_budget (int) : Size of the decoded inputs of one window in bytes
+        datasets (DatasetCache) : Cache of open datasets, defaults to the cache
+                                  of the calling thread. It holds all inputs
+                                  open until the output is written, whatever
+                                  its maxsize
+        dtype (np.dtype) : Data type of the output raster
+        nodata (float) : Nodata value of the output raster
+        overviews (list) : Optional overview factors, e.g. [2, 4, 8]
+        profile_options (dict) : Extra keyword arguments of output_profile
+        cog (bool) : Whether to write a Cloud Optimized GeoTIFF
+        profiler (PipelineProfiler) : Optional profiler of the stages and windows
+
+    Returns:
+        None
+    """
+
+    assert reducer in REDUCERS, "Undefined reducer name."
+    assert len(raster_files) > 0, "No raster to reduce."
+
+    profile_options = profile_options or {}
+    profiler = profiler or PipelineProfiler(enabled=False)
+    if datasets is None:
+        datasets = get_dataset_cache()
+    with datasets.reserve(len(raster_files)):
+        _reduce_rasters(
+            raster_files,
+            output_file,
+            reducer,
+            tmp_dir,
+            band,
+            grid_blocks,
+            mem_budget,
+            datasets,
+            dtype,
+            nodata,
+            overviews,
+            profile_options,
+            cog,
+            profiler,
+        )
+
+
+def _reduce_rasters(
+    raster_files,
+    output_file,
+    reducer,
+    tmp_dir,
+    band,
+    grid_blocks,
+    mem_budget,
+    datasets,
+    dtype,
+    nodata,
+    overviews,
+    profile_options,
+    cog,
+    profiler,
+):
+    """Reduces the rasters with all inputs kept open, see reduce_rasters"""
+
+    reference = open_dataset(raster_files[0], datasets)
+    nodatas = []
+    itemsize = 0
+    for raster_file in raster_files:
+        raster = open_dataset(raster_file, datasets)
+        assert (raster.shape, raster.transform) == (
+            reference.shape,
+            reference.transform,
+        ), "Raster {} is not aligned with {}.".format(raster_file, raster_files[0])
+        nodatas.append(raster.nodata)
+        itemsize = max(itemsize, np.dtype(raster.dtypes[band - 1]).itemsize)
+
+    if grid_blocks:
+        windows = make_windows(raster_files[0], grid_blocks=grid_blocks)
+    else:
+        # One input at a time plus a float64 result and int32 counts, or all
+        # inputs stacked as float64 for the median
+        if reducer == "median":
+            pixel_bytes = 8 * len(raster_files) + 12
+        else:
+            pixel_bytes = itemsize + 12
+        windows = plan_windows(
+            raster_files[0],
+            mem_budget=mem_budget,
+            pixel_bytes=pixel_bytes,
+            align=profile_options.get("blocksize", OUTPUT_BLOCKSIZE),
+        )
+
+    out_meta = output_profile(
+        reference.meta, dtype=dtype, nodata=nodata, **profile_options
+    )
+
+    with atomic_output(output_file, tmp_dir) as scratch_file:
+        with rio.open(scratch_file, "w", **out_meta) as dst:
+            for idx, window in tqdm(enumerate(windows), total=len(windows)):
+                arrays = _read_inputs(
+                    raster_files, band, window, datasets, profiler, idx
+                )
+                with profiler.stage("reduce", idx):
+                    result = reduce_arrays(arrays, reducer, nodatas, nodata)
+                with profiler.stage("write", idx) as record:
+                    result = result.astype(dtype)
+                    dst.write(result, 1, window=window)
+                    record["bytes_written"] = result.nbytes
+
+        with profiler.stage("finish") as record:
+            finish_output(scratch_file, overviews, cog)
+            record["bytes_written"] = os.path.getsize(scratch_file)
+
+
+def _read_inputs(raster_files, band, window, datasets, profiler, idx):
+    """Reads one window of each input in turn, see reduce_rasters"""
+    for raster_file in raster_files:
+        with profiler.stage("read", idx) as record:
+            array = open_dataset(raster_file, datasets).read(band, window=window)
+            record["bytes_read"] = array.nbytes
+        yield array
+
+
+def reduce_arrays(arrays, reducer="max", nodatas=None, nodata=-1):
+    """
+    Combines arrays of the same shape element-wise, see reduce_rasters.
+
+    Args:
+        arrays (iterable) : The arrays, consumed one at a time
+        reducer (str) : One of REDUCERS
+        nodatas (list) : Nodata value of each array, None if it has none
+        nodata (float) : Value of the elements without any valid input
+
+    Returns:
+        result (np.array) : The combined array, float64 except for "count"
+    """
+
+    assert reducer in REDUCERS, "Undefined reducer name."
+
+    result = count = stack = None
+    for idx, array in enumerate(arrays):
+        values = array.astype(np.float64)
+        valid = ~np.isnan(values)
+        if nodatas is not None and nodatas[idx] is not None:
+            valid &= values != nodatas[idx]
+
+        if count is None:
+            count = np.zeros(values.shape, dtype=np.int32)
+            result = np.zeros(values.shape, dtype=np.float64)
+            if reducer == "max":
+                result.fill(-np.inf)
+            stack = []
+
+        if reducer == "max":
+            np.maximum(result, values, out=result, where=valid)
+        elif reducer == "mean":
+            np.add(result, values, out=result, where=valid)
+        elif reducer == "first":
+            np.copyto(result, values, where=valid & (count == 0))
+        elif reducer == "median":
+            values[~valid] = np.nan
+            stack.append(values)
+        count += valid
+
+    assert count is not None, "No array to reduce."
+
+    if reducer == "count":
+        return count
+    if reducer == "mean":
+        np.divide(result, count, out=result, where=count > 0)
+    elif reducer == "median":
+        stack = np.stack(stack)
+        stack[:, count == 0] = 0
+        result = np.nanmedian(stack, axis=0)
+    result[count == 0] = nodata
+
+    return result
+
+
+def get_preds_windowing(
+    area,
+    area_dict,
+    model,
+    tmp_dir,
+    best_features,
+    output,
+    grid_blocks=None,
+    threshold=0,
+    workers=1,
+    executor="thread",
+    mem_budget=WINDOW_MEM_BUDGET,
+    dtype=np.float32,
+    overviews=None,
+    profile_options=None,
+    batch_size=PREDICT_BATCH_SIZE,
+    dedupe=False,
+    cog=False,
+    profiler=None,
+):
+    """
+    Predicts the target probability of each pixel window by window and writes
+    the predictions of each window straight into the output raster. Pixels
+    whose features are all zero (nodata) are set to -1 without being passed to
+    the model, see predict_rows.
+
+    With workers > 1 the windows are read and predicted concurrently, each worker
+    holding its own open datasets. Results are collected in window order by a
+    single writer, so the output does not depend on the number of workers.
+    Thread pools suit models that release the GIL in predict_proba, process
+    pools also parallelise the pandas feature assembly. The output is written in
+    a private scratch directory and moved into place once complete.
+
+    Args:
+        area (str) : The area of interest (AOI)
+        area_dict (dict) : Python dictionary containing the file paths per area
+        model : Fitted classifier implementing predict_proba
+        tmp_dir (str) : Parent of the scratch directory, see scratch_dir
+        best_features (list) : Feature names used by the model
+        output (str) : The output filepath
+        grid_blocks (int) : Number of windows along each axis. If None, the
+                            windows are planned with plan_windows
+        threshold (float) : Probabilities below the threshold are set to 0
+        workers (int) : Number of concurrent workers
+        executor (str) : Worker pool type, "thread" or "process"
+        mem_budget (int) : Size of the decoded inputs of one window in bytes
+        dtype (np.dtype) : Data type of the output raster
+        overviews (list) : Optional overview factors, e.g. [2, 4, 8]
+        profile_options (dict) : Extra keyword arguments of output_profile
+        batch_size (int) : Maximum number of rows per predict_proba call
+        dedupe (bool) : Whether to predict identical feature vectors only once
+        cog (bool) : Whether to write a Cloud Optimized GeoTIFF
+        profiler (PipelineProfiler) : Optional profiler of the stages and windows.
+                                      Workers time their own read and predict
+                                      stages, and the records are collected here
+
+    Returns:
+        report (dict) : Number of pixels ("pixels"), of pixels with data
+                        ("pixels_valid"), of rows passed to the model
+                        ("rows_predicted"), wall time in seconds ("seconds") and
+                        "pixels_per_second", bytes decoded ("bytes_read"),
+                        bytes of the bands used as features ("bytes_used") and
+                        bytes of all bands of the area ("bytes_all_bands")
+    """
+
+    assert executor in ("thread", "process"), "Undefined executor name."
+
+    plan = compile_feature_plan(area_dict, area, best_features)
+    profile_options = profile_options or {}
+    profiler = profiler or PipelineProfiler(enabled=False)
+
+    # Read bands
+    src_file = area_dict[area]["images"][0]
+    if grid_blocks:
+        windows = make_windows(src_file, grid_blocks=grid_blocks)
+    else:
+        windows = plan_windows(
+            src_file,
+            mem_budget=mem_budget,
+            pixel_bytes=plan["pixel_bytes"]["read"],
+            align=profile_options.get("blocksize", OUTPUT_BLOCKSIZE),
+        )
+
+    out_meta = output_profile(
+        open_dataset(src_file).meta, dtype=dtype, **profile_options
+    )
+
+    state = {
+        "plan": plan,
+        "model": model,
+        "threshold": threshold,
+        "batch_size": batch_size,
+        "dedupe": dedupe,
+        "profile": profiler.enabled,
+    }
+    counts = {"pixels_valid": 0, "rows_predicted": 0}
+    start = time.perf_counter()
+
+    pool = None
+    if workers > 1 and executor == "process":
+        pool = ProcessPoolExecutor(
+            workers, initializer=_init_worker, initargs=(state,)
+        )
+        results = _imap_ordered(
+            pool, _predict_window, enumerate(windows), 2 * workers
+        )
+    else:
+        state = _attach_datasets(state)
+        predict = partial(_predict_window, state=state)
+        if workers > 1:
+            pool = ThreadPoolExecutor(workers)
+            results = _imap_ordered(pool, predict, enumerate(windows), 2 * workers)
+        else:
+            results = map(predict, enumerate(windows))
+
+    try:
+        with atomic_output(output, tmp_dir) as scratch_file:
+            with rio.open(scratch_file, "w", **out_meta) as dst:
+                pbar = tqdm(zip(windows, results), total=len(windows))
+                pbar.set_description("Processing {}...".format(area))
+                for idx, (window, result) in enumerate(pbar):
+                    out_image, n_valid, n_rows, records = result
+                    profiler.extend(records)
+                    with profiler.stage("write", idx) as record:
+                        out_image = out_image.astype(dtype)
+                        dst.write(out_image, 1, window=window)
+                        record["bytes_written"] = out_image.nbytes
+                    counts["pixels_valid"] += n_valid
+                    counts["rows_predicted"] += n_rows
+
+            with profiler.stage("finish") as record:
+                finish_output(scratch_file, overviews, cog)
+                record["bytes_written"] = os.path.getsize(scratch_file)
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+        for datasets in state.get("datasets", []):
+            datasets.close()
+
+    seconds = time.perf_counter() - start
+    pixels = sum(int(window.height) * int(window.width) for window in windows)
+    report = {"pixels": pixels}
+    report.update(counts)
+    report["seconds"] = seconds
+    report["pixels_per_second"] = pixels / seconds if seconds > 0 else None
+    for key, nbytes in plan["pixel_bytes"].items():
+        report["bytes_" + key] = pixels * nbytes
+
+    return report
+
+
+def _init_worker(state):
+    """Stores the prediction state in a worker process"""
+    global _WORKER
+    _WORKER = _attach_datasets(state)
+
+
+def _attach_datasets(state):
+    """Adds per-thread storage of open datasets to the prediction state"""
+    state = dict(state)
+    state["local"] = threading.local()
+    state["lock"] = threading.Lock()
+    state["datasets"] = []
+    return state
+
+
+def _worker_datasets(state):
+    """Returns the open datasets of the calling worker thread"""
+    local = state["local"]
+    if not hasattr(local, "datasets"):
+        local.datasets = DatasetCache()
+        with state["lock"]:
+            state["datasets"].append(local.datasets)
+    return local.datasets
+
+
+def _imap_ordered(pool, func, items, max_pending):
+    """Maps func over items with the pool, yielding results in order while
+    keeping at most max_pending tasks in flight"""
+    pending = deque()
+    for item in items:
+        pending.append(pool.submit(func, item))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def _predict_window(item, state=None):
+    """
+    Predicts the target probability of the pixels of one (index, window) item.
+    Returns the predictions along with the number of valid pixels, of predicted
+    rows and the profiler records of the window.
+    """
+    idx, window = item
+    state = state or _WORKER
+    datasets = _worker_datasets(state)
+    profiler = PipelineProfiler(enabled=state["profile"])
+
+    # Prediction
+    with profiler.stage("read", idx) as record:
+        X_test = read_features_window(state["plan"], window, datasets=datasets)
+        record["bytes_read"] = X_test.shape[0] * state["plan"]["pixel_bytes"]["read"]
+    with profiler.stage("predict", idx) as record:
+        preds, n_valid, n_rows = predict_rows(
+            state["model"],
+            X_test,
+            threshold=state["threshold"],
+            batch_size=state["batch_size"],
+            dedupe=state["dedupe"],
+        )
+        record["rows"] = n_rows
+
+    preds = preds.reshape((window.height, window.width))
+    return preds, n_valid, n_rows, profiler.records
+
+
+def predict_rows(
+    model, X, threshold=0, batch_size=PREDICT_BATCH_SIZE, dedupe=False, nodata=-1
+):
+    """
+    Predicts the target probability of the rows of a feature matrix. Rows whose
+    features are all zero are set to nodata without being predicted, and the
+    remaining rows are passed to the model in batches of at most batch_size.
+
+    Args:
+        model : Fitted classifier implementing predict_proba
+        X (np.array) : Feature matrix of shape (rows, features)
+        threshold (float) : Probabilities below the threshold are set to 0
+        batch_size (int) : Maximum number of rows per predict_proba call
+        dedupe (bool) : Whether to predict identical rows only once, which pays
+                        off when many pixels share the same feature vector
+        nodata (float) : Value of the rows without data
+
+    Returns:
+        preds (np.array) : Probability of each row
+        n_valid (int) : Number of rows with data
+        n_rows (int) : Number of rows passed to the model
+    """
+
+    valid = X.any(axis=1)
+    preds = np.full(X.shape[0], nodata, dtype=np.float64)
+    X_valid = X[valid]
+    n_valid = X_valid.shape[0]
+    if n_valid == 0:
+        return preds, 0, 0
+
+    if dedupe:
+        X_valid, inverse = np.unique(X_valid, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+
+    n_rows = X_valid.shape[0]
+    probs = np.empty(n_rows, dtype=np.float64)
+    for start in range(0, n_rows, batch_size):
+        stop = start + batch_size
+        probs[start:stop] = model.predict_proba(X_valid[start:stop])[:, 1]
+
+    if threshold > 0:
+        probs[probs < threshold] = 0
+    if dedupe:
+        probs = probs[inverse]
+
+    preds[valid] = probs
+    return preds, n_valid, n_rows
+
+
+def compile_feature_plan(area_dict, area, best_features):
+    """
+    Maps each model feature to the raster file and band it is read from, so
+    windows can be read straight into a feature matrix. Band features are
+    named B<band>_<year> and index features <index>_<year>, as produced by
+    read_bands_window and rename_ind_cols.
+
+    Args:
+        area_dict (dict) : Python dictionary containing the file paths per area
+        area (str) : The area of interest (AOI)
+        best_features (list) : Feature names used by the model, in model order
+
+    Returns:
+        plan (dict) : The feature names under "features", under "reads" a list of
+                      (file path, band indexes, feature columns) tuples, one per file,
+                      and under "pixel_bytes" the bytes per pixel decoded when reading
+                      the plan ("read"), of the feature bands alone ("used") and of
+                      all bands of the area ("all_bands")
+    """
+
+    sources = {}
+    for kind in ("images", "indices"):
+        for image_file in area_dict[area][kind]:
+            year = image_file.split("_")[-1].split(".")[0]
+            sources[(kind, year)] = image_file
+
+    reads = {}
+    for col, feature in enumerate(best_features):
+        name, year = feature.rsplit("_", 1)
+        if name in INDEX_NAMES:
+            key, band = ("indices", year), INDEX_NAMES.index(name) + 1
+        elif name == "ibi":
+            key, band = ("indices", year), IBI_BAND
+        else:
+            key, band = ("images", year), int(name.lstrip("B"))
+        assert key in sources, "No {} raster found for feature {}".format(
+            key[0], feature
+        )
+        bands, cols = reads.setdefault(sources[key], ([], []))
+        bands.append(band)
+        cols.append(col)
+
+    # Pixel interleaved files decompress every band of a block on any band read
+    pixel_bytes = {"read": 0, "used": 0, "all_bands": 0}
+    for image_file in sources.values():
+        raster = open_dataset(image_file)
+        itemsizes = [np.dtype(dtype).itemsize for dtype in raster.dtypes]
+        pixel_interleaved = raster.interleaving == Interleaving.pixel
+
+        pixel_bytes["all_bands"] += sum(itemsizes)
+        if image_file in reads:
+            bands = reads[image_file][0]
+            used = sum(itemsizes[band - 1] for band in set(bands))
+            pixel_bytes["used"] += used
+            pixel_bytes["read"] += sum(itemsizes) if pixel_interleaved else used
+
+    return {
+        "features": list(best_features),
+        "reads": [(path, bands, cols) for path, (bands, cols) in reads.items()],
+        "pixel_bytes": pixel_bytes,
+    }
+
+
+def read_features_window(plan, window, datasets=None):
+    """
+    Reads the bands listed in a feature plan into one feature matrix. Missing
+    and infinite values are replaced by 0 in place.
+
+    Args:
+        plan (dict) : Feature plan created by compile_feature_plan
+        window (Window) : The window to read
+        datasets (DatasetCache) : Cache of open datasets, defaults to the cache
+                                  of the calling thread
+
+    Returns:
+        X (np.array) : float32 array of shape (pixels, features)
+    """
+
+    X = np.empty(
+        (int(window.height) * int(window.width), len(plan["features"])),
+        dtype=np.float32,
+    )
+    for path, bands, cols in plan["reads"]:
+        raster = open_dataset(path, datasets)
+        data = read_scaled(raster, bands, window=window, out_dtype=np.float32)
+        for band, col in zip(data, cols):
+            X[:, col] = band.ravel()
+
+    return np.nan_to_num(X, copy=False, nan=0.0, posinf=0.0, neginf=0.0)
+
+
+def stitch(output_file, tmp_dir, file_list=None):
+    """
+    Merges all raster files to one
+    Source: https://gis.stackexchange.com/questions/230553/merging-all-tiles-from-one-directory-using-gdal
+
+    The script and intermediate mosaic live in a private scratch directory and
+    the output is moved into place once complete.
+
+    Args:
+        output_file (str) : The output filepath
+        tmp_dir (str) : Path to temporary directory
+        file_list (list) : Paths to the tiles to merge. If None, all tmp*.tif
+                           files in tmp_dir are merged, stale ones included
+
+    Returns:
+        result () : The stitched image
+    """
+
+    if file_list is None:
+        p = Path(tmp_dir)
+        file_list = [str(f) for f in list(p.glob("tmp*.tif"))]
+    files_string = " ".join(file_list)
+
+    with scratch_dir(tmp_dir) as job_dir:
+        merged_file = os.path.join(job_dir, "merged.tif")
+        warped_file = os.path.join(job_dir, os.path.basename(output_file))
+        script_file = os.path.join(job_dir, "stitch.sh")
+        _stitch(files_string, merged_file, warped_file, script_file)
+        finalise(warped_file, output_file)
+
+
+def _stitch(files_string, merged_file, output_file, script_file):
+    """Runs gdal_merge.py and gdalwarp through a shell script, see stitch"""
+
+    text = f"""
+
+    # set conda env for these commands - took me 3h to figure out
+    eval "$(conda shell.bash hook)"
+    conda activate /opt/conda/envs/ee
+
+    gdal_merge.py -n -1 -a_nodata -1 -o {merged_file} -of gtiff {files_string}
+    gdalwarp -co "COMPRESS=DEFLATE" -srcnodata -dstnodata {merged_file} {output_file}
+
+    """
+
+    f = open(script_file, "w")
+    f.write(text)
+    f.close()
+
+    command = "sh " + script_file
+    run_cmd(command)
+
+
+def run_cmd(command):
+    try:
+        result = subprocess.run(
+            command, shell=True, check=True, capture_output=True
+        )
+        return result
+    except subprocess.CalledProcessError as exc:
+        print(exc.stderr.decode("utf-8"))  # readable gdal error
+        raise exc
+
+
+class DatasetCache:
+    """
+    Bounded cache of open rasterio datasets keyed by file path. Once more than
+    maxsize datasets are open, the least recently used one is closed. A dataset
+    is reopened when the size, modification time or inode of its file changed
+    since it was opened, so rewritten files are not read through stale handles.
+
+    Datasets are not thread safe, so a cache must only be used from one thread.
+    Handles returned by open() should not be kept across calls to open(), as
+    they may be evicted in between.
+
+    With a band cache directory, rasters are decoded once into memory-mapped
+    files there and opened as MemmapDataset, see open_band_cache.
+
+    Args:
+        maxsize (int) : Maximum number of open datasets
+        band_cache_dir (str) : Directory of the band caches, defaults to the
+                               module setting BAND_CACHE_DIR
+    """
+
+    def __init__(self, maxsize=DATASET_CACHE_SIZE, band_cache_dir=None):
+        self.maxsize = maxsize
+        self.band_cache_dir = band_cache_dir
+        self._datasets = OrderedDict()
+
+    def open(self, path):
+        """Returns the open dataset of path, opening it if needed"""
+        signature = file_signature(path)
+        raster, opened = self._datasets.get(path, (None, None))
+        if raster is not None and not raster.closed and opened == signature:
+            self._datasets.move_to_end(path)
+            return raster
+        self.evict(path)
+
+        band_cache_dir = self.band_cache_dir or BAND_CACHE_DIR
+        if band_cache_dir:
+            raster = open_band_cache(path, band_cache_dir)
+        else:
+            raster = rio.open(path)
+        self._datasets[path] = (raster, signature)
+        self._trim()
+        return raster
+
+    @contextmanager
+    def reserve(self, size):
+        """
+        Raises maxsize to at least size for the duration of the context, e.g.
+        so that all inputs of a job read window by window stay open
+        """
+
+        maxsize = self.maxsize
+        self.maxsize = max(maxsize, size)
+        try:
+            yield self
+        finally:
+            self.maxsize = maxsize
+            self._trim()
+
+    def _trim(self):
+        """Closes the least recently used datasets beyond maxsize"""
+        while len(self._datasets) > self.maxsize:
+            _, (evicted, _) = self._datasets.popitem(last=False)
+            evicted.close()
+
+    def evict(self, path):
+        """Closes the dataset of path if it is open, e.g. before overwriting it"""
+        raster, _ = self._datasets.pop(path, (None, None))
+        if raster is not None:
+            raster.close()
+
+    def close(self):
+        """Closes all open datasets"""
+        while self._datasets:
+            _, (raster, _) = self._datasets.popitem()
+            raster.close()
+
+    def __contains__(self, path):
+        return path in self._datasets
+
+    def __len__(self):
+        return len(self._datasets)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class PipelineProfiler:
+    """
+    Opt-in profiler of the geoutils pipelines. Each stage() records its wall
+    time, the bytes read and written as set by the caller, and the peak
+    resident memory of the process during the stage, optionally per window.
+    Records can be summarised per stage and exported as JSON or CSV to compare
+    runs.
+
+    The peak of a stage is measured by resetting the peak RSS of the process
+    when the stage starts, see reset_peak_rss, which needs Linux. Stages that
+    overlap, nested or in other threads, keep their own peak across these
+    resets. Where the peak cannot be reset, "peak_rss" is the peak of the
+    process so far and the record has "peak_scope" "process" instead of "stage".
+
+    A disabled profiler, used when the entry points get profiler=None, does
+    not time anything.
+
+    Args:
+        enabled (bool) : Whether to record stages
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.records = []
+        self._start = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name, window=None, **fields):
+        """
+        Times the code of the context as one record of stage name. The yielded
+        record is a dict whose "bytes_read" and "bytes_written" the code sets.
+
+        Args:
+            name (str) : Name of the stage, e.g. "read" or "predict"
+            window (int) : Index of the window processed, if any
+            **fields : Extra values stored in the record, e.g. area or year
+
+        Yields:
+            record (dict) : The record of the stage
+        """
+
+        record = {"stage": name, "window": window, "bytes_read": 0, "bytes_written": 0}
+        record.update(fields)
+        if not self.enabled:
+            yield record
+            return
+
+        with _OPEN_STAGES_LOCK:
+            # The open stages keep the peak reached so far before it is reset
+            if _OPEN_STAGES:
+                _, peak = current_rss()
+                for open_record in _OPEN_STAGES:
+                    open_record["peak_rss"] = max(open_record["peak_rss"], peak)
+            reset = reset_peak_rss()
+            record["peak_rss"] = 0
+            _OPEN_STAGES.append(record)
+
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["start_s"] = start - self._start
+            record["seconds"] = time.perf_counter() - start
+            with _OPEN_STAGES_LOCK:
+                _OPEN_STAGES.remove(record)
+                _, peak = current_rss()
+                record["peak_rss"] = max(record["peak_rss"], peak)
+            record["peak_scope"] = "stage" if reset else "process"
+            record["pid"] = os.getpid()
+            self.records.append(record)
+
+    def extend(self, records):
+        """Adds records made elsewhere, e.g. by a worker process"""
+        if self.enabled:
+            self.records.extend(records)
+
+    def summary(self):
+        """
+        Returns the records aggregated per stage: number of records, total
+        seconds, bytes read and written, and the highest peak RSS.
+        """
+
+        stages = OrderedDict()
+        for record in self.records:
+            total = stages.setdefault(
+                record["stage"],
+                {"count": 0, "seconds": 0.0, "bytes_read": 0, "bytes_written": 0},
+            )
+            total["count"] += 1
+            for key in ("seconds", "bytes_read", "bytes_written"):
+                total[key] += record[key]
+            total["peak_rss"] = max(total.get("peak_rss", 0), record["peak_rss"])
+        return stages
+
+    def to_json(self, output_file):
+        """Writes the summary and all records to a JSON file"""
+        with open(output_file, "w") as f:
+            json.dump(
+                {"summary": self.summary(), "records": self.records},
+                f,
+                indent=1,
+                default=str,
+            )
+
+    def to_csv(self, output_file):
+        """Writes all records to a CSV file, one row per record"""
+        columns = []
+        for record in self.records:
+            columns += [key for key in record if key not in columns]
+        with open(output_file, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=columns)
+            writer.writeheader()
+            writer.writerows(self.records)
+
+
+def peak_rss():
+    """
+    Returns the peak resident set size of the process in bytes, over its
+    lifetime or, on Linux, since the last reset_peak_rss.
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def reset_peak_rss():
+    """Resets the peak RSS of the process to its current RSS, Linux only"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
 
-    return df.rename(columns=renaming)
+def current_rss():
+    """
+    Returns the current and peak RSS of the process in bytes. The peak is the
+    one since the last reset_peak_rss where /proc/self/status is available,
+    otherwise the one of peak_rss and the current RSS is None.
+    """
+    try:
+        with open("/proc/self/status") as f:
+            status = dict(line.partition(":")[::2] for line in f)
+    except OSError:
+        return None, peak_rss()
+    rss = int(status["VmRSS"].split()[0]) * 1024
+    if "VmHWM" in status:
+        return rss, int(status["VmHWM"].split()[0]) * 1024
+    return rss, peak_rss()
 
 
-def get_rasters_merged(
-    raster_file1, raster_file2, output_file, tmp_dir, grid_blocks=5
-):
-    p = Path(tmp_dir)
-    tmp_files = [str(f) for f in list(p.glob("tmp*.tif"))]
-    for f in tmp_files:
-        os.remove(f)
+class MemmapDataset:
+    """
+    Read-only stand-in for a rasterio dataset whose bands were decoded into a
+    band-sequential .npy file, see build_band_cache. read() returns views of
+    the memory map for single bands and contiguous band ranges, so repeated
+    reads of a raster cost no decompression and, once the file is in the page
+    cache, no disk I/O. The arrays returned are read-only.
 
-    windows = make_windows(raster_file1, grid_blocks=grid_blocks)
-    pbar = tqdm(enumerate(windows), total=len(windows))
+    Args:
+        data_file (str) : Path to the .npy file of shape (count, height, width)
+        record (dict) : Metadata of the source raster written by build_band_cache
+    """
 
-    for idx, window in pbar:
-        raster1 = rio.open(raster_file1).read(1, window=window)
-        raster2 = rio.open(raster_file2).read(1, window=window)
-        result = np.maximum(raster1, raster2)
+    def __init__(self, data_file, record):
+        self.name = record["source"]
+        self.data_file = data_file
+        self.record = record
+        self._data = np.load(data_file, mmap_mode="r")
+
+        self.count, self.height, self.width = self._data.shape
+        self.shape = (self.height, self.width)
+        self.indexes = tuple(range(1, self.count + 1))
+        self.dtypes = tuple([self._data.dtype.name] * self.count)
+        self.nodata = record["nodata"]
+        self.scales = tuple(record["scales"])
+        self.offsets = tuple(record["offsets"])
+        self.transform = rio.Affine(*record["transform"])
+        self.crs = rio.crs.CRS.from_wkt(record["crs"]) if record["crs"] else None
+        self.res = (abs(self.transform.a), abs(self.transform.e))
+        self.bounds = rio.coords.BoundingBox(
+            *rio.transform.array_bounds(self.height, self.width, self.transform)
+        )
+        self.block_shapes = [tuple(shape) for shape in record["block_shapes"]]
+        self.interleaving = Interleaving.band
+        self.driver = record["driver"]
+        self.closed = False
+
+    @property
+    def meta(self):
+        return {
+            "driver": self.driver,
+            "dtype": self.dtypes[0],
+            "nodata": self.nodata,
+            "width": self.width,
+            "height": self.height,
+            "count": self.count,
+            "crs": self.crs,
+            "transform": self.transform,
+        }
+
+    @property
+    def profile(self):
+        return self.meta
+
+    def read(self, indexes=None, window=None, out_dtype=None, **kwargs):
+        """
+        Reads bands like rasterio's DatasetReader.read.
+
+        Args:
+            indexes (int or list) : Band index or list of band indexes, all if None
+            window (Window) : The window to read, the whole raster if None
+            out_dtype (np.dtype) : Data type of the result, which is then a copy
+
+        Returns:
+            data (np.array) : 2D for an int index, 3D otherwise
+        """
+
+        assert not kwargs, "Unsupported read arguments: {}".format(list(kwargs))
+        if window is None:
+            rows = cols = slice(None)
+        else:
+            rows, cols = window.round_offsets().round_lengths().toslices()
+
+        if indexes is None:
+            bands = slice(None)
+        elif isinstance(indexes, int):
+            bands = indexes - 1
+        else:
+            indexes = list(indexes)
+            steps = np.diff(indexes)
+            if len(indexes) == 1 or np.all(steps == 1):
+                bands = slice(indexes[0] - 1, indexes[-1])
+            else:
+                bands = np.asarray(indexes) - 1
+
+        data = self._data[bands, rows, cols]
+        if out_dtype is not None:
+            data = data.astype(out_dtype)
+        return data
+
+    def overviews(self, bidx):
+        return []
+
+    def tags(self, bidx=0, ns=None):
+        return {}
+
+    def close(self):
+        self._data = None
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _band_cache_paths(raster_file, cache_dir):
+    """Returns the .npy and .json paths of the band cache of a raster"""
+    key = hashlib.sha1(os.path.abspath(raster_file).encode()).hexdigest()[:16]
+    stem = os.path.join(cache_dir, Path(raster_file).stem + "-" + key)
+    return stem + ".npy", stem + ".json"
+
+
+def build_band_cache(raster_file, cache_dir, mem_budget=WINDOW_MEM_BUDGET):
+    """
+    Decodes all bands of a raster window by window into a band-sequential .npy
+    file of shape (count, height, width) in cache_dir, with a JSON sidecar
+    holding the raster metadata and the size and modification time of the
+    source, which tell whether the cache is still valid.
 
-        # Save
-        image_src = raster_file1
-        tmp_file = tmp_dir + "tmp{}.tif".format(idx)
-        tfm = transform(window, transform=rio.open(image_src).transform)
-        save_predictions_window(result, image_src, tmp_file, window, tfm)
+    Args:
+        raster_file (str) : Path to the raster file
+        cache_dir (str) : Directory of the band caches
+        mem_budget (int) : Size of the decoded bands of one window in bytes
 
-    stitch(output_file, tmp_dir)
+    Returns:
+        data_file (str) : Path to the .npy file
+        record (dict) : The sidecar metadata
+    """
 
+    os.makedirs(cache_dir, exist_ok=True)
+    data_file, record_file = _band_cache_paths(raster_file, cache_dir)
+    stat = os.stat(raster_file)
 
-def get_preds_windowing(
-    area,
-    area_dict,
-    model,
-    tmp_dir,
-    best_features,
-    output,
-    grid_blocks=5,
-    threshold=0,
-):
+    with rio.open(raster_file) as src:
+        assert len(set(src.dtypes)) == 1, "Bands of {} differ in type.".format(
+            raster_file
+        )
+        record = {
+            "source": raster_file,
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "driver": src.driver,
+            "nodata": src.nodata,
+            "scales": list(src.scales),
+            "offsets": list(src.offsets),
+            "transform": list(src.transform)[:6],
+            "crs": src.crs.to_wkt() if src.crs else None,
+            "block_shapes": [list(shape) for shape in src.block_shapes],
+        }
+
+        fd, tmp_file = tempfile.mkstemp(suffix=".npy", dir=cache_dir)
+        os.close(fd)
+        try:
+            data = np.lib.format.open_memmap(
+                tmp_file,
+                mode="w+",
+                dtype=src.dtypes[0],
+                shape=(src.count, src.height, src.width),
+            )
+            for window in plan_windows(raster_file, mem_budget=mem_budget):
+                rows, cols = window.toslices()
+                data[:, rows, cols] = src.read(window=window)
+            data.flush()
+            del data
+            os.replace(tmp_file, data_file)
+        except BaseException:
+            os.remove(tmp_file)
+            raise
 
-    # Delete tmp files from previous run
-    if Path(output).is_file():
-        os.remove(output)
+    fd, tmp_file = tempfile.mkstemp(suffix=".json", dir=cache_dir)
+    with os.fdopen(fd, "w") as f:
+        json.dump(record, f, indent=1)
+    os.replace(tmp_file, record_file)
 
-    p = Path(tmp_dir)
-    tmp_files = [str(f) for f in list(p.glob("tmp*.tif"))]
-    for f in tmp_files:
-        os.remove(f)
+    return data_file, record
 
-    # Read bands
-    src_file = area_dict[area]["images"][0]
-    windows = make_windows(src_file, grid_blocks=grid_blocks)
 
-    pbar = tqdm(enumerate(windows), total=len(windows))
-    for idx, window in pbar:
-        pbar.set_description("Processing {}...".format(area))
+def open_band_cache(raster_file, cache_dir):
+    """
+    Opens the band cache of a raster as a MemmapDataset, building it first if
+    it is missing or older than the raster.
+
+    Args:
+        raster_file (str) : Path to the raster file
+        cache_dir (str) : Directory of the band caches
+
+    Returns:
+        raster (MemmapDataset) : The cached raster
+    """
+
+    os.makedirs(cache_dir, exist_ok=True)
+    data_file, record_file = _band_cache_paths(raster_file, cache_dir)
+    stat = os.stat(raster_file)
+
+    with file_lock(data_file):
+        record = load_manifest(record_file)
+        valid = os.path.isfile(data_file) and (
+            record.get("size"),
+            record.get("mtime_ns"),
+        ) == (stat.st_size, stat.st_mtime_ns)
+        if not valid:
+            data_file, record = build_band_cache(raster_file, cache_dir)
 
-        df_bands = read_bands_window(area_dict, area, window=window)
-        df_inds = read_inds_window(area_dict, area, window=window)
-        df_test = pd.concat((df_bands, df_inds), axis=1)
-        df_test = rename_ind_cols(df_test)
-        df_test = df_test.replace([np.inf, -np.inf], 0)
+    return MemmapDataset(data_file, record)
 
-        # Prediction
-        X_test = df_test[best_features].fillna(0)
-        all_zeroes = X_test.iloc[:, :-1].sum(axis=1) == 0
 
-        data = X_test
-        features = best_features
+def file_signature(path):
+    """
+    Returns the (size, modification time, inode) of a file, which changes when
+    the file is rewritten, or None for paths that are not local files.
+    """
+    try:
+        stat = os.stat(path)
+    except (OSError, ValueError):
+        return None
+    return (stat.st_size, stat.st_mtime_ns, stat.st_ino)
 
-        # Prettify Tiff
-        preds = model.predict_proba(data)[:, 1]
-        if threshold > 0:
-            preds[(preds < threshold)] = 0
 
-        preds[all_zeroes] = -1
+def get_dataset_cache():
+    """Returns the default DatasetCache of the calling thread"""
+    if not hasattr(_DATASETS, "cache"):
+        _DATASETS.cache = DatasetCache()
+    return _DATASETS.cache
 
-        # Save
-        image_src = src_file
-        output_file = tmp_dir + "tmp{}.tif".format(idx)
-        tfm = transform(window, transform=rio.open(src_file).transform)
-        save_predictions_window(preds, image_src, output_file, window, tfm)
 
-    # print('Saving to {}...'.format(output))
-    stitch(output, tmp_dir)
+def close_datasets():
+    """Closes the datasets of the default DatasetCache of the calling thread"""
+    get_dataset_cache().close()
 
 
-def stitch(output_file, tmp_dir):
+def open_dataset(path, datasets=None):
     """
-    Merges all raster files to one
-    Source: https://gis.stackexchange.com/questions/230553/merging-all-tiles-from-one-directory-using-gdal
+    Opens a raster through a DatasetCache, so repeated reads of the same file
+    reuse one handle.
 
     Args:
-        output_file (str) : The output filepath
-        tmp_dir (str) : Path to temporary directory
+        path (str) : Path to the raster file
+        datasets (DatasetCache) : Cache to use. Defaults to the cache of the
+                                  calling thread, see close_datasets
 
     Returns:
-        result () : The stitched image
+        raster (rio.DatasetReader) : The open dataset
     """
 
-    p = Path(tmp_dir)
-    file_list = [str(f) for f in list(p.glob("tmp*.tif"))]
-    files_string = " ".join(file_list)
-
-    text = f"""
-
-    # set conda env for these commands - took me 3h to figure out
-    eval "$(conda shell.bash hook)"
-    conda activate /opt/conda/envs/ee
+    if datasets is None:
+        datasets = get_dataset_cache()
+    return datasets.open(path)
 
-    gdal_merge.py -n -1 -a_nodata -1 -o merged.tif -of gtiff {files_string}
-    gdalwarp -co "COMPRESS=DEFLATE" -srcnodata -dstnodata merged.tif {output_file}
 
+def read_scaled(raster, indexes, window=None, out_dtype=None):
     """
+    Reads bands of a raster, converting bands that carry a scale or offset, such
+    as indices written with an integer dtype, back to float32 values. Their
+    nodata pixels are returned as NaN.
 
-    f = open(tmp_dir + "stitch.sh", "w")
-    f.write(text)
-    f.close()
+    Args:
+        raster (rio.DatasetReader) : The open dataset
+        indexes (int or list) : Band index or list of band indexes
+        window (Window) : The window to read
+        out_dtype (np.dtype) : Data type of unscaled bands, defaults to their own
 
-    command = "sh " + tmp_dir + "stitch.sh"
-    run_cmd(command)
+    Returns:
+        data (np.array) : The band values
+    """
 
+    data = raster.read(indexes, window=window, out_dtype=out_dtype)
+    bands = [indexes] if isinstance(indexes, int) else list(indexes)
+    scales = np.array([raster.scales[band - 1] for band in bands])
+    offsets = np.array([raster.offsets[band - 1] for band in bands])
+    if np.all(scales == 1) and np.all(offsets == 0):
+        return data
 
-def run_cmd(command):
-    try:
-        result = subprocess.run(
-            command, shell=True, check=True, capture_output=True
-        )
-        return result
-    except subprocess.CalledProcessError as exc:
-        print(exc.stderr.decode("utf-8"))  # readable gdal error
-        raise exc
+    values = data.astype(np.float32)
+    if raster.nodata is not None:
+        values[data == raster.nodata] = np.nan
+    shape = (-1,) + (1,) * (data.ndim - 1) if data.ndim == 3 else ()
+    values *= scales.astype(np.float32).reshape(shape)
+    values += offsets.astype(np.float32).reshape(shape)
+    return values
 
 
-def read_inds_window(area_dict, area, window):
+def read_inds_window(area_dict, area, window, datasets=None):
     """
     Reads the bands for each image of each area and calculates
     the derived indices.
@@ -323,6 +2021,9 @@ def read_inds_window(area_dict, area, window):
     Args:
         area_dict (dict) : Python dictionary containing the file paths per area
         area (str) : The area of interest (AOI)
+        window (Window) : The window to read
+        datasets (DatasetCache) : Cache of open datasets, defaults to the cache
+                                  of the calling thread
 
     Returns:
         data (pd.DataFrame) : The resulting pandas dataframe containing the raw spectral
@@ -338,9 +2039,9 @@ def read_inds_window(area_dict, area, window):
 
         # Read each band
         subdata = dict()
-        raster = rio.open(image_file)
+        raster = open_dataset(image_file, datasets)
         for band_idx in range(raster.count):
-            band = raster.read(band_idx + 1, window=window).ravel()
+            band = read_scaled(raster, band_idx + 1, window=window).ravel()
             subdata["I{}".format(band_idx + 1)] = band
 
         # Cast to pandas subdataframe
@@ -356,7 +2057,7 @@ def read_inds_window(area_dict, area, window):
     return data
 
 
-def read_bands_window(area_dict, area, window):
+def read_bands_window(area_dict, area, window, datasets=None):
     """
     Reads the bands for each image of each area and calculates
     the derived indices.
@@ -364,6 +2065,9 @@ def read_bands_window(area_dict, area, window):
     Args:
         area_dict (dict) : Python dictionary containing the file paths per area
         area (str) : The area of interest (AOI)
+        window (Window) : The window to read
+        datasets (DatasetCache) : Cache of open datasets, defaults to the cache
+                                  of the calling thread
 
     Returns:
         data (pd.DataFrame) : The resulting pandas dataframe containing the raw spectral
@@ -379,7 +2083,7 @@ def read_bands_window(area_dict, area, window):
 
         # Read each band
         subdata = dict()
-        raster = rio.open(image_file)
+        raster = open_dataset(image_file, datasets)
         for band_idx in range(raster.count):
             band = raster.read(band_idx + 1, window=window).ravel()
             subdata["B{}".format(band_idx + 1)] = band
@@ -397,28 +2101,27 @@ def read_bands_window(area_dict, area, window):
 
 
 def make_windows(image_file, grid_blocks=5):
-    """Make a list of windows based on bounds of an image file"""
+    """
+    Make a list of grid_blocks x grid_blocks windows based on bounds of an image
+    file. The last row and column of windows extend to the edges of the image.
+    """
 
     windows = []
-    subdata = dict()
-    raster = rio.open(image_file)
-    src_shape = raster.shape
-    height, width = int(src_shape[0] / grid_blocks), int(
-        src_shape[1] / grid_blocks
-    )
+    with rio.open(image_file) as raster:
+        src_height, src_width = raster.shape
+    height, width = int(src_height / grid_blocks), int(src_width / grid_blocks)
     grid_indices = list(
         itertools.product(range(grid_blocks), range(grid_blocks))
     )
-    grid_cnt = len(grid_indices)
 
     # Read each window
     for idx in range(len(grid_indices)):
         i, j = grid_indices[idx]
         row_start, row_stop, col_start, col_stop = (
             i * height,
-            (i + 1) * height,
+            (i + 1) * height if i < grid_blocks - 1 else src_height,
             j * width,
-            (j + 1) * width,
+            (j + 1) * width if j < grid_blocks - 1 else src_width,
         )
         w = Window.from_slices((row_start, row_stop), (col_start, col_stop))
         windows.append(w)
@@ -426,6 +2129,78 @@ def make_windows(image_file, grid_blocks=5):
     return windows
 
 
+def get_pixel_bytes(raster_files):
+    """
+    Returns the number of bytes a single pixel takes across all bands of
+    the given rasters once decoded.
+    """
+
+    nbytes = 0
+    for raster_file in raster_files:
+        with rio.open(raster_file) as raster:
+            nbytes += sum(np.dtype(dtype).itemsize for dtype in raster.dtypes)
+    return nbytes
+
+
+def plan_windows(
+    image_file, mem_budget=WINDOW_MEM_BUDGET, pixel_bytes=None, align=None
+):
+    """
+    Plans processing windows that cover the whole image, edges included, and
+    whose bounds follow the internal tile or strip layout of the file, so that
+    every compressed block is decoded by exactly one window. The window size
+    is derived from a memory budget rather than from the file size on disk,
+    with at least one aligned block per window.
+
+    Windows do not overlap and have no halo. Every operator geoutils applies
+    window by window works pixel by pixel, so windowed results match the
+    whole image at the seams.
+
+    Args:
+        image_file (str) : Path to the reference raster
+        mem_budget (int) : Size of the decoded data of one window in bytes
+        pixel_bytes (int) : Bytes per pixel of all data read per window. Defaults
+                            to all bands of image_file
+        align (int) : Optional block size windows must also align to, e.g. the
+                      tile size of the output raster
+
+    Returns:
+        windows (list) : List of rasterio Windows in row-major order
+    """
+
+    with rio.open(image_file) as raster:
+        height, width = raster.shape
+        block_h, block_w = raster.block_shapes[0]
+        if pixel_bytes is None:
+            pixel_bytes = sum(np.dtype(dtype).itemsize for dtype in raster.dtypes)
+
+    if align:
+        block_h = block_h * align // math.gcd(block_h, align)
+        if block_w < width:
+            block_w = block_w * align // math.gcd(block_w, align)
+    block_w = min(block_w, width)
+
+    # Number of blocks per window allowed by the budget
+    max_blocks = max(1, mem_budget // (pixel_bytes * block_h * block_w))
+    n_blocks_x = math.ceil(width / block_w)
+
+    if n_blocks_x == 1:
+        blocks_x = 1
+    else:
+        blocks_x = min(n_blocks_x, max(1, math.isqrt(max_blocks)))
+    blocks_y = max(1, max_blocks // blocks_x)
+
+    step_h, step_w = blocks_y * block_h, blocks_x * block_w
+    windows = []
+    for row in range(0, height, step_h):
+        for col in range(0, width, step_w):
+            windows.append(
+                Window(col, row, min(step_w, width - col), min(step_h, height - row))
+            )
+
+    return windows
+
+
 def ndvi(b):
     return (b["B8"] - b["B4"]) / (b["B8"] + b["B4"])
 
@@ -466,11 +2241,100 @@ def baei(b):
     return (b["B4"] + 0.3) / (b["B3"] + b["B11"])
 
 
+def index_dtype(band_dtype):
+    """
+    Returns the data type used for the derived indices of bands of type band_dtype:
+    the band type if it is floating, float64 otherwise. Integer bands are not used
+    as is, since their differences would wrap around.
+    """
+    if np.issubdtype(band_dtype, np.floating):
+        return np.dtype(band_dtype)
+    return np.dtype(np.float64)
+
+
+def compute_indices(bands, out=None, dtype=np.float32):
+    """
+    Calculates all derived indices in a single pass over the bands.
+
+    Equivalent to stacking ndvi(), ndbi(), ..., baei() in INDEX_NAMES order, but
+    every index is written straight into a preallocated output buffer and the
+    shared sub-expressions (B11+B9, B9+B4, B3+B11, B12/B3) are computed once.
+    Scratch memory is two window-sized buffers, plus a converted copy of each of
+    the eight bands used when the bands are not already of type dtype, e.g. for
+    integer rasters.
+
+    Args:
+        bands (np.array or dict) : Array of shape (count, ...) with the spectral bands
+                                   in band order, or a dict with "B1" ... "B12" keys
+        out (np.array) : Optional preallocated output of shape (10, ...) and type dtype
+        dtype (np.dtype) : Data type used for the computation and the output
+
+    Returns:
+        out (np.array) : Array of shape (10, ...) containing the derived indices
+    """
+
+    def band(n):
+        if isinstance(bands, dict):
+            return np.asarray(bands[f"B{n}"], dtype=dtype)
+        return np.asarray(bands[n - 1], dtype=dtype)
+
+    b3, b4, b5, b7, b8, b9, b11, b12 = [band(n) for n in (3, 4, 5, 7, 8, 9, 11, 12)]
+
+    if out is None:
+        out = np.empty((len(INDEX_NAMES),) + b4.shape, dtype=dtype)
+    t1 = np.empty(b4.shape, dtype=dtype)
+    t2 = np.empty(b4.shape, dtype=dtype)
+
+    (o_ndvi, o_ndbi, o_savi, o_mndwi, o_ui, o_nbi, o_brba, o_nbai, o_mbi, o_baei) = out
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # ndvi, ui
+        np.subtract(b8, b4, out=o_ndvi)
+        np.divide(o_ndvi, np.add(b8, b4, out=t1), out=o_ndvi)
+        np.subtract(b7, b5, out=o_ui)
+        np.divide(o_ui, np.add(b7, b5, out=t1), out=o_ui)
+
+        # ndbi: B11+B9
+        np.subtract(b11, b9, out=o_ndbi)
+        np.divide(o_ndbi, np.add(b11, b9, out=t1), out=o_ndbi)
+
+        # savi, mbi: B9+B4
+        np.add(b9, b4, out=t2)
+        np.subtract(b9, b4, out=o_savi)
+        np.multiply(o_savi, 1.5, out=o_savi)
+        np.divide(o_savi, np.add(t2, 0.5, out=t1), out=o_savi)
+        np.multiply(b12, b4, out=o_mbi)
+        np.subtract(o_mbi, np.multiply(b9, b9, out=t1), out=o_mbi)
+        np.divide(o_mbi, np.add(t2, b12, out=t1), out=o_mbi)
+
+        # mndwi, baei: B3+B11
+        np.add(b3, b11, out=t2)
+        np.subtract(b3, b11, out=o_mndwi)
+        np.divide(o_mndwi, t2, out=o_mndwi)
+        np.add(b4, 0.3, out=o_baei)
+        np.divide(o_baei, t2, out=o_baei)
+
+        # nbi, brba
+        np.multiply(b4, b11, out=o_nbi)
+        np.divide(o_nbi, b9, out=o_nbi)
+        np.divide(b4, b11, out=o_brba)
+
+        # nbai: B12/B3
+        np.divide(b12, b3, out=t1)
+        np.subtract(b11, t1, out=o_nbai)
+        np.divide(o_nbai, np.add(b11, t1, out=t2), out=o_nbai)
+
+    return out
+
+
 def ibi(b):
     """
     Calculates the index-based building index (IBI).
     Source: https://stats.stackexchange.com/questions/178626/how-to-normalize-data-between-1-and-1
 
+    The whole arrays are used for the normalisation ranges and the outlier
+    cutoffs, see ibi_stats and ibi_window for rasters that do not fit in memory.
+
     Args:
         area_dict (dict or pd.DataFrame) : A Python dictionary or Python DataFrame containing
                                            the 12 band values
@@ -481,7 +2345,7 @@ def ibi(b):
     """
 
     # Threshold
-    t = 0.05
+    t = IBI_THRESHOLD
 
     # Normalize to (-1,1)
     ndbi_t, savi_t, mndwi_t = (
@@ -489,16 +2353,11 @@ def ibi(b):
         b["savi"],
         b["mndwi"],
     )  # ndbi(), savi(), mndwi()
-    ndbi_n = 2 * (ndbi_t - ndbi_t.min()) / (ndbi_t.max() - ndbi_t.min()) - 1
-    savi_n = 2 * (savi_t - savi_t.min()) / (savi_t.max() - savi_t.min()) - 1
-    mndwi_n = (
-        2 * (mndwi_t - mndwi_t.min()) / (mndwi_t.max() - mndwi_t.min()) - 1
-    )
+    ranges = [[x.min(), x.max()] for x in (ndbi_t, savi_t, mndwi_t)]
+    temp = _ibi_raw(ndbi_t, savi_t, mndwi_t, ranges)
 
     # Remove outliers
-    temp = (ndbi_n - (savi_n + mndwi_n) / 2) / (ndbi_n + (savi_n + mndwi_n) / 2)
-    vv = pd.DataFrame({"col": temp.reshape(-1, 1)[:, 0]})
-    cutoffs = list(vv["col"].quantile([t / 2, 1 - t / 2]))
+    cutoffs = list(np.nanquantile(temp, [t / 2, 1 - t / 2]))
 
     temp[temp <= cutoffs[0]] = cutoffs[0]
     temp[temp >= cutoffs[1]] = cutoffs[1]
@@ -506,50 +2365,148 @@ def ibi(b):
     return temp
 
 
-def save_predictions(pred, image_src, output_file):
+def _ibi_raw(ndbi_t, savi_t, mndwi_t, ranges):
+    """IBI before outlier clipping, with the (min, max) ranges of its inputs"""
+    ndbi_n, savi_n, mndwi_n = [
+        2 * (x - lo) / (hi - lo) - 1
+        for x, (lo, hi) in zip((ndbi_t, savi_t, mndwi_t), ranges)
+    ]
+    return (ndbi_n - (savi_n + mndwi_n) / 2) / (ndbi_n + (savi_n + mndwi_n) / 2)
+
+
+def ibi_stats(
+    image_file,
+    windows,
+    t=IBI_THRESHOLD,
+    sample_size=IBI_SAMPLE_SIZE,
+    dtype=np.float32,
+    seed=0,
+):
+    """
+    Estimates the statistics of the IBI of a raster in one pass over its windows.
+
+    The min and max of ndbi, savi and mndwi are exact. The outlier cutoffs are
+    quantiles of a uniform sample of at most sample_size pixels, drawn by keeping
+    the pixels with the smallest random keys, and are exact when the raster has
+    no more finite pixels than that. Only bands 3, 4, 9 and 11 are read.
+
+    Args:
+        image_file (str) : Path to the raster with the spectral bands
+        windows (list) : Windows covering the raster
+        t (float) : Share of the values clipped as outliers, half at each end
+        sample_size (int) : Maximum number of pixels sampled
+        dtype (np.dtype) : Data type used for the computation
+        seed (int) : Seed of the sampling
+
+    Returns:
+        stats (dict) : The "ranges" of ndbi, savi and mndwi and the "cutoffs",
+                       keyword arguments of ibi_window
+    """
+
+    rng = np.random.default_rng(seed)
+    ranges = np.array([[np.inf, -np.inf]] * 3)
+    sample = np.empty((3, 0), dtype=dtype)
+    keys = np.empty(0)
+
+    with rio.open(image_file) as image:
+        for window in windows:
+            bands = image.read([3, 4, 9, 11], window=window).astype(dtype)
+            b = dict(zip(["B3", "B4", "B9", "B11"], bands))
+            with np.errstate(divide="ignore", invalid="ignore"):
+                values = np.stack([ndbi(b), savi(b), mndwi(b)]).reshape(3, -1)
+            values = values[:, np.isfinite(values).all(axis=0)]
+            if values.shape[1] == 0:
+                continue
+
+            ranges[:, 0] = np.minimum(ranges[:, 0], values.min(axis=1))
+            ranges[:, 1] = np.maximum(ranges[:, 1], values.max(axis=1))
+
+            # Bottom-k sampling: a uniform sample of all pixels seen so far
+            keys = np.concatenate([keys, rng.random(values.shape[1])])
+            sample = np.concatenate([sample, values], axis=1)
+            if keys.size > sample_size:
+                keep = np.argpartition(keys, sample_size)[:sample_size]
+                keys, sample = keys[keep], sample[:, keep]
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        temp = _ibi_raw(*sample, ranges.astype(dtype))
+    cutoffs = np.nanquantile(temp[np.isfinite(temp)], [t / 2, 1 - t / 2])
+
+    return {"ranges": ranges.tolist(), "cutoffs": cutoffs.tolist()}
+
+
+def ibi_window(ndbi_t, savi_t, mndwi_t, ranges, cutoffs):
+    """
+    Calculates the IBI of a window from raster-wide statistics.
+
+    Args:
+        ndbi_t, savi_t, mndwi_t (np.array) : The indices of the window
+        ranges (list) : (min, max) of ndbi, savi and mndwi, see ibi_stats
+        cutoffs (list) : Lower and upper outlier cutoffs, see ibi_stats
+
+    Returns:
+        temp (np.array) : The IBI of the window
+    """
+
+    dtype = np.result_type(ndbi_t)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        temp = _ibi_raw(ndbi_t, savi_t, mndwi_t, np.asarray(ranges, dtype=dtype))
+
+    lo, hi = np.asarray(cutoffs, dtype=dtype)
+    temp[temp <= lo] = lo
+    temp[temp >= hi] = hi
+
+    return temp
+
+
+def save_predictions(pred, image_src, output_file, dtype=np.float32, **profile_options):
     """
     Saves the predictions as a TIFF file, based on a reference (source) image.
 
     Args:
         pred (numpy array) : The array containing the predictions
         image_src (str) : Path to the source image to be used as a reference file
+        dtype (np.dtype) : Data type of the output raster
+        profile_options : Extra keyword arguments of output_profile
 
     Returns:
         None
     """
 
+    get_dataset_cache().evict(output_file)
     with rio.open(image_src) as src:
         out_image = np.array(pred).reshape((src.height, src.width))
-        out_meta = src.meta
-
-        out_meta.update(
-            {
-                "driver": "GTiff",
-                "height": src.height,
-                "width": src.width,
-                "count": 1,
-                "nodata": -1,
-                "dtype": np.float64,
-            }
-        )
+        out_meta = output_profile(src.meta, dtype=dtype, **profile_options)
 
-        with rio.open(output_file, "w", **out_meta, compress="deflate") as dest:
-            dest.write(out_image, 1)
+        with rio.open(output_file, "w", **out_meta) as dest:
+            dest.write(out_image.astype(dtype), 1)
 
 
-def read_bands(area_dict, area):
+def read_bands(area_dict, area, datasets=None, backend="pandas"):
     """
     Reads the bands for each image of each area and calculates the derived indices.
+    The indices are computed in the band type for floating bands and in float64
+    for integer bands, see index_dtype.
+
+    With backend="arrow" the columns are assembled into a pyarrow Table without
+    copying the band arrays, see arrow_table.
 
     Args:
         area_dict (dict) : Python dictionary containing the file paths per area
         area (str) : The area of interest (AOI)
+        datasets (DatasetCache) : Cache of open datasets, defaults to the cache
+                                  of the calling thread
+        backend (str) : "pandas" or "arrow"
 
     Returns:
-        data (pd.DataFrame) : The resulting pandas dataframe containing the raw spectral
-                              bands and derived indices
+        data (pd.DataFrame or pa.Table) : The resulting pandas dataframe containing the
+                                          raw spectral bands and derived indices
     """
 
+    assert backend in ("pandas", "arrow"), "Undefined backend name."
+    if backend == "arrow":
+        return arrow_table(_read_band_columns(area_dict, area, datasets))
+
     data = []
     image_list = area_dict[area]["images"]
 
@@ -559,22 +2516,15 @@ def read_bands(area_dict, area):
 
         # Read each band
         subdata = dict()
-        raster = rio.open(image_file)
+        raster = open_dataset(image_file, datasets)
         for band_idx in range(raster.count):
             band = raster.read(band_idx + 1).ravel()
             subdata["B{}".format(band_idx + 1)] = band
 
         # Get derived indices
-        subdata["ndvi"] = ndvi(subdata)
-        subdata["ndbi"] = ndbi(subdata)
-        subdata["savi"] = savi(subdata)
-        subdata["mndwi"] = mndwi(subdata)
-        subdata["ui"] = ui(subdata)
-        subdata["nbi"] = nbi(subdata)
-        subdata["brba"] = brba(subdata)
-        subdata["nbai"] = nbai(subdata)
-        subdata["mbi"] = mbi(subdata)
-        subdata["baei"] = baei(subdata)
+        indices = compute_indices(subdata, dtype=index_dtype(band.dtype))
+        for name, index in zip(INDEX_NAMES, indices):
+            subdata[name] = index
 
         # Cast to pandas subdataframe
         subdata = pd.DataFrame(subdata).fillna(0)
@@ -590,65 +2540,420 @@ def read_bands(area_dict, area):
     return data
 
 
-def generate_training_data(area_dict):
+def _read_band_columns(area_dict, area, datasets=None, pixels=None):
+    """
+    Returns the (name, year, values) columns of the bands and derived indices of
+    each image of an area, optionally for the given flat pixel positions only.
+    Missing values are set to 0, copying the band arrays only if they have any.
+    """
+
+    columns = []
+    for image_file in area_dict[area]["images"]:
+        year = image_file.split("_")[-1].split(".")[0]
+        raster = open_dataset(image_file, datasets)
+
+        bands = []
+        for band_idx in range(raster.count):
+            band = raster.read(band_idx + 1).ravel()
+            if pixels is not None:
+                band = band[pixels]
+            if np.issubdtype(band.dtype, np.floating) and np.isnan(band).any():
+                band = np.where(np.isnan(band), 0, band).astype(band.dtype)
+            bands.append(band)
+            columns.append(("B{}".format(band_idx + 1), year, band))
+
+        b = {"B{}".format(band_idx + 1): band for band_idx, band in enumerate(bands)}
+        indices = compute_indices(b, dtype=index_dtype(bands[0].dtype))
+        np.copyto(indices, 0, where=np.isnan(indices))
+        for name, index in zip(INDEX_NAMES, indices):
+            columns.append((name, year, index))
+
+    return columns
+
+
+def arrow_table(columns, extra=None):
+    """
+    Assembles feature columns into a pyarrow Table. Contiguous numpy arrays are
+    wrapped without copying. Each feature field is named "<feature>_<year>",
+    as the pandas columns, and carries {"feature": ..., "year": ...} metadata,
+    see feature_fields. The table converts to polars with pl.from_arrow.
+
+    Args:
+        columns (list) : (feature, year, values) of the feature columns
+        extra (list) : (name, values) of other columns, e.g. the target
+
+    Returns:
+        table (pa.Table) : The table
+    """
+
+    import pyarrow as pa
+
+    fields, arrays = [], []
+    for feature, year, values in columns:
+        array = pa.array(np.ascontiguousarray(values))
+        metadata = {"feature": feature, "year": str(year)}
+        name = "{}_{}".format(feature, year)
+        fields.append(pa.field(name, array.type, metadata=metadata))
+        arrays.append(array)
+    for name, values in extra or []:
+        array = pa.array(np.ascontiguousarray(values))
+        fields.append(pa.field(name, array.type))
+        arrays.append(array)
+
+    return pa.Table.from_arrays(arrays, schema=pa.schema(fields))
+
+
+def feature_fields(table, features=None, years=None):
+    """
+    Returns the names of the feature columns of an Arrow table, selected by
+    their field metadata rather than by parsing the column names.
+
+    Args:
+        table (pa.Table) : Table created by arrow_table
+        features (list) : Features to keep, e.g. ["B4", "ndvi"], all if None
+        years (list) : Years to keep, all if None
+
+    Returns:
+        names (list) : Names of the matching columns, in table order
+    """
+
+    years = None if years is None else {str(year) for year in years}
+    names = []
+    for field in table.schema:
+        metadata = field.metadata or {}
+        feature = metadata.get(b"feature")
+        if feature is None:
+            continue
+        if features is not None and feature.decode() not in features:
+            continue
+        if years is not None and metadata[b"year"].decode() not in years:
+            continue
+        names.append(field.name)
+    return names
+
+
+def _keep_rows(columns, target):
+    """
+    Returns the positions of the rows with a label and a non-zero feature sum,
+    summed like the pandas path of generate_training_data.
+    """
+    values = np.stack([values for _, _, values in columns], axis=1)
+    return np.flatnonzero((values.sum(axis=1) != 0) & (target != 0))
+
+
+def generate_training_data(
+    area_dict,
+    streaming=False,
+    mem_budget=WINDOW_MEM_BUDGET,
+    profiler=None,
+    backend="pandas",
+):
     """
     Generates training data consisting of pixels as data points. The script obtains the
     raw spectrals bands and calculates the derived indices for each year (2016-2020)
     for each area. The resulting dataframe also contains a column containing the target
     label and a column indicating the area of each pixel.
 
+    With streaming=True, the labelled pixels are located in the mask rasters
+    first and only the windows containing them are read, see iter_training_data.
+    The result is the same, but peak memory scales with the training data rather
+    than with the area rasters. All paths compute the indices in the type given
+    by index_dtype, so integer bands give the same float64 indices in each.
+
+    With backend="arrow" the result is a pyarrow Table with the same columns plus
+    a "pixel" column in place of the index, see arrow_table.
+
     Args:
         area_dict (dict) : Python dictionary containing the file paths per area
+        streaming (bool) : Whether to read the labelled windows only
+        mem_budget (int) : Size of the decoded bands of one window in bytes
+        profiler (PipelineProfiler) : Optional profiler of the stages and windows
+        backend (str) : "pandas" or "arrow"
 
     Returns:
-        data (pd.DataFrame) : The resulting pandas dataframe containing the training data
+        data (pd.DataFrame or pa.Table) : The resulting training data
         area_code (dict) : A Python dictionary containing the numerical codes for each area
                            e.g. {'maicao': 0, 'riohacha': 1, 'uribia': 2}
     """
 
+    assert backend in ("pandas", "arrow"), "Undefined backend name."
+    profiler = profiler or PipelineProfiler(enabled=False)
+
+    if backend == "arrow":
+        return _training_table(area_dict, streaming, mem_budget, profiler)
+
+    if streaming:
+        area_code = {area: idx for idx, area in enumerate(area_dict)}
+        data = iter_training_data(area_dict, mem_budget=mem_budget, profiler=profiler)
+        data = pd.concat(data)
+        with profiler.stage("concat"):
+            data = data.rename_axis("pixel").sort_values(["area", "pixel"])
+        return data.rename_axis(None), area_code
+
     data = []
     area_code = {}
 
     for idx, area in enumerate(area_dict):
         print("Reading {}...".format(area))
 
-        # Read positive target mask
-        pos = rio.open(area_dict[area]["pos_mask_tiff"])
-        pos_mask = pos.read(1).ravel()
-        pos_grid = pos.read(2).ravel()
+        with profiler.stage("read_masks", area=area) as record:
+            # Read positive target mask
+            pos = rio.open(area_dict[area]["pos_mask_tiff"])
+            pos_mask = pos.read(1).ravel()
+            pos_grid = pos.read(2).ravel()
 
-        # Read negative mask
-        neg = rio.open(area_dict[area]["neg_mask_tiff"])
-        neg_mask = neg.read(1).ravel()
-        neg_grid = neg.read(2).ravel()
+            # Read negative mask
+            neg = rio.open(area_dict[area]["neg_mask_tiff"])
+            neg_mask = neg.read(1).ravel()
+            neg_grid = neg.read(2).ravel()
 
-        # Get sum of postive and negative mask
-        mask = pos_mask + neg_mask
-        grid = pos_grid + neg_grid
+            # Get sum of postive and negative mask
+            mask = pos_mask + neg_mask
+            grid = pos_grid + neg_grid
+            record["bytes_read"] = 2 * (pos_mask.nbytes + neg_mask.nbytes)
 
         # Read bands
-        subdata = read_bands(area_dict, area)
+        with profiler.stage("read_bands", area=area) as record:
+            subdata = read_bands(area_dict, area)
+            record["bytes_read"] = get_pixel_bytes(
+                area_dict[area]["images"]
+            ) * len(mask)
         subdata["target"] = mask
         subdata["uid"] = grid
         subdata["area"] = idx
         area_code[area] = idx
 
         # Get non-zero rows
-        subdata = subdata[subdata.iloc[:, :-3].values.sum(axis=1) != 0]
-        subdata = subdata[subdata["target"] != 0]
+        with profiler.stage("filter", area=area):
+            subdata = subdata[subdata.iloc[:, :-3].values.sum(axis=1) != 0]
+            subdata = subdata[subdata["target"] != 0]
         data.append(subdata)
 
     # Concatenate all areas
-    data = pd.concat(data)
+    with profiler.stage("concat"):
+        data = pd.concat(data)
+
+    return data, area_code
+
+
+def _training_table(area_dict, streaming, mem_budget, profiler):
+    """Arrow backend of generate_training_data"""
+
+    import pyarrow as pa
+
+    area_code = {area: idx for idx, area in enumerate(area_dict)}
+    if streaming:
+        tables = iter_training_data(
+            area_dict, mem_budget=mem_budget, profiler=profiler, backend="arrow"
+        )
+    else:
+        tables = []
+        for idx, area in enumerate(area_dict):
+            print("Reading {}...".format(area))
+
+            with profiler.stage("read_masks", area=area):
+                pos = rio.open(area_dict[area]["pos_mask_tiff"]).read([1, 2])
+                neg = rio.open(area_dict[area]["neg_mask_tiff"]).read([1, 2])
+                target = (pos[0] + neg[0]).ravel()
+                grid = (pos[1] + neg[1]).ravel()
+
+            # Only the labelled pixels are kept from the bands
+            with profiler.stage("read_bands", area=area):
+                labelled = np.flatnonzero(target)
+                columns = _read_band_columns(area_dict, area, pixels=labelled)
+            with profiler.stage("filter", area=area):
+                keep = _keep_rows(columns, target[labelled])
+                pixels = labelled[keep]
+                columns = [(name, year, values[keep]) for name, year, values in columns]
+                extra = [
+                    ("target", target[pixels]),
+                    ("uid", grid[pixels]),
+                    ("area", np.full(len(pixels), idx, dtype=np.int64)),
+                    ("pixel", pixels.astype(np.int64)),
+                ]
+                tables.append(arrow_table(columns, extra))
+
+    with profiler.stage("concat"):
+        data = pa.concat_tables(list(tables), promote_options="default")
+        if streaming:
+            data = data.sort_by([("area", "ascending"), ("pixel", "ascending")])
 
     return data, area_code
 
 
+def iter_training_data(
+    area_dict,
+    mem_budget=WINDOW_MEM_BUDGET,
+    datasets=None,
+    profiler=None,
+    backend="pandas",
+):
+    """
+    Streams the training data of generate_training_data window by window. The
+    positive and negative mask rasters are read first and the bands are only
+    read for windows containing labelled pixels, and only kept for those pixels.
+
+    Args:
+        area_dict (dict) : Python dictionary containing the file paths per area
+        mem_budget (int) : Size of the decoded bands of one window in bytes
+        datasets (DatasetCache) : Cache of open datasets, defaults to the cache
+                                  of the calling thread
+        profiler (PipelineProfiler) : Optional profiler of the stages and windows
+        backend (str) : "pandas" or "arrow"
+
+    Yields:
+        data (pd.DataFrame or pa.Table) : The training data of one window, indexed by
+                                          the position of each pixel in its area raster,
+                                          or with this position as "pixel" column
+    """
+
+    assert backend in ("pandas", "arrow"), "Undefined backend name."
+    profiler = profiler or PipelineProfiler(enabled=False)
+
+    for idx, area in enumerate(area_dict):
+        print("Reading {}...".format(area))
+        pos_file = area_dict[area]["pos_mask_tiff"]
+        neg_file = area_dict[area]["neg_mask_tiff"]
+        image_list = area_dict[area]["images"]
+
+        width = open_dataset(pos_file, datasets).width
+        windows = plan_windows(
+            pos_file,
+            mem_budget=mem_budget,
+            pixel_bytes=get_pixel_bytes(image_list),
+        )
+
+        for w_idx, window in enumerate(windows):
+            # Locate labelled pixels
+            with profiler.stage("read_masks", w_idx, area=area) as record:
+                pos = open_dataset(pos_file, datasets).read([1, 2], window=window)
+                neg = open_dataset(neg_file, datasets).read([1, 2], window=window)
+                record["bytes_read"] = pos.nbytes + neg.nbytes
+            mask = pos[0] + neg[0]
+            labelled = mask != 0
+            if not labelled.any():
+                continue
+
+            rows, cols = np.nonzero(labelled)
+            pixels = (rows + window.row_off) * width + cols + window.col_off
+
+            # Read bands of the labelled pixels
+            subdata = dict()
+            columns = []
+            for image_file in image_list:
+                year = image_file.split("_")[-1].split(".")[0]
+                with profiler.stage("read_bands", w_idx, area=area) as record:
+                    bands = open_dataset(image_file, datasets).read(window=window)
+                    record["bytes_read"] = bands.nbytes
+                bands = bands[:, labelled]
+                with profiler.stage("compute", w_idx, area=area):
+                    indices = compute_indices(bands, dtype=index_dtype(bands.dtype))
+
+                for band_idx, band in enumerate(bands):
+                    subdata["B{}_{}".format(band_idx + 1, year)] = band
+                    columns.append(("B{}".format(band_idx + 1), year, band))
+                for name, index in zip(INDEX_NAMES, indices):
+                    subdata["{}_{}".format(name, year)] = index
+                    columns.append((name, year, index))
+
+            if backend == "arrow":
+                with profiler.stage("frame", w_idx, area=area):
+                    for _, _, values in columns:
+                        np.copyto(values, 0, where=np.isnan(values))
+                    target = mask[labelled]
+                    keep = _keep_rows(columns, target)
+                    columns = [(name, year, v[keep]) for name, year, v in columns]
+                    extra = [
+                        ("target", target[keep]),
+                        ("uid", (pos[1] + neg[1])[labelled][keep]),
+                        ("area", np.full(len(keep), idx, dtype=np.int64)),
+                        ("pixel", pixels[keep].astype(np.int64)),
+                    ]
+                    table = arrow_table(columns, extra)
+                if table.num_rows:
+                    yield table
+                continue
+
+            with profiler.stage("frame", w_idx, area=area):
+                subdata = pd.DataFrame(subdata, index=pixels).fillna(0)
+                subdata["target"] = mask[labelled]
+                subdata["uid"] = (pos[1] + neg[1])[labelled]
+                subdata["area"] = idx
+
+                # Get non-zero rows
+                subdata = subdata[subdata.iloc[:, :-3].values.sum(axis=1) != 0]
+            if len(subdata):
+                yield subdata
+
+
+def write_training_data(
+    area_dict, output_file, mem_budget=WINDOW_MEM_BUDGET, datasets=None
+):
+    """
+    Writes the training data of generate_training_data to a Parquet file
+    incrementally, one window at a time, so it can spill tables larger than
+    memory. The file has the schema of the arrow backend, with the (feature,
+    year) metadata of each field and a "pixel" column.
+
+    Args:
+        area_dict (dict) : Python dictionary containing the file paths per area
+        output_file (str) : Path to the output Parquet file
+        mem_budget (int) : Size of the decoded bands of one window in bytes
+        datasets (DatasetCache) : Cache of open datasets, defaults to the cache
+                                  of the calling thread
+
+    Returns:
+        area_code (dict) : A Python dictionary containing the numerical codes for each area
+    """
+
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    # Areas may cover different years, use the union of their fields
+    fields = OrderedDict()
+    for area in area_dict:
+        for image_file in area_dict[area]["images"]:
+            year = image_file.split("_")[-1].split(".")[0]
+            raster = open_dataset(image_file, datasets)
+            names = ["B{}".format(band + 1) for band in range(raster.count)]
+            band_type = pa.from_numpy_dtype(np.dtype(raster.dtypes[0]))
+            if pa.types.is_floating(band_type):
+                index_type = band_type
+            else:
+                index_type = pa.float64()
+            for name in names + INDEX_NAMES:
+                column = "{}_{}".format(name, year)
+                value_type = index_type if name in INDEX_NAMES else band_type
+                metadata = {"feature": name, "year": year}
+                field = pa.field(column, value_type, metadata=metadata)
+                fields.setdefault(column, field)
+    fields["target"] = pa.field("target", pa.uint16())
+    fields["uid"] = pa.field("uid", pa.uint16())
+    fields["area"] = pa.field("area", pa.int64())
+    fields["pixel"] = pa.field("pixel", pa.int64())
+    schema = pa.schema(list(fields.values()))
+
+    with pq.ParquetWriter(output_file, schema) as writer:
+        for chunk in iter_training_data(
+            area_dict, mem_budget, datasets, backend="arrow"
+        ):
+            arrays = []
+            for field in schema:
+                if field.name in chunk.column_names:
+                    arrays.append(chunk.column(field.name).cast(field.type))
+                else:
+                    arrays.append(pa.nulls(chunk.num_rows, field.type))
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+
+    return {area: idx for idx, area in enumerate(area_dict)}
+
+
 def get_filepaths(
     areas, images_dir, indices_dir, pos_mask_dir="", neg_mask_dir=""
 ):
     """
     Returns a dictionary containing the image filepaths for each area.
+    Dot-prefixed files are skipped.
 
     Args:
         areas (list) : Python list of strings of the areas of interests (AOIs)
@@ -671,12 +2976,14 @@ def get_filepaths(
 
         image_files, indices_files = [], []
 
+        # Dot-prefixed files such as the index manifest, its lock and the
+        # partial outputs are not rasters of the area
         for image_file in os.listdir(images_dir):
-            if area in image_file:
+            if area in image_file and not image_file.startswith("."):
                 image_files.append(images_dir + image_file)
 
         for image_file in os.listdir(indices_dir):
-            if area in image_file:
+            if area in image_file and not image_file.startswith("."):
                 indices_files.append(indices_dir + image_file)
 
         area_dict[area]["images"] = sorted(image_files)
@@ -700,7 +3007,7 @@ def explode(gdf):
                                  and two new columns: level_0 and level_1
     """
 
-    gs = gdf.explode()
+    gs = gdf.geometry.explode(index_parts=True)
     gdf2 = gs.reset_index().rename(columns={0: "geometry"})
     if "class" in gdf2.columns:
         gdf2 = gdf2.drop("class", axis=1)
@@ -713,23 +3020,45 @@ def explode(gdf):
     return gdf_out
 
 
-def generate_mask(tiff_file, shape_file, output_file, plot=False):
+def read_mask_shapes(shape_file):
+    """
+    Reads the label geometries of a vector file as single-part features, in the
+    order in which generate_mask numbers them.
+
+    Args:
+        shape_file (str) : Path to shapefile
+
+    Returns:
+        gdf (gpd.GeoDataFrame) : The exploded features
+    """
+    return explode(gpd.read_file(shape_file).dropna())
+
+
+def generate_mask(
+    tiff_file, shape_file, output_file, plot=False, grid_start=1, shapes=None
+):
     """
     Generates a segmentation mask for one TIFF image.
 
+    The geometries are burned once as feature numbers, from which the class mask
+    (band 1) and the grid IDs (band 2) are derived by lookup. Grid IDs run from
+    grid_start to grid_start + len(shapes) - 1. Callers building several masks
+    pass a running offset to keep IDs unique, see get_pos_raster_mask.
+
     Args:
         tiff_file (str) : Path to reference TIFF file
         shape_file (str) : Path to shapefile
         output_file (str) : Path to output file
+        grid_start (int) : First grid ID
+        shapes (gpd.GeoDataFrame) : Features of shape_file if already read with
+                                    read_mask_shapes
 
     Returns:
         image (np.array) : A binary mask as a numpy array
     """
-    global GRID_ID
 
-    src = rio.open(tiff_file)
-    raw = gpd.read_file(shape_file).dropna()
-    gdf = explode(raw)
+    src = open_dataset(tiff_file)
+    gdf = read_mask_shapes(shape_file) if shapes is None else shapes
 
     values = {}
 
@@ -738,28 +3067,24 @@ def generate_mask(tiff_file, shape_file, output_file, plot=False):
         values = {value: x + 2 for x, value in enumerate(unique_classes)}
         values["Informal settlement"] = 1
 
-    value = 1.0
-    masks, grids = [], []
-    for index, (idx, x) in enumerate(gdf.iterrows()):
-        if "class" in x:
-            value = values[x["class"]]
-        gdf_json = json.loads(gpd.GeoDataFrame(x).T.to_json())
-        feature = [gdf_json["features"][0]["geometry"]][0]
-        masks.append((feature, value))
-        grids.append((feature, GRID_ID))
-        GRID_ID += 1
-
-    masks = rio.features.rasterize(
-        ((g, v) for (g, v) in masks),
+    # Burn feature numbers 1..n, later features overwrite earlier ones
+    feature_ids = np.arange(1, len(gdf) + 1, dtype=np.int64)
+    burned = rio.features.rasterize(
+        zip(gdf.geometry.values, feature_ids.astype(np.int32)),
         out_shape=src.shape,
         transform=src.transform,
-    ).astype(rio.uint16)
+        dtype=np.int32,
+    )
 
-    grids = rio.features.rasterize(
-        ((g, v) for (g, v) in grids),
-        out_shape=src.shape,
-        transform=src.transform,
-    ).astype(rio.uint16)
+    mask_lut = np.zeros(len(gdf) + 1, dtype=np.float64)
+    if "class" in gdf.columns:
+        mask_lut[1:] = gdf["class"].map(values).values
+    else:
+        mask_lut[1:] = 1.0
+    grid_lut = np.concatenate(([0], feature_ids + grid_start - 1))
+
+    masks = mask_lut[burned].astype(rio.uint16)
+    grids = grid_lut[burned].astype(rio.uint16)
 
     out_meta = src.meta.copy()
     out_meta["count"] = 2
@@ -767,6 +3092,7 @@ def generate_mask(tiff_file, shape_file, output_file, plot=False):
     out_meta["dtype"] = rio.uint16
     out_meta["compress"] = "deflate"
 
+    get_dataset_cache().evict(output_file)
     with rio.open(output_file, "w", **out_meta) as dst:
         dst.write(masks, indexes=1)
         dst.write(grids, indexes=2)
@@ -785,16 +3111,30 @@ def generate_mask(tiff_file, shape_file, output_file, plot=False):
     return masks, grids, values
 
 
-def get_pos_raster_mask(area_dict, plot=False):
+def next_grid_id(area_dict, key="pos_grid_ids"):
+    """
+    Returns the first grid ID after the ranges stored under key in area_dict, or
+    1 if there are none. The mask builders store the [first, next) grid ID range
+    of each area under "pos_grid_ids" and "neg_grid_ids".
+    """
+    ends = [value[key][1] for value in area_dict.values() if key in value]
+    return max(ends, default=1)
+
+
+def get_pos_raster_mask(area_dict, plot=False, grid_start=1):
     """
     Converts positive vector label files (GPKG) to raster masks (TIFF)
 
+    Grid IDs are numbered consecutively over the areas from grid_start.
+
     Args:
         area_dict (dict) : Python dictionary containing the file paths per area
+        grid_start (int) : First grid ID
 
     Returns:
-        area_dict (dict) : The input area_dict with a new entry "pos_mask_tiff"
-                           containing the file path of the generated TIFF file.
+        area_dict (dict) : The input area_dict with new entries "pos_mask_tiff"
+                           containing the file path of the generated TIFF file
+                           and "pos_grid_ids" containing its grid ID range.
     """
 
     for area, value in area_dict.items():
@@ -804,31 +3144,45 @@ def get_pos_raster_mask(area_dict, plot=False):
         target_file = shape_file.replace("gpkg", "tiff")
 
         # Generate masks
+        shapes = read_mask_shapes(shape_file)
         generate_mask(
             tiff_file=tiff_file,
             shape_file=shape_file,
             output_file=target_file,
             plot=plot,
+            grid_start=grid_start,
+            shapes=shapes,
         )
 
         # Set filepath of raster mask in the area dictionary
         area_dict[area]["pos_mask_tiff"] = target_file
+        area_dict[area]["pos_grid_ids"] = [grid_start, grid_start + len(shapes)]
+        grid_start += len(shapes)
 
     return area_dict
 
 
-def get_neg_raster_mask(area_dict, plot=False):
+def get_neg_raster_mask(area_dict, plot=False, grid_start=None):
     """
     Converts negative vector label files (GPKG) to raster masks (TIFF)
 
+    Grid IDs are numbered consecutively over the areas from grid_start, by
+    default after the positive grid IDs recorded by get_pos_raster_mask, so the
+    IDs of both masks are unique, see next_grid_id.
+
     Args:
         area_dict (dict) : Python dictionary containing the file paths per area
+        grid_start (int) : First grid ID
 
     Returns:
-        area_dict (dict) : The input area_dict with a new entry "neg_mask_tiff"
-                           containing the file path of the generated TIFF file.
+        area_dict (dict) : The input area_dict with new entries "neg_mask_tiff"
+                           containing the file path of the generated TIFF file
+                           and "neg_grid_ids" containing its grid ID range.
     """
 
+    if grid_start is None:
+        grid_start = next_grid_id(area_dict)
+
     for area, value in area_dict.items():
 
         # Get filepaths
@@ -839,7 +3193,7 @@ def get_neg_raster_mask(area_dict, plot=False):
         if os.path.isfile(shape_file):
 
             # Read vector file + geopandas cleanup
-            gdf = gpd.read_file(shape_file)
+            shapes = read_mask_shapes(shape_file)
 
             # Generate masks
             _, _, target_dict = generate_mask(
@@ -847,7 +3201,11 @@ def get_neg_raster_mask(area_dict, plot=False):
                 shape_file=shape_file,
                 output_file=target_file,
                 plot=plot,
+                grid_start=grid_start,
+                shapes=shapes,
             )
+            area_dict[area]["neg_grid_ids"] = [grid_start, grid_start + len(shapes)]
+            grid_start += len(shapes)
 
         # Set filepath of raster mask in the area dictionary
         area_dict[area]["neg_mask_tiff"] = target_file